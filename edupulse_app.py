@@ -1,19 +1,70 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session
+from flask import (Flask, Request, render_template, request, redirect, url_for, flash, jsonify, session, make_response,
+                   send_file)
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_bcrypt import Bcrypt
-from pymongo import MongoClient
-from pymongo.errors import ConnectionFailure, ServerSelectionTimeoutError
+from flask.cli import AppGroup
+import pymongo
+from pymongo import MongoClient, IndexModel, InsertOne, UpdateOne, UpdateMany, ReturnDocument, ASCENDING, DESCENDING, monitoring
+from pymongo.errors import (ConnectionFailure, ServerSelectionTimeoutError, DuplicateKeyError, OperationFailure,
+                            ClientBulkWriteException, PyMongoError)
+from pymongo.server_type import SERVER_TYPE
+import click
 import os
+import threading
+import time
 import traceback
 from datetime import datetime, timedelta
 from werkzeug.utils import secure_filename
+from werkzeug.exceptions import RequestEntityTooLarge, NotFound
 import logging
 import calendar
+import contextlib
+import mimetypes
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import functools
+import hashlib
+import hmac
+import io
+import itertools
+import json
+import tracemalloc
 import random
+import shutil
 import string
+import subprocess
+import sys
+import tempfile
+import urllib.parse
+import urllib.request
 import uuid
+import numpy as np
+from bson import ObjectId
+from bson import encode as bson_encode
+from bson.int64 import Int64
+from twilio.request_validator import RequestValidator
 from twilio.rest import Client
 
+# boto3 is optional; needed only for PHOTO_STORAGE=s3
+try:
+    import boto3
+    from botocore.config import Config as BotoConfig
+    from botocore.exceptions import ClientError
+except ImportError:
+    boto3 = None
+
+# Pillow is optional; without it photos are stored as uploaded
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = ImageOps = None
+
+try:
+    import prometheus_client
+    from prometheus_client import CollectorRegistry, Counter, Histogram, multiprocess
+    from prometheus_client.core import GaugeMetricFamily
+except ImportError:
+    prometheus_client = None
+
 # Configure logging
 logging.basicConfig(level=logging.INFO, 
                     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -29,42 +80,1071 @@ app.config['TWILIO_ACCOUNT_SID'] = os.environ.get('AC470f84ce0e1de280d9fc2ca8237
 app.config['TWILIO_AUTH_TOKEN'] = os.environ.get('af0ac93a4073efed905879f891b94c55', '')    # Add your Twilio Auth Token here if not using env vars
 app.config['TWILIO_PHONE_NUMBER'] = os.environ.get('+15055392013', '') # Add your Twilio Phone Number here if not using env vars
 app.config['TWILIO_CALLBACK_URL'] = os.environ.get('TWILIO_CALLBACK_URL', 'https://your-app-url.com/ivr/callback')
+# Where Twilio reports the final status of each call; when unset, /ivr/status next to the callback URL
+app.config['TWILIO_STATUS_CALLBACK_URL'] = os.environ.get('TWILIO_STATUS_CALLBACK_URL', '')
 app.config['TEST_PHONE_NUMBERS'] = os.environ.get('8050117904,9035541365', '')  # Comma-separated list of test phone numbers
 
+# IVR campaign limits, applied per Twilio account
+app.config['CAMPAIGN_MAX_CONCURRENCY'] = int(os.environ.get('CAMPAIGN_MAX_CONCURRENCY', '8'))
+app.config['CAMPAIGN_CALLS_PER_SECOND'] = float(os.environ.get('CAMPAIGN_CALLS_PER_SECOND', '5'))
+# A process that stops while placing a call gives its share of the concurrency limit back after this long
+app.config['CAMPAIGN_CALL_LEASE_SECONDS'] = int(os.environ.get('CAMPAIGN_CALL_LEASE_SECONDS', '60'))
+# Campaigns without a heartbeat for this long are considered abandoned and may be resumed
+app.config['CAMPAIGN_STALE_SECONDS'] = int(os.environ.get('CAMPAIGN_STALE_SECONDS', '120'))
+
 bcrypt = Bcrypt(app)
 
 # Configure upload folder before any routes are defined
 app.config['UPLOAD_FOLDER'] = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads')
-if not os.path.exists(app.config['UPLOAD_FOLDER']):
-    os.makedirs(app.config['UPLOAD_FOLDER'])
-    logger.info(f"Created upload folder: {app.config['UPLOAD_FOLDER']}")
 
-# MongoDB Connection - Using local MongoDB for reliable development
-try:
-    # Using local MongoDB connection which is more reliable for development
-    client = MongoClient("mongodb://localhost:27017/", serverSelectionTimeoutMS=5000)
-    # Test the connection
-    client.admin.command('ping')
-    logger.info("Connected successfully to MongoDB")
-except (ConnectionFailure, ServerSelectionTimeoutError) as e:
-    logger.error(f"MongoDB Connection Error: {e}")
-    raise
+# Uploads are streamed here first; it must be on the same filesystem as UPLOAD_FOLDER
+app.config['UPLOAD_STAGING_FOLDER'] = os.path.join(app.config['UPLOAD_FOLDER'], '.incoming')
+_staging_folder_ready = None
+
+# The upload staging folder, created on first use in each process rather than at import
+def upload_staging_folder():
+    global _staging_folder_ready
+    folder = app.config['UPLOAD_STAGING_FOLDER']
+    if _staging_folder_ready != folder:
+        if not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+            logger.info(f"Created upload folder: {folder}")
+        _staging_folder_ready = folder
+    return folder
+
+# Upload limits: the whole request, and each photo in it
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_UPLOAD_MB', '40')) * 1024 * 1024
+app.config['PHOTO_MAX_BYTES'] = int(os.environ.get('PHOTO_MAX_MB', '15')) * 1024 * 1024
+# Processed photos are scaled down to fit this many pixels on their longest side
+app.config['PHOTO_MAX_DIMENSION'] = int(os.environ.get('PHOTO_MAX_DIMENSION', '2048'))
+app.config['PHOTO_WORKERS'] = int(os.environ.get('PHOTO_WORKERS', '2'))
+
+# Where stored photos live: "local" keeps them under UPLOAD_FOLDER, "s3" in an S3-compatible
+# bucket (AWS S3, MinIO, ...) reached with the usual AWS_ACCESS_KEY_ID / AWS_SECRET_ACCESS_KEY
+app.config['PHOTO_STORAGE'] = os.environ.get('PHOTO_STORAGE', 'local')
+app.config['S3_BUCKET'] = os.environ.get('S3_BUCKET', 'edupulse-photos')
+app.config['S3_ENDPOINT_URL'] = os.environ.get('S3_ENDPOINT_URL') or None
+app.config['S3_REGION'] = os.environ.get('S3_REGION', 'us-east-1')
+# Lifetime of presigned upload and download URLs
+app.config['PHOTO_PRESIGNED_URL_SECONDS'] = int(os.environ.get('PHOTO_PRESIGNED_URL_SECONDS', '900'))
+
+# Smaller renditions made for every stored photo, kept next to it as <digest>.w<width>.<ext>.
+# Formats Pillow cannot write here (AVIF needs a recent build) are skipped.
+app.config['PHOTO_RENDITION_WIDTHS'] = [
+    int(width) for width in os.environ.get('PHOTO_RENDITION_WIDTHS', '320,640,1280').split(',') if width.strip()
+]
+app.config['PHOTO_RENDITION_FORMATS'] = [
+    name.strip() for name in os.environ.get('PHOTO_RENDITION_FORMATS', 'webp,jpeg').split(',') if name.strip()
+]
+app.config['PHOTO_TRANSCODE_PROCESSES'] = int(os.environ.get('PHOTO_TRANSCODE_PROCESSES', str(os.cpu_count() or 1)))
+# Photos whose 64-bit dHashes differ in at most this many bits are treated as the same picture
+app.config['PHOTO_REUSE_MAX_DISTANCE'] = int(os.environ.get('PHOTO_REUSE_MAX_DISTANCE', '6'))
+
+class HashingUploadFile:
+    """
+    Temporary file for one uploaded part that hashes the bytes as werkzeug
+    writes them, and refuses parts larger than max_bytes.
+    """
+    
+    def __init__(self, directory, max_bytes):
+        self._file = tempfile.NamedTemporaryFile(dir=directory, prefix="upload-", delete=False)
+        self.name = self._file.name
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        self.max_bytes = max_bytes
+        self.claimed = False
+        self.started_at = self.finished_at = time.perf_counter()
+    
+    def write(self, data):
+        self.finished_at = time.perf_counter()
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            raise RequestEntityTooLarge(f"Each photo may be at most {self.max_bytes // (1024 * 1024)} MB")
+        self.sha256.update(data)
+        return self._file.write(data)
+    
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+class UploadRequest(Request):
+    """Request that streams file uploads into HashingUploadFile instead of memory or anonymous temp files"""
+    
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        upload = HashingUploadFile(upload_staging_folder(), app.config['PHOTO_MAX_BYTES'])
+        self.__dict__.setdefault("upload_files", []).append(upload)
+        return upload
+
+app.request_class = UploadRequest
+
+# Remove uploaded parts the request did not claim
+@app.teardown_request
+def remove_unclaimed_uploads(error=None):
+    for upload in request.__dict__.get("upload_files", []):
+        upload.close()
+        if metrics is not None:
+            metrics.upload_bytes.observe(upload.size)
+            metrics.upload_seconds.observe(upload.finished_at - upload.started_at)
+        if not upload.claimed:
+            try:
+                os.remove(upload.name)
+            except FileNotFoundError:
+                pass
+
+@app.errorhandler(RequestEntityTooLarge)
+def upload_too_large(error):
+    message = error.description
+    if message == RequestEntityTooLarge.description:
+        message = f"The upload may be at most {app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)} MB in total"
+    return jsonify({"status": "fail", "message": f"Upload too large. {message}."}), 413
+
+class LocalDiskStorage:
+    """
+    Photo storage in a directory on this server. Presigned uploads are
+    signed URLs for /storage/<key> on this app, so their bytes still pass
+    through a web worker; meant for development and single-node installs.
+    """
+    
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+    
+    def path(self, key):
+        path = os.path.normpath(os.path.join(self.root, key))
+        if not path.startswith(os.path.join(self.root, "")):
+            raise ValueError(f"Invalid storage key: {key}")
+        return path
+    
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+    
+    def size(self, key):
+        try:
+            return os.path.getsize(self.path(key))
+        except FileNotFoundError:
+            return None
+    
+    def put_file(self, key, local_path, content_type=None):
+        """Store the contents of local_path under key; local_path is left in place"""
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Linked or copied beside the target and renamed into place, so an object is never seen half-written
+        partial_path = f"{path}.{uuid.uuid4().hex}.partial"
+        try:
+            os.link(local_path, partial_path)
+        except OSError:
+            shutil.copyfile(local_path, partial_path)
+        os.replace(partial_path, path)
+    
+    def fetch(self, key, local_path):
+        shutil.copyfile(self.path(key), local_path)
+    
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+    
+    def _signature(self, key, content_type, expires):
+        message = f"PUT\n{key}\n{content_type}\n{expires}".encode()
+        return hmac.new(app.secret_key.encode(), message, hashlib.sha256).hexdigest()
+    
+    def presigned_put(self, key, content_type, expires_in):
+        expires = int(time.time()) + expires_in
+        return url_for("local_storage_put", key=key, expires=expires,
+                       signature=self._signature(key, content_type, expires), _external=True)
+    
+    def verify_put(self, key, content_type, expires, signature):
+        try:
+            expires = int(expires)
+        except (TypeError, ValueError):
+            return False
+        return expires >= time.time() and hmac.compare_digest(self._signature(key, content_type, expires), signature or "")
+    
+    def send(self, key, mimetype, etag, max_age):
+        path = self.path(key)
+        if not os.path.exists(path):
+            raise NotFound()
+        return send_file(path, mimetype=mimetype, etag=etag, max_age=max_age)
+
+class S3Storage:
+    """
+    Photo storage in an S3-compatible bucket (AWS S3, MinIO, ...). Clients
+    upload straight to the bucket with presigned PUT URLs, and photos are
+    served by redirecting to presigned GET URLs.
+    """
+    
+    def __init__(self, bucket, endpoint_url=None, region=None):
+        if boto3 is None:
+            raise RuntimeError("PHOTO_STORAGE=s3 needs boto3: pip install boto3")
+        self.bucket = bucket
+        self.client = boto3.client("s3", endpoint_url=endpoint_url, region_name=region,
+                                   config=BotoConfig(signature_version="s3v4"))
+    
+    def _head(self, key):
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+    
+    def exists(self, key):
+        return self._head(key) is not None
+    
+    def size(self, key):
+        head = self._head(key)
+        return head["ContentLength"] if head else None
+    
+    def put_file(self, key, local_path, content_type=None):
+        """Store the contents of local_path under key; local_path is left in place"""
+        extra_args = {"ContentType": content_type} if content_type else None
+        self.client.upload_file(local_path, self.bucket, key, ExtraArgs=extra_args)
+    
+    def fetch(self, key, local_path):
+        self.client.download_file(self.bucket, key, local_path)
+    
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+    
+    def presigned_put(self, key, content_type, expires_in):
+        return self.client.generate_presigned_url(
+            "put_object",
+            Params={"Bucket": self.bucket, "Key": key, "ContentType": content_type},
+            ExpiresIn=expires_in
+        )
+    
+    def send(self, key, mimetype, etag, max_age):
+        expires_in = app.config['PHOTO_PRESIGNED_URL_SECONDS']
+        url = self.client.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": self.bucket, "Key": key, "ResponseContentType": mimetype,
+                    "ResponseCacheControl": f"private, max-age={max_age}"},
+            ExpiresIn=expires_in
+        )
+        # The redirect may be reused until shortly before its URL expires
+        response = redirect(url)
+        response.cache_control.max_age = max(0, expires_in - 60)
+        return response
+
+# Photo storage backend selected by PHOTO_STORAGE
+def create_photo_storage():
+    if app.config['PHOTO_STORAGE'] == "s3":
+        return S3Storage(app.config['S3_BUCKET'], app.config['S3_ENDPOINT_URL'], app.config['S3_REGION'])
+    return LocalDiskStorage(app.config['UPLOAD_FOLDER'])
+
+class LazyPhotoStorage:
+    """
+    Stand-in for the photo storage backend that creates it per process on use.
+
+    Like the MongoClient (see MongoConnection), an S3 client's connection
+    pool must not be shared across fork(), so none is created at import and
+    a forked child creates its own.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+        self._storage = None
+    
+    def backend(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._storage = create_photo_storage()
+                    self._pid = os.getpid()
+        return self._storage
+    
+    def reset(self):
+        """Drop this process's backend, e.g. after PHOTO_STORAGE changed; the next use creates a new one"""
+        with self._lock:
+            self._pid = self._storage = None
+    
+    def _after_fork(self):
+        # The lock may have been held by a parent thread at fork time
+        self._lock = threading.Lock()
+    
+    def __getattr__(self, name):
+        return getattr(self.backend(), name)
+
+photo_storage = LazyPhotoStorage()
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=photo_storage._after_fork)
+
+# MongoDB configuration
+app.config['MONGO_URI'] = os.environ.get('MONGO_URI', 'mongodb://localhost:27017/')
+app.config['MONGO_DB_NAME'] = os.environ.get('MONGO_DB_NAME', 'edupulse_db')
+
+# How often each process checks whether the curriculum changed
+app.config['CURRICULUM_POLL_SECONDS'] = float(os.environ.get('CURRICULUM_POLL_SECONDS', '30'))
+
+# Store new course progress as a completion bitmap instead of a copy of the curriculum tree
+app.config['COMPACT_PROGRESS'] = os.environ.get('COMPACT_PROGRESS', '0') == '1'
+
+# School holidays excluded from working days, as comma-separated YYYY-MM-DD dates
+app.config['SCHOOL_HOLIDAYS'] = [
+    day.strip() for day in os.environ.get('SCHOOL_HOLIDAYS', '').split(',') if day.strip()
+]
+
+# Most read queries a teacher dashboard render may issue; exceeding it fails in debug/testing and logs otherwise
+app.config['DASHBOARD_QUERY_BUDGET'] = int(os.environ.get('DASHBOARD_QUERY_BUDGET', '3'))
+
+# How long completed submissions are remembered for replay, and when an unfinished one counts as abandoned
+app.config['IDEMPOTENCY_KEY_TTL_SECONDS'] = int(os.environ.get('IDEMPOTENCY_KEY_TTL_SECONDS', '86400'))
+app.config['IDEMPOTENCY_STALE_SECONDS'] = int(os.environ.get('IDEMPOTENCY_STALE_SECONDS', '120'))
+
+# Round trips a /mark_attendance submission is expected to need; the actual count is logged per request
+app.config['ATTENDANCE_ROUND_TRIP_BUDGET'] = int(os.environ.get('ATTENDANCE_ROUND_TRIP_BUDGET', '6'))
+# How long a worker trusts its last look at the daily_attendance unique index
+app.config['ATTENDANCE_INDEX_CHECK_SECONDS'] = int(os.environ.get('ATTENDANCE_INDEX_CHECK_SECONDS', '60'))
+
+# MongoDB commands any request may issue before a warning is logged, and how often one query shape
+# may repeat within a request before it is reported as a probable N+1 loop
+app.config['REQUEST_QUERY_BUDGET'] = int(os.environ.get('REQUEST_QUERY_BUDGET', '25'))
+app.config['QUERY_REPEAT_THRESHOLD'] = int(os.environ.get('QUERY_REPEAT_THRESHOLD', '5'))
+
+class RequestQueryCounter(monitoring.CommandListener):
+    """
+    Records the commands issued by the current thread while measuring.
+
+    pymongo publishes command events on the thread that runs the operation,
+    so a thread-local list keeps concurrent requests apart. Every Flask
+    request is measured from before_request to after_request; the budget
+    decorators look at the commands their view issued. Each record holds the
+    command name, collection, duration once it finished, and for queries
+    and writes its shape: the filter with every value replaced by "?", so
+    that repeats of the same lookup with different values compare equal.
+    Reads of the curriculum store's collections are not counted as queries;
+    its reloads are shared by every request in the process.
+    """
+    
+    READ_COMMANDS = {"find", "aggregate", "count", "distinct"}
+    WRITE_COMMANDS = {"insert", "update", "delete", "findAndModify", "bulkWrite"}
+    SHAPED_COMMANDS = READ_COMMANDS | {"insert", "update", "delete", "findAndModify"}
+    IGNORED_COLLECTIONS = {"curriculum", "schema_migrations"}
+    
+    def __init__(self):
+        self._local = threading.local()
+    
+    def start(self):
+        self._local.commands = []
+        self._local.running = {}
+    
+    def stop(self):
+        commands = getattr(self._local, "commands", None)
+        self._local.commands = None
+        self._local.running = None
+        return commands or []
+    
+    def mark(self):
+        """Position in the current recording, starting one if none is running"""
+        if getattr(self._local, "commands", None) is None:
+            self.start()
+        return len(self._local.commands)
+    
+    def since(self, mark):
+        return (getattr(self._local, "commands", None) or [])[mark:]
+    
+    @classmethod
+    def reads(cls, commands):
+        return [f"{command['name']} {command['collection']}" for command in commands
+                if command["name"] in cls.READ_COMMANDS and command["collection"] not in cls.IGNORED_COLLECTIONS]
+    
+    @classmethod
+    def wrote(cls, commands):
+        """Whether the commands may have changed data: a write outside a transaction or a transaction commit"""
+        return any((command["name"] in cls.WRITE_COMMANDS and not command["in_transaction"])
+                   or command["name"] == "commitTransaction" for command in commands)
+    
+    @classmethod
+    def shape(cls, value):
+        if isinstance(value, dict):
+            return {key: cls.shape(item) for key, item in value.items()}
+        if isinstance(value, list) and any(isinstance(item, (dict, list)) for item in value):
+            return [cls.shape(item) for item in value]
+        return "?"
+    
+    @classmethod
+    def command_shape(cls, name, command):
+        if name == "find":
+            query = command.get("filter", {})
+        elif name == "aggregate":
+            query = command.get("pipeline", [])
+        elif name in ("count", "distinct", "findAndModify"):
+            query = command.get("query", {})
+        elif name in ("update", "delete"):
+            statements = command.get("updates" if name == "update" else "deletes") or [{}]
+            query = statements[0].get("q", {})
+        else:
+            return f"{name} {command.get(name)}"
+        return f"{name} {command.get(name)} {json.dumps(cls.shape(query), default=str)}"
+    
+    @staticmethod
+    def repeated_shapes(commands, threshold):
+        """Query shapes issued at least threshold times, most repeated first: probable N+1 loops"""
+        counts = {}
+        for command in commands:
+            if command["shape"] is not None:
+                counts[command["shape"]] = counts.get(command["shape"], 0) + 1
+        return sorted([(count, shape) for shape, count in counts.items() if count >= threshold], reverse=True)
+    
+    def started(self, event):
+        commands = getattr(self._local, "commands", None)
+        if commands is not None:
+            name = event.command_name
+            record = {
+                "name": name,
+                "collection": event.command.get(name),
+                "shape": self.command_shape(name, event.command) if name in self.SHAPED_COMMANDS else None,
+                # Operations of a transaction carry autocommit: false
+                "in_transaction": "autocommit" in event.command,
+                "duration": None
+            }
+            commands.append(record)
+            self._local.running[(event.connection_id, event.request_id)] = record
+    
+    def _finished(self, event):
+        running = getattr(self._local, "running", None)
+        if running:
+            record = running.pop((event.connection_id, event.request_id), None)
+            if record is not None:
+                record["duration"] = event.duration_micros / 1e6
+    
+    def succeeded(self, event):
+        self._finished(event)
+    
+    def failed(self, event):
+        self._finished(event)
+
+request_query_counter = RequestQueryCounter()
+
+# Count the read queries of a view and enforce the budget held in the given config key
+def query_budget(config_key):
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            mark = request_query_counter.mark()
+            try:
+                return view(*args, **kwargs)
+            finally:
+                reads = RequestQueryCounter.reads(request_query_counter.since(mark))
+                budget = app.config[config_key]
+                if len(reads) > budget:
+                    message = f"{request.endpoint} issued {len(reads)} queries, budget is {budget}: {', '.join(reads)}"
+                    if app.debug or app.testing:
+                        raise AssertionError(message)
+                    logger.warning(message)
+        return wrapper
+    return decorator
+
+# Log every database round trip of a view against the budget held in the given config key
+def round_trip_budget(config_key):
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            mark = request_query_counter.mark()
+            try:
+                return view(*args, **kwargs)
+            finally:
+                commands = request_query_counter.since(mark)
+                budget = app.config[config_key]
+                summary = ", ".join(f"{command['name']} {command['collection']}" for command in commands)
+                message = f"{request.endpoint} used {len(commands)} round trips (budget {budget}): {summary}"
+                if len(commands) > budget:
+                    logger.warning(message)
+                else:
+                    logger.info(message)
+        return wrapper
+    return decorator
+
+# Measure the MongoDB commands of every request
+@app.before_request
+def start_request_queries():
+    request_query_counter.start()
+    request.__dict__["started_at"] = time.perf_counter()
+
+# Report the request's commands in a Server-Timing header and warn about budget overruns and N+1 patterns
+@app.after_request
+def report_request_queries(response):
+    commands = request_query_counter.stop()
+    if metrics is not None and "started_at" in request.__dict__:
+        metrics.request_seconds.labels(request.endpoint or "unmatched", request.method, response.status_code).observe(
+            time.perf_counter() - request.__dict__["started_at"])
+    if not commands:
+        return response
+    
+    durations = [command["duration"] or 0 for command in commands]
+    slowest = commands[durations.index(max(durations))]
+    response.headers.add("Server-Timing", f'mongo;dur={sum(durations) * 1000:.1f};desc="{len(commands)} commands"')
+    response.headers.add("Server-Timing", f'mongo-slowest;dur={max(durations) * 1000:.1f};'
+                                          f'desc="{slowest["name"]} {slowest["collection"]}"')
+    
+    budget = app.config['REQUEST_QUERY_BUDGET']
+    if len(commands) > budget:
+        logger.warning(f"{request.method} {request.path} ({request.endpoint}) issued {len(commands)} MongoDB "
+                       f"commands, budget is {budget}; {sum(durations) * 1000:.1f} ms in total, slowest "
+                       f"{slowest['name']} {slowest['collection']} {max(durations) * 1000:.1f} ms")
+    for count, shape in RequestQueryCounter.repeated_shapes(commands, app.config['QUERY_REPEAT_THRESHOLD']):
+        logger.warning(f"Probable N+1 in {request.endpoint}: {count} x {shape}")
+    return response
+
+# Drop the recording of a request that ended in an exception
+@app.teardown_request
+def stop_request_queries(error=None):
+    request_query_counter.stop()
+
+# Readiness: servers must have answered a heartbeat this recently, and connection demand
+# (checked out plus waiting) may be at most this fraction of the pool size
+app.config['HEALTH_HEARTBEAT_STALE_SECONDS'] = float(os.environ.get('HEALTH_HEARTBEAT_STALE_SECONDS', '30'))
+app.config['HEALTH_MAX_POOL_SATURATION'] = float(os.environ.get('HEALTH_MAX_POOL_SATURATION', '1.0'))
+
+class HealthMonitor(monitoring.TopologyListener, monitoring.ServerListener,
+                    monitoring.ServerHeartbeatListener, monitoring.ConnectionPoolListener):
+    """
+    Health of this process's MongoDB client, kept in memory from pymongo's
+    topology, server, heartbeat and pool events.
+
+    The client's monitor threads heartbeat every server in the background,
+    so handlers can check the state without a round trip of their own. The
+    state is "starting" until the first heartbeat of any server completes,
+    then "up" while a writable server is known and "down" otherwise.
+    TopologyListener and ServerListener share their method names, so those
+    methods tell the two apart by event type.
+    """
+    
+    NEW_SERVER = {"type": "Unknown", "error": None, "heartbeat_ms": None, "last_heartbeat": None,
+                  "consecutive_failures": 0}
+    NEW_POOL = {"max_size": 0, "checked_out": 0, "waiting": 0, "checkout_timeouts": 0}
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+    
+    def reset(self):
+        with self._lock:
+            self._servers = {}
+            self._pools = {}
+            self._known = False
+            self._writable = False
+    
+    def _server(self, address):
+        return self._servers.setdefault(address, dict(self.NEW_SERVER))
+    
+    def _pool(self, address):
+        return self._pools.setdefault(address, dict(self.NEW_POOL))
+    
+    # Topology and server events
+    def opened(self, event):
+        pass
+    
+    def description_changed(self, event):
+        with self._lock:
+            if isinstance(event, monitoring.TopologyDescriptionChangedEvent):
+                servers = event.new_description.server_descriptions().values()
+                self._known = any(server.server_type != SERVER_TYPE.Unknown or server.error for server in servers)
+                self._writable = event.new_description.has_writable_server()
+            else:
+                server = self._server(event.server_address)
+                server["type"] = event.new_description.server_type_name
+                server["error"] = str(event.new_description.error) if event.new_description.error else None
+    
+    def closed(self, event):
+        if isinstance(event, monitoring.ServerClosedEvent):
+            with self._lock:
+                self._servers.pop(event.server_address, None)
+    
+    # Heartbeat events
+    def started(self, event):
+        pass
+    
+    def succeeded(self, event):
+        with self._lock:
+            server = self._server(event.connection_id)
+            server["last_heartbeat"] = time.monotonic()
+            server["consecutive_failures"] = 0
+            # An awaited (streaming) heartbeat waits for the server to report a change, so its duration is not latency
+            if not event.awaited:
+                server["heartbeat_ms"] = event.duration * 1000
+    
+    def failed(self, event):
+        with self._lock:
+            server = self._server(event.connection_id)
+            server["consecutive_failures"] += 1
+            server["error"] = str(event.reply)
+    
+    # Connection pool events
+    def pool_created(self, event):
+        with self._lock:
+            self._pool(event.address)["max_size"] = event.options.get("maxPoolSize", 100)
+    
+    def pool_ready(self, event):
+        pass
+    
+    def pool_cleared(self, event):
+        pass
+    
+    def pool_closed(self, event):
+        with self._lock:
+            self._pools.pop(event.address, None)
+    
+    def connection_created(self, event):
+        pass
+    
+    def connection_ready(self, event):
+        pass
+    
+    def connection_closed(self, event):
+        pass
+    
+    def connection_check_out_started(self, event):
+        with self._lock:
+            self._pool(event.address)["waiting"] += 1
+    
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            pool = self._pool(event.address)
+            pool["waiting"] -= 1
+            if event.reason == monitoring.ConnectionCheckOutFailedReason.TIMEOUT:
+                pool["checkout_timeouts"] += 1
+    
+    def connection_checked_out(self, event):
+        with self._lock:
+            pool = self._pool(event.address)
+            pool["waiting"] -= 1
+            pool["checked_out"] += 1
+    
+    def connection_checked_in(self, event):
+        with self._lock:
+            self._pool(event.address)["checked_out"] -= 1
+    
+    def status(self):
+        if not self._known:
+            return "starting"
+        return "up" if self._writable else "down"
+    
+    def database_available(self):
+        """False once the monitor has seen that no server takes writes; True while it does not know yet"""
+        return self.status() != "down"
+    
+    def snapshot(self, topology_description=None):
+        """Current state per server; round trip times come from the client's topology description if given"""
+        round_trips = {}
+        if topology_description is not None:
+            round_trips = {address: description.round_trip_time
+                           for address, description in topology_description.server_descriptions().items()}
+        now = time.monotonic()
+        with self._lock:
+            servers = []
+            for address in sorted(set(self._servers) | set(self._pools)):
+                server = self._servers.get(address, self.NEW_SERVER)
+                pool = self._pools.get(address, self.NEW_POOL)
+                round_trip = round_trips.get(address)
+                servers.append({
+                    "address": f"{address[0]}:{address[1]}",
+                    "type": server["type"],
+                    "error": server["error"],
+                    "consecutive_failures": server["consecutive_failures"],
+                    "heartbeat_ms": round(server["heartbeat_ms"], 2) if server["heartbeat_ms"] is not None else None,
+                    "round_trip_ms": round(round_trip * 1000, 2) if round_trip is not None else None,
+                    "last_heartbeat_seconds_ago": (round(now - server["last_heartbeat"], 1)
+                                                   if server["last_heartbeat"] is not None else None),
+                    "pool_size": pool["max_size"],
+                    "checked_out": pool["checked_out"],
+                    "waiting": pool["waiting"],
+                    "pool_saturation": (round((pool["checked_out"] + pool["waiting"]) / pool["max_size"], 3)
+                                        if pool["max_size"] else 0.0),
+                    "checkout_timeouts": pool["checkout_timeouts"]
+                })
+            return {"state": self.status(), "servers": servers}
+    
+    @staticmethod
+    def not_ready_reasons(snapshot, stale_seconds, max_saturation):
+        """Why a snapshot is not ready to serve traffic; empty when it is"""
+        reasons = []
+        if snapshot["state"] != "up":
+            reasons.append(f"database is {snapshot['state']}")
+        for server in snapshot["servers"]:
+            age = server["last_heartbeat_seconds_ago"]
+            # Servers the client has not reached yet are covered by the state
+            if server["type"] != "Unknown" and (age is None or age > stale_seconds):
+                reasons.append(f"no heartbeat from {server['address']} for over {stale_seconds:g}s")
+            if server["pool_saturation"] > max_saturation:
+                reasons.append(f"connection pool for {server['address']} is {server['pool_saturation']:.0%} saturated")
+        return reasons
+
+health_monitor = HealthMonitor()
+
+# Answer 503 straight away, without a round trip, while the health monitor knows the database is down
+def requires_database(view):
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not health_monitor.database_available():
+            logger.warning(f"{request.endpoint} refused: database is down")
+            return jsonify({"status": "fail", "message": "Database connection error. Please try again."}), 503
+        return view(*args, **kwargs)
+    return wrapper
+
+# Prometheus metrics at /metrics, on by default when prometheus_client is installed. With several
+# worker processes set PROMETHEUS_MULTIPROC_DIR to an empty directory before the server starts.
+app.config['METRICS_ENABLED'] = (prometheus_client is not None
+                                 and os.environ.get('METRICS_ENABLED', '1') == '1')
+# Upper bound on the database query a scrape makes, server selection included
+app.config['METRICS_QUERY_TIMEOUT_SECONDS'] = float(os.environ.get('METRICS_QUERY_TIMEOUT_SECONDS', '0.5'))
+
+class AppMetrics(monitoring.CommandListener):
+    """
+    Prometheus metrics of this process: request latency per endpoint, MongoDB
+    command time per collection, upload sizes and durations, and IVR call
+    outcomes. It is also registered as a command listener on the MongoDB client.
+
+    With PROMETHEUS_MULTIPROC_DIR set, prometheus_client keeps every value in
+    memory-mapped files in that directory, one per process, and /metrics sums
+    the files of all workers. Campaign queue depth is not kept here; it is
+    read from the database when /metrics is scraped, see CampaignQueueCollector.
+    """
+    
+    LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+    MONGO_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, 1)
+    UPLOAD_BYTE_BUCKETS = tuple(1024 * kb for kb in (64, 256, 1024, 4096, 16384, 65536))
+    
+    def __init__(self):
+        self.request_seconds = Histogram(
+            "edupulse_request_duration_seconds", "Time to handle a request, by Flask endpoint",
+            ["endpoint", "method", "status"], buckets=self.LATENCY_BUCKETS)
+        self.mongo_seconds = Histogram(
+            "edupulse_mongo_command_duration_seconds", "Time of MongoDB commands, by command and collection",
+            ["command", "collection"], buckets=self.MONGO_BUCKETS)
+        self.upload_bytes = Histogram(
+            "edupulse_upload_bytes", "Size of each uploaded photo received by the app",
+            buckets=self.UPLOAD_BYTE_BUCKETS)
+        self.upload_seconds = Histogram(
+            "edupulse_upload_duration_seconds", "Time from the first to the last byte of each uploaded photo",
+            buckets=self.LATENCY_BUCKETS)
+        self.ivr_calls = Counter(
+            "edupulse_ivr_calls", "Finished IVR calls, by final status", ["status"])
+        self._local = threading.local()
+    
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        running = getattr(self._local, "running", None)
+        if running is None:
+            running = self._local.running = {}
+        running[(event.connection_id, event.request_id)] = collection if isinstance(collection, str) else ""
+    
+    def _finished(self, event):
+        running = getattr(self._local, "running", None)
+        collection = running.pop((event.connection_id, event.request_id), "") if running else ""
+        self.mongo_seconds.labels(event.command_name, collection).observe(event.duration_micros / 1e6)
+    
+    def succeeded(self, event):
+        self._finished(event)
+    
+    def failed(self, event):
+        self._finished(event)
+
+class CampaignQueueCollector:
+    """IVR campaigns that are queued or running and their calls not yet dialed, read at scrape time"""
+    
+    @staticmethod
+    def _families():
+        return (GaugeMetricFamily("edupulse_campaigns", "IVR campaigns by status", labels=["status"]),
+                GaugeMetricFamily("edupulse_campaign_calls_queued",
+                                  "Calls of queued or running IVR campaigns not yet dialed", labels=["status"]))
+    
+    def describe(self):
+        # Lets the registry learn the metric names without querying the database
+        return self._families()
+    
+    def collect(self):
+        campaigns, queued_calls = self._families()
+        # A scrape must not wait on a database that is down; the other metrics are still served
+        if not health_monitor.database_available():
+            return
+        try:
+            with pymongo.timeout(app.config['METRICS_QUERY_TIMEOUT_SECONDS']):
+                rows = {row["_id"]: row for row in feedback_campaigns_collection.aggregate([
+                    {"$match": {"status": {"$in": ["queued", "running"]}}},
+                    {"$group": {
+                        "_id": "$status",
+                        "campaigns": {"$sum": 1},
+                        "calls": {"$sum": {"$subtract": ["$total_calls",
+                                                         {"$add": ["$calls_dispatched", "$calls_failed"]}]}}
+                    }}
+                ])}
+        except PyMongoError as e:
+            logger.error(f"Error reading campaign queue for metrics: {e}")
+            return
+        for status in ["queued", "running"]:
+            row = rows.get(status, {})
+            campaigns.add_metric([status], row.get("campaigns", 0))
+            queued_calls.add_metric([status], row.get("calls", 0))
+        yield campaigns
+        yield queued_calls
+
+metrics = AppMetrics() if app.config['METRICS_ENABLED'] else None
+if metrics is not None and "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+    prometheus_client.REGISTRY.register(CampaignQueueCollector())
+
+# Registry to expose at /metrics: this process's, or the sum of every worker's in multiprocess mode
+def metrics_registry():
+    if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+        return prometheus_client.REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    registry.register(CampaignQueueCollector())
+    return registry
+
+class MongoConnection:
+    """
+    The MongoClient of the current process, created on first use.
+
+    A MongoClient must not be shared across fork(): its pool sockets and
+    monitor threads belong to the parent. Nothing connects at import, so
+    pre-fork servers such as gunicorn fork before any client exists, and
+    each worker creates its own on its first request. If a process forks
+    after all, the child notices the changed pid and creates a fresh client.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+        self._client = None
+        self._database = None
+    
+    def client(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    # MongoClient connects in the background; the first operation waits for it
+                    health_monitor.reset()
+                    listeners = [request_query_counter, health_monitor] + ([metrics] if metrics is not None else [])
+                    self._client = MongoClient(app.config['MONGO_URI'], serverSelectionTimeoutMS=5000,
+                                               event_listeners=listeners)
+                    self._database = self._client[app.config['MONGO_DB_NAME']]
+                    self._pid = os.getpid()
+                    logger.info(f"Created MongoDB client for process {self._pid}")
+        return self._client
+    
+    def database(self):
+        self.client()
+        return self._database
+    
+    def reset(self):
+        """Close this process's client, e.g. after MONGO_URI changed; the next use creates a new one"""
+        with self._lock:
+            if self._pid == os.getpid() and self._client is not None:
+                self._client.close()
+            self._pid = self._client = self._database = None
+    
+    def _after_fork(self):
+        # The lock may have been held by a parent thread at fork time
+        self._lock = threading.Lock()
+
+mongo_connection = MongoConnection()
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=mongo_connection._after_fork)
+
+class LazyDatabase:
+    """Stand-in for the application Database that resolves to the current process's client on use"""
+    
+    def __getitem__(self, name):
+        return mongo_connection.database()[name]
+    
+    def __getattr__(self, name):
+        return getattr(mongo_connection.database(), name)
+
+class LazyCollection:
+    """Stand-in for an application collection that resolves to the current process's client on use"""
+    
+    def __init__(self, collection_name):
+        self._collection_name = collection_name
+        self._database = None
+        self._collection = None
+    
+    def _resolve(self):
+        database = mongo_connection.database()
+        if database is not self._database:
+            self._collection = database[self._collection_name]
+            self._database = database
+        return self._collection
+    
+    def __getitem__(self, name):
+        return self._resolve()[name]
+    
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
 
 # Initialize database collections
-db = client['edupulse_db']
-contact_collection = db['contact_messages']
-users_collection = db["users"]
-principals_collection = db["principals"]
-attendance_collection = db["attendance"]
-activities_collection = db["activities"]
-daily_attendance_collection = db["daily_attendance"]
-teacher_monthly_stats = db["teacher_monthly_stats"]
-subject_activity_stats = db["subject_activity_stats"]
-curriculum_collection = db["curriculum"]
-course_progress_collection = db["course_progress"]
-feedback_ratings_collection = db["feedback_ratings"]
-calls_collection = db["call_records"]
-warnings_collection = db["warnings"]
+db = LazyDatabase()
+contact_collection = LazyCollection("contact_messages")
+users_collection = LazyCollection("users")
+principals_collection = LazyCollection("principals")
+attendance_collection = LazyCollection("attendance")
+activities_collection = LazyCollection("activities")
+daily_attendance_collection = LazyCollection("daily_attendance")
+teacher_monthly_stats = LazyCollection("teacher_monthly_stats")
+school_daily_attendance = LazyCollection("school_daily_attendance")
+subject_activity_stats = LazyCollection("subject_activity_stats")
+curriculum_collection = LazyCollection("curriculum")
+course_progress_collection = LazyCollection("course_progress")
+feedback_ratings_collection = LazyCollection("feedback_ratings")
+calls_collection = LazyCollection("call_records")
+feedback_campaigns_collection = LazyCollection("feedback_campaigns")
+campaign_calls_collection = LazyCollection("campaign_calls")
+warnings_collection = LazyCollection("warnings")
+rating_history_collection = LazyCollection("rating_history")
+schema_migrations_collection = LazyCollection("schema_migrations")
+idempotency_keys_collection = LazyCollection("idempotency_keys")
+photo_blobs_collection = LazyCollection("photo_blobs")
+
+# Index manifest for every collection. Bump INDEX_MANIFEST_VERSION whenever the
+# manifest changes so that `flask db ensure-indexes` applies it on the next deploy.
+INDEX_MANIFEST_VERSION = 9
+INDEX_MANIFEST = {
+    "users": [
+        IndexModel([("email", ASCENDING)], name="email_unique", unique=True),
+        IndexModel([("teacher_id", ASCENDING)], name="teacher_id_unique", unique=True,
+                   partialFilterExpression={"teacher_id": {"$type": "string"}}),
+        IndexModel([("role", ASCENDING), ("school", ASCENDING)], name="role_school")
+    ],
+    "principals": [
+        IndexModel([("email", ASCENDING)], name="email_unique", unique=True)
+    ],
+    "daily_attendance": [
+        IndexModel([("teacher_email", ASCENDING), ("date_str", ASCENDING)], name="teacher_date_unique", unique=True),
+        IndexModel([("date_str", ASCENDING), ("status", ASCENDING)], name="date_status")
+    ],
+    "activities": [
+        IndexModel([("teacher_email", ASCENDING), ("date_str", ASCENDING), ("status", ASCENDING)], name="teacher_date_status"),
+        IndexModel([("teacher_email", ASCENDING), ("created_at", DESCENDING)], name="teacher_created"),
+        IndexModel([("status", ASCENDING), ("completion_date", ASCENDING)], name="status_completion_date"),
+        IndexModel([("photo_paths", ASCENDING)], name="photo_paths"),
+        IndexModel([("photo_hashed_at", ASCENDING)], name="photo_hashed_at", sparse=True),
+        IndexModel([("suspected_reuse", ASCENDING), ("created_at", DESCENDING)], name="suspected_reuse_created",
+                   partialFilterExpression={"suspected_reuse": True})
+    ],
+    "course_progress": [
+        IndexModel([("teacher_email", ASCENDING), ("class", ASCENDING), ("subject", ASCENDING)],
+                   name="teacher_class_subject_unique", unique=True),
+        IndexModel([("teacher_email", ASCENDING), ("updated_at", DESCENDING)], name="teacher_updated")
+    ],
+    "curriculum": [
+        IndexModel([("class", ASCENDING), ("subject", ASCENDING)], name="class_subject_unique", unique=True)
+    ],
+    "teacher_monthly_stats": [
+        IndexModel([("teacher_email", ASCENDING), ("year", ASCENDING), ("month", ASCENDING)],
+                   name="teacher_month_unique", unique=True),
+        IndexModel([("year", ASCENDING), ("month", ASCENDING)], name="year_month"),
+        IndexModel([("school", ASCENDING), ("year", ASCENDING), ("month", ASCENDING)], name="school_year_month")
+    ],
+    "school_daily_attendance": [
+        IndexModel([("school", ASCENDING), ("date_str", ASCENDING)], name="school_date_unique", unique=True),
+        IndexModel([("date_str", ASCENDING)], name="date")
+    ],
+    "subject_activity_stats": [
+        IndexModel([("teacher_email", ASCENDING), ("subject", ASCENDING), ("class", ASCENDING),
+                    ("year", ASCENDING), ("month", ASCENDING)], name="teacher_subject_month_unique", unique=True)
+    ],
+    "feedback_ratings": [
+        IndexModel([("teacher_email", ASCENDING), ("created_at", DESCENDING)], name="teacher_created"),
+        IndexModel([("campaign_id", ASCENDING), ("status", ASCENDING)], name="campaign_status")
+    ],
+    "feedback_campaigns": [
+        IndexModel([("status", ASCENDING), ("heartbeat_at", ASCENDING)], name="status_heartbeat")
+    ],
+    "campaign_calls": [
+        IndexModel([("campaign_id", ASCENDING), ("status", ASCENDING)], name="campaign_status")
+    ],
+    "call_records": [
+        IndexModel([("call_sid", ASCENDING)], name="call_sid_unique", unique=True)
+    ],
+    "warnings": [
+        IndexModel([("teacher_email", ASCENDING), ("read", ASCENDING)], name="teacher_read")
+    ],
+    "rating_history": [
+        IndexModel([("teacher_email", ASCENDING), ("created_at", ASCENDING)], name="teacher_created"),
+        IndexModel([("feedback_id", ASCENDING)], name="feedback")
+    ],
+    "idempotency_keys": [
+        IndexModel([("created_at", ASCENDING)], name="created_ttl",
+                   expireAfterSeconds=app.config['IDEMPOTENCY_KEY_TTL_SECONDS'])
+    ],
+    "photo_blobs": [
+        IndexModel([("released_at", ASCENDING)], name="released_at",
+                   partialFilterExpression={"released_at": {"$exists": True}})
+    ]
+}
+
+# Apply changed expireAfterSeconds values of existing TTL indexes in the manifest
+def sync_ttl_indexes(database, report):
+    for collection_name, indexes in INDEX_MANIFEST.items():
+        ttl_indexes = [index.document for index in indexes if "expireAfterSeconds" in index.document]
+        if not ttl_indexes:
+            continue
+        existing = database[collection_name].index_information()
+        for index in ttl_indexes:
+            current = existing.get(index["name"], {}).get("expireAfterSeconds")
+            if current is None or current == index["expireAfterSeconds"]:
+                continue
+            try:
+                database.command("collMod", collection_name,
+                                 index={"name": index["name"], "expireAfterSeconds": index["expireAfterSeconds"]})
+                logger.info(f"Changed TTL of {collection_name}.{index['name']} from {current}s "
+                            f"to {index['expireAfterSeconds']}s")
+            except OperationFailure as e:
+                logger.error(f"Failed to change TTL of {collection_name}.{index['name']}: {e}")
+                report["errors"][collection_name] = str(e)
+
+def ensure_indexes(database=None, force=False):
+    """
+    Apply INDEX_MANIFEST to the database. Meant to run once per deploy, not on import.
+
+    Creation is skipped when the recorded manifest version is already current,
+    unless force is set. Re-creating an existing index is a no-op, so the call
+    is idempotent either way. TTL indexes whose expireAfterSeconds comes from
+    a setting are checked on every call and changed in place with collMod,
+    since create_indexes refuses to change an existing index's options.
+
+    Returns:
+        dict: version applied, index names created per collection, per-collection
+        creation errors, and the collections that have none of their expected indexes.
+    """
+    database = database if database is not None else db
+    report = {"version": INDEX_MANIFEST_VERSION, "created": {}, "errors": {}, "missing": []}
+    
+    sync_ttl_indexes(database, report)
+    
+    applied = database["schema_migrations"].find_one({"_id": "indexes"}) or {}
+    if force or applied.get("version", 0) < INDEX_MANIFEST_VERSION:
+        for collection_name, indexes in INDEX_MANIFEST.items():
+            try:
+                report["created"][collection_name] = database[collection_name].create_indexes(indexes)
+            except OperationFailure as e:
+                # Usually existing duplicates blocking a unique index; keep going with the rest
+                logger.error(f"Failed to create indexes on {collection_name}: {e}")
+                report["errors"][collection_name] = str(e)
+        # This process looks at the indexes again on its next submission
+        _attendance_index_checked.clear()
+        
+        if not report["errors"]:
+            database["schema_migrations"].update_one(
+                {"_id": "indexes"},
+                {"$set": {"version": INDEX_MANIFEST_VERSION, "applied_at": datetime.now()}},
+                upsert=True
+            )
+            logger.info(f"Index manifest version {INDEX_MANIFEST_VERSION} applied")
+    else:
+        logger.info(f"Index manifest version {INDEX_MANIFEST_VERSION} already applied")
+    
+    # Report collections that have none of the indexes the manifest expects
+    for collection_name, indexes in INDEX_MANIFEST.items():
+        expected = {index.document["name"] for index in indexes}
+        existing = set(database[collection_name].index_information())
+        if not expected & existing:
+            report["missing"].append(collection_name)
+    
+    if report["missing"]:
+        logger.warning(f"Collections without any of their expected indexes: {', '.join(report['missing'])}")
+    
+    return report
 
 # Activity types with associated icons and colors
 ACTIVITY_TYPES = {
@@ -75,15 +1155,20 @@ ACTIVITY_TYPES = {
     "discussion": {"icon": "fas fa-comments", "color": "purple-500"}
 }
 
-# Function to verify database connection
-def verify_db_connection():
-    try:
-        # Try to ping the database
-        client.admin.command('ping')
-        return True
-    except Exception as e:
-        logger.error(f"Database connection error: {e}")
-        return False
+# Add query parameters to a URL, keeping the ones it already has; None values are left out
+def url_with_query(url, params):
+    parts = urllib.parse.urlsplit(url)
+    query = urllib.parse.parse_qsl(parts.query, keep_blank_values=True)
+    query += [(name, value) for name, value in params.items() if value is not None]
+    return urllib.parse.urlunsplit(parts._replace(query=urllib.parse.urlencode(query)))
+
+# Where Twilio reports a call's final status: TWILIO_STATUS_CALLBACK_URL, or /ivr/status beside the callback URL
+def status_callback_url_for(callback_url):
+    if app.config['TWILIO_STATUS_CALLBACK_URL']:
+        return app.config['TWILIO_STATUS_CALLBACK_URL']
+    parts = urllib.parse.urlsplit(callback_url)
+    prefix = parts.path.rsplit('/ivr/', 1)[0] if '/ivr/' in parts.path else ''
+    return urllib.parse.urlunsplit(parts._replace(path=f"{prefix}/ivr/status", query="", fragment=""))
 
 # Real Twilio IVR Call Client
 class TwilioClient:
@@ -103,9 +1188,10 @@ class TwilioClient:
         self.client = Client(self.account_sid, self.auth_token)
         logger.info("Initialized Twilio client")
         
-    def make_ivr_call(self, to_number, teacher_name, class_name, subject, callback_url=None):
+    def make_ivr_call(self, to_number, teacher_name, class_name, subject, callback_url=None, call_id=None):
         """
-        Make a real IVR call to a student using Twilio
+        Make a real IVR call to a student using Twilio.
+        call_id is passed back in the webhook URLs so they can find the call before its SID is stored.
         """
         try:
             logger.info(f"Making IVR call to {to_number} for feedback on {teacher_name}'s {subject} class")
@@ -115,14 +1201,20 @@ class TwilioClient:
                 callback_url = self.callback_url
                 
             # Append query parameters to callback URL to identify the context
-            full_callback_url = f"{callback_url}?teacher={teacher_name}&class={class_name}&subject={subject}"
+            full_callback_url = url_with_query(
+                callback_url, {"teacher": teacher_name, "class": class_name, "subject": subject, "call_id": call_id}
+            )
+            status_callback_url = url_with_query(status_callback_url_for(callback_url), {"call_id": call_id})
             
-            # Make the actual Twilio API call
+            # Make the actual Twilio API call; the status callback reports calls that end without a rating
             call = self.client.calls.create(
                 to=to_number,
                 from_=self.from_number,
                 url=full_callback_url,
-                method="POST"
+                method="POST",
+                status_callback=status_callback_url,
+                status_callback_event=["completed"],
+                status_callback_method="POST"
             )
             
             logger.info(f"Initiated call with SID: {call.sid}")
@@ -159,313 +1251,575 @@ class TwilioClient:
         logger.warning(f"get_ivr_response called directly for {call_sid} - this should be handled via webhooks")
         return None
 
+# Helper function to name the field that caused a unique index violation
+def duplicate_key_field(error):
+    key_pattern = (error.details or {}).get("keyPattern") or {}
+    if key_pattern:
+        return next(iter(key_pattern))
+    # Older servers only report the index name in the message
+    return "teacher_id" if "teacher_id" in str(error) else "email"
+
 # Helper function to generate random ID (for simulating Twilio call SIDs)
 def generate_random_id(length):
     """Generate a random ID of specified length"""
     return ''.join(random.choice(string.ascii_letters + string.digits) for _ in range(length))
 
 # IVR Feedback System Functions
-def schedule_weekly_feedback_calls():
+def twilio_is_configured():
+    """True when real Twilio credentials are present; otherwise calls are simulated"""
+    return all([
+        app.config.get('TWILIO_ACCOUNT_SID'),
+        app.config.get('TWILIO_AUTH_TOKEN'),
+        app.config.get('TWILIO_PHONE_NUMBER')
+    ])
+
+def create_twilio_client():
+    """Real Twilio client in production, simulated client in development"""
+    if twilio_is_configured():
+        return TwilioClient()
+    return SimulatedTwilioClient()
+
+class AccountCallLimiter:
     """
-    Schedule weekly feedback calls to students for all teachers.
-    In a production environment, this would be scheduled to run automatically
-    once per week using a task scheduler.
+    Concurrency and calls-per-second limits of one Twilio account, shared by
+    every campaign in every process.
+
+    The account's twilio_accounts document holds a lease per call being
+    placed and a token bucket refilled at CAMPAIGN_CALLS_PER_SECOND, with
+    bursts of one call. A call is let through by one atomic update that
+    drops expired leases, refills the bucket and, when a lease is free and a
+    token is left, takes both. Leases expire after CAMPAIGN_CALL_LEASE_SECONDS
+    so a crashed process cannot hold them. A rate of 0 or less disables the
+    calls-per-second limit.
+    """
+    
+    def __init__(self, account_sid, database=None):
+        self.account_sid = account_sid
+        self.database = database if database is not None else db
+        self.max_concurrency = max(1, app.config['CAMPAIGN_MAX_CONCURRENCY'])
+        self.rate = app.config['CAMPAIGN_CALLS_PER_SECOND']
+    
+    def _try_acquire(self, lease_id):
+        now = datetime.now()
+        if self.rate > 0:
+            elapsed_seconds = {"$divide": [{"$subtract": [now, {"$ifNull": ["$refilled_at", now]}]}, 1000]}
+            tokens = {"$min": [1, {"$add": [{"$ifNull": ["$tokens", 1]}, {"$multiply": [elapsed_seconds, self.rate]}]}]}
+        else:
+            tokens = 1
+        lease = {"id": lease_id,
+                 "expires_at": now + timedelta(seconds=app.config['CAMPAIGN_CALL_LEASE_SECONDS'])}
+        return self.database["twilio_accounts"].find_one_and_update(
+            {"_id": self.account_sid},
+            [
+                {"$set": {
+                    "leases": {"$filter": {"input": {"$ifNull": ["$leases", []]},
+                                           "cond": {"$gt": ["$$this.expires_at", now]}}},
+                    "tokens": tokens,
+                    "refilled_at": now
+                }},
+                {"$set": {"granted": {"$and": [{"$lt": [{"$size": "$leases"}, self.max_concurrency]},
+                                               {"$gte": ["$tokens", 1]}]}}},
+                {"$set": {
+                    "leases": {"$cond": ["$granted", {"$concatArrays": ["$leases", [lease]]}, "$leases"]},
+                    "tokens": {"$cond": ["$granted", {"$subtract": ["$tokens", 1]}, "$tokens"]}
+                }}
+            ],
+            projection={"granted": 1, "tokens": 1},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+    
+    @contextlib.contextmanager
+    def call_slot(self):
+        """Wait for a free lease and a token, and hold the lease while the call is placed"""
+        lease_id = str(uuid.uuid4())
+        while True:
+            state = self._try_acquire(lease_id)
+            if state["granted"]:
+                break
+            # Wait for the next token, or poll for a lease another call gives back
+            wait = (1 - state["tokens"]) / self.rate if self.rate > 0 and state["tokens"] < 1 else 0.05
+            time.sleep(min(max(wait, 0.01), 1))
+        try:
+            yield
+        finally:
+            self.database["twilio_accounts"].update_one(
+                {"_id": self.account_sid}, {"$pull": {"leases": {"id": lease_id}}}
+            )
+
+def student_phone_numbers(count, live):
     """
+    Phone numbers to dial for one teacher's feedback.
+    In production these would come from the student database; until then live
+    campaigns rotate through TEST_PHONE_NUMBERS and simulations use random numbers.
+    """
+    test_phone_numbers = []
+    if live and app.config.get('TEST_PHONE_NUMBERS'):
+        test_phone_numbers = [number.strip() for number in app.config['TEST_PHONE_NUMBERS'].split(',') if number.strip()]
+    
+    if test_phone_numbers:
+        return [test_phone_numbers[i % len(test_phone_numbers)] for i in range(count)]
+    return [f"+1555{random.randint(1000000, 9999999)}" for _ in range(count)]
+
+def start_feedback_campaign(teacher_emails=None, students_per_teacher=None, requested_by=None,
+                            database=None, background=True):
+    """
+    Queue an IVR feedback campaign and return without waiting for any call.
+
+    Creates the queued campaign, then one feedback_ratings document per
+    teacher and one campaign_calls document per student call, and dials them
+    on a background thread (see run_feedback_campaign). All progress lives
+    in Mongo, so an interrupted campaign can be picked up again by
+    resume_feedback_campaigns().
+
+    Args:
+        teacher_emails (list, optional): Teachers to collect feedback for. All teachers when None.
+        students_per_teacher (int, optional): Calls per teacher. A random 20-30 when None.
+        requested_by (str, optional): Email of the principal who asked for the campaign.
+        background (bool): Start dialing on a background thread. Set to False to dial later.
+
+    Returns:
+        dict: The campaign document, or None if no teacher could be scheduled
+    """
+    database = database if database is not None else db
+    
+    query = {"role": "teacher"}
+    if teacher_emails is not None:
+        query["email"] = {"$in": list(teacher_emails)}
+    teachers = list(database["users"].find(query, {"email": 1, "name": 1, "class": 1, "subject": 1}))
+    logger.info(f"Found {len(teachers)} teachers for feedback scheduling")
+    
+    live = twilio_is_configured()
+    campaign_id = str(uuid.uuid4())
+    now = datetime.now()
+    feedback_documents = []
+    call_documents = []
+    skipped_teachers = []
+    
+    for teacher in teachers:
+        teacher_email = teacher.get("email")
+        class_level = teacher.get("class")
+        subject = teacher.get("subject")
+        
+        if not teacher_email:
+            logger.warning(f"Teacher record missing email: {teacher.get('_id')}")
+            continue
+        
+        if not class_level or not subject:
+            logger.warning(f"Teacher {teacher_email} missing class or subject information. Skipping.")
+            skipped_teachers.append(teacher_email)
+            continue
+        
+        student_count = students_per_teacher if students_per_teacher is not None else random.randint(20, 30)
+        feedback_id = str(uuid.uuid4())
+        feedback_request = {
+            "_id": feedback_id,
+            "campaign_id": campaign_id,
+            "teacher_email": teacher_email,
+            "teacher_name": teacher.get("name", "Unknown Teacher"),
+            "class": class_level,
+            "subject": subject,
+            "status": "scheduled",
+            "created_at": now,
+            "ratings": {
+                "1": 0,
+                "2": 0,
+                "3": 0,
+                "4": 0,
+                "5": 0
+            },
+            "average_rating": 0,
+            "total_students": student_count,
+            "calls_initiated": 0,
+            "calls_completed": 0,
+            "calls_finished": 0,
+            "rating_sum": 0
+        }
+        if requested_by:
+            feedback_request["requested_by"] = requested_by
+        feedback_documents.append(feedback_request)
+        
+        for student_phone in student_phone_numbers(student_count, live):
+            call_documents.append({
+                "_id": str(uuid.uuid4()),
+                "campaign_id": campaign_id,
+                "feedback_id": feedback_id,
+                "to": student_phone,
+                "status": "pending",
+                "attempts": 0,
+                "created_at": now
+            })
+    
+    if teacher_emails is not None:
+        found = {teacher.get("email") for teacher in teachers}
+        skipped_teachers.extend(email for email in teacher_emails if email not in found)
+    
+    if not feedback_documents:
+        logger.warning("No teachers could be scheduled for feedback calls")
+        return None
+    
+    campaign = {
+        "_id": campaign_id,
+        "status": "queued",
+        "live": live,
+        "teacher_count": len(feedback_documents),
+        "skipped_teachers": skipped_teachers,
+        "total_calls": len(call_documents),
+        "calls_dispatched": 0,
+        "calls_failed": 0,
+        "requested_by": requested_by,
+        "created_at": now,
+        "heartbeat_at": now
+    }
+    
+    # The campaign goes first, so resume_feedback_campaigns can find any child written after it
+    database["feedback_campaigns"].insert_one(campaign)
+    database["feedback_ratings"].insert_many(feedback_documents)
+    database["campaign_calls"].insert_many(call_documents)
+    logger.info(f"Queued feedback campaign {campaign_id}: {len(feedback_documents)} teachers, {len(call_documents)} calls")
+    
+    if background:
+        threading.Thread(
+            target=run_feedback_campaign,
+            args=(campaign_id,),
+            kwargs={"database": database},
+            name=f"campaign-{campaign_id[:8]}",
+            daemon=True
+        ).start()
+    
+    return campaign
+
+def run_feedback_campaign(campaign_id, twilio_client=None, database=None):
+    """
+    Dial every outstanding call of a campaign across a thread pool.
+
+    Parallelism is bounded by the account's concurrency and calls-per-second
+    limits, which AccountCallLimiter enforces across processes. Each call is
+    claimed in Mongo before it is dialed. Calls a crashed runner left in
+    "dialing" are dialed again, so a student may rarely be called twice, but
+    no call is lost.
+
+    Returns:
+        dict: The finished campaign document, or None if the campaign was not runnable
+    """
+    database = database if database is not None else db
+    campaigns = database["feedback_campaigns"]
+    now = datetime.now()
+    
+    campaign = campaigns.find_one_and_update(
+        {"_id": campaign_id, "status": {"$in": ["queued", "running"]}},
+        {"$set": {"status": "running", "heartbeat_at": now}, "$min": {"started_at": now}},
+        return_document=ReturnDocument.AFTER
+    )
+    if not campaign:
+        logger.warning(f"Feedback campaign {campaign_id} is not queued or running")
+        return None
+    
     try:
-        logger.info("Starting weekly feedback call scheduling process...")
+        twilio = twilio_client or create_twilio_client()
+        limiter = AccountCallLimiter(twilio.account_sid, database)
         
-        # First verify database connection
-        if not verify_db_connection():
-            logger.error("Database connection failed - cannot schedule feedback calls")
-            return False
+        database["campaign_calls"].update_many(
+            {"campaign_id": campaign_id, "status": "dialing"},
+            {"$set": {"status": "pending"}}
+        )
+        pending_calls = [call["_id"] for call in database["campaign_calls"].find(
+            {"campaign_id": campaign_id, "status": "pending"}, {"_id": 1}
+        )]
+        feedback_by_id = {
+            feedback["_id"]: feedback
+            for feedback in database["feedback_ratings"].find(
+                {"campaign_id": campaign_id}, {"teacher_name": 1, "class": 1, "subject": 1}
+            )
+        }
+        logger.info(f"Running feedback campaign {campaign_id}: {len(pending_calls)} calls outstanding")
+        
+        with ThreadPoolExecutor(max_workers=app.config['CAMPAIGN_MAX_CONCURRENCY'],
+                                thread_name_prefix=f"campaign-{campaign_id[:8]}") as executor:
+            for call_id in pending_calls:
+                executor.submit(_dial_campaign_call, call_id, campaign, feedback_by_id,
+                                twilio, limiter, database)
+        
+        _finish_campaign_feedback(campaign, database)
+        
+        # Calls whose failure could not be recorded keep the campaign running; once its heartbeat
+        # goes stale, resume_feedback_campaigns dials them again
+        if database["campaign_calls"].find_one(
+                {"campaign_id": campaign_id, "status": {"$in": ["pending", "dialing"]}}, {"_id": 1}):
+            logger.warning(f"Feedback campaign {campaign_id} has unfinished calls; leaving it running for a resume")
+            return campaigns.find_one({"_id": campaign_id})
+        
+        return campaigns.find_one_and_update(
+            {"_id": campaign_id},
+            {"$set": {"status": "completed", "completed_at": datetime.now(), "heartbeat_at": datetime.now()}},
+            return_document=ReturnDocument.AFTER
+        )
+    except Exception as e:
+        logger.error(f"Error running feedback campaign {campaign_id}: {e}")
+        campaigns.update_one({"_id": campaign_id}, {"$set": {"status": "failed", "error": str(e)}})
+        return None
+
+def _dial_campaign_call(call_id, campaign, feedback_by_id, twilio, limiter, database):
+    """Claim, dial and record one campaign call. Runs on the campaign thread pool."""
+    try:
+        call = database["campaign_calls"].find_one_and_update(
+            {"_id": call_id, "status": "pending"},
+            {"$set": {"status": "dialing", "updated_at": datetime.now()}, "$inc": {"attempts": 1}},
+            return_document=ReturnDocument.AFTER
+        )
+        if not call:
+            return
+        
+        # The call record the webhooks look up exists before dialing, keyed by the campaign call,
+        # so a status callback that beats the SID update below still finds it. Until Twilio
+        # assigns a SID, a placeholder keeps the unique call_sid index satisfied.
+        database["call_records"].update_one(
+            {"_id": call_id},
+            {"$setOnInsert": {
+                "call_sid": f"pending:{call_id}",
+                "feedback_id": call["feedback_id"],
+                "campaign_id": campaign["_id"],
+                "to": call["to"],
+                "status": "queued",
+                "created_at": datetime.now()
+            }},
+            upsert=True
+        )
         
-        # Initialize our Twilio client
-        twilio = TwilioClient()
+        feedback = feedback_by_id.get(call["feedback_id"], {})
+        with limiter.call_slot():
+            result = twilio.make_ivr_call(
+                call["to"],
+                feedback.get("teacher_name", "Unknown Teacher"),
+                feedback.get("class", "Unknown Class"),
+                feedback.get("subject", "Unknown Subject"),
+                app.config.get('TWILIO_CALLBACK_URL', 'https://example.com/ivr/callback'),
+                call_id=call_id
+            )
         
-        # Find all teachers
-        teachers = list(users_collection.find({"role": "teacher"}))
-        logger.info(f"Found {len(teachers)} teachers for feedback scheduling")
+        if not result:
+            logger.warning(f"Failed to make call {call_id} to {call['to']}")
+            _fail_campaign_call(call_id, campaign, database)
+            return
         
-        if not teachers:
-            logger.warning("No teachers found in the database. Skipping feedback scheduling.")
-            return False
-            
-        # Track processed teachers
-        processed_count = 0
-        success_count = 0
-        
-        # Process each teacher
-        for teacher in teachers:
-            teacher_email = teacher.get("email")
-            class_level = teacher.get("class")
-            subject = teacher.get("subject")
-            
-            if not teacher_email:
-                logger.warning(f"Teacher record missing email: {teacher.get('_id')}")
-                continue
-                
-            if not class_level or not subject:
-                logger.warning(f"Teacher {teacher_email} missing class or subject information. Skipping.")
-                continue
-                
-            try:
-                logger.info(f"Scheduling feedback for teacher: {teacher_email}, Class: {class_level}, Subject: {subject}")
-                
-                # Create a new feedback request in the database
-                feedback_request = {
-                    "_id": str(uuid.uuid4()),
-                    "teacher_email": teacher_email,
-                    "teacher_name": f"{teacher.get('first_name', '')} {teacher.get('last_name', '')}",
-                    "class": class_level,
-                    "subject": subject,
-                    "status": "scheduled",
-                    "created_at": datetime.now(),
-                    "ratings": {
-                        "1": 0,
-                        "2": 0,
-                        "3": 0,
-                        "4": 0,
-                        "5": 0
-                    },
-                    "average_rating": 0
-                }
-                
-                # Insert the feedback request
-                result = feedback_ratings_collection.insert_one(feedback_request)
-                
-                if not result.inserted_id:
-                    logger.error(f"Failed to create feedback request for {teacher_email}")
-                    continue
-                
-                # Queue initial phone calls
-                feedback_id = result.inserted_id
-                logger.info(f"Created feedback request with ID: {feedback_id}")
-                
-                # In a real application, we would queue calls with Twilio here
-                # For testing purposes, simulate the feedback
-                sim_result = simulate_student_feedback(feedback_id)
-                
-                if sim_result:
-                    success_count += 1
-                    logger.info(f"Successfully scheduled and simulated feedback for {teacher_email}")
-                else:
-                    logger.error(f"Failed to simulate feedback for {teacher_email}")
-                
-                processed_count += 1
-            except Exception as e:
-                logger.error(f"Error processing teacher {teacher_email}: {e}")
-                
-        logger.info(f"Weekly feedback scheduling completed. Processed {processed_count} teachers, {success_count} successful")
-        return success_count > 0
+        database["call_records"].update_one({"_id": call_id}, {"$set": {"call_sid": result["sid"]}})
+        database["campaign_calls"].update_one(
+            {"_id": call_id},
+            {"$set": {"status": "dialed", "call_sid": result["sid"], "updated_at": datetime.now()}}
+        )
+        database["feedback_ratings"].update_one({"_id": call["feedback_id"]}, {"$inc": {"calls_initiated": 1}})
+        
+        if not campaign["live"]:
+            # Simulated calls are answered immediately; real ratings arrive through /ivr/process
+            call_status = twilio.get_call_status(result["sid"])
+            rating = twilio.get_ivr_response(result["sid"]) if call_status == "completed" else None
+            record_call_outcome(call["feedback_id"], rating, database, call_id=call_id)
+            database["call_records"].update_one(
+                {"_id": call_id},
+                {"$set": {"status": call_status, "rating": rating, "outcome_recorded": True}}
+            )
+            finalize_feedback_if_done(call["feedback_id"], database)
+            if metrics is not None:
+                metrics.ivr_calls.labels(call_status).inc()
         
+        database["feedback_campaigns"].update_one(
+            {"_id": campaign["_id"]},
+            {"$inc": {"calls_dispatched": 1}, "$set": {"heartbeat_at": datetime.now()}}
+        )
     except Exception as e:
-        logger.error(f"Error scheduling weekly feedback: {e}")
+        logger.error(f"Error dialing campaign call {call_id}: {e}")
+        try:
+            _fail_campaign_call(call_id, campaign, database)
+        except Exception as e:
+            # Left in "dialing"; the campaign stays running and a resume dials it again
+            logger.error(f"Error marking campaign call {call_id} failed: {e}")
+
+def _fail_campaign_call(call_id, campaign, database):
+    """
+    Count a claimed call that could not be completed as finished without a rating.
+    Only a call still in "dialing" is failed, so an outcome is never counted twice.
+    """
+    call = database["campaign_calls"].find_one_and_update(
+        {"_id": call_id, "status": "dialing"},
+        {"$set": {"status": "failed", "updated_at": datetime.now()}},
+        projection={"feedback_id": 1}
+    )
+    if not call:
+        return
+    if metrics is not None:
+        metrics.ivr_calls.labels("failed").inc()
+    record_call_outcome(call["feedback_id"], None, database, call_id=call_id)
+    finalize_feedback_if_done(call["feedback_id"], database)
+    database["feedback_campaigns"].update_one(
+        {"_id": campaign["_id"]},
+        {"$inc": {"calls_failed": 1}, "$set": {"heartbeat_at": datetime.now()}}
+    )
+
+def record_call_outcome(feedback_id, rating, database=None, call_id=None):
+    """
+    Count one finished call on its feedback request, with its rating if the student gave one.
+
+    With a call_id the call is remembered in counted_calls by the same update,
+    so counting the same call again is a no-op.
+
+    Returns:
+        bool: True if the call was counted
+    """
+    database = database if database is not None else db
+    increments = {"calls_finished": 1}
+    if rating in ["1", "2", "3", "4", "5"]:
+        increments.update({
+            f"ratings.{rating}": 1,
+            "calls_completed": 1,
+            "rating_sum": int(rating)
+        })
+    query = {"_id": feedback_id}
+    update = {"$inc": increments}
+    if call_id is not None:
+        query["counted_calls"] = {"$ne": call_id}
+        update["$push"] = {"counted_calls": call_id}
+    return database["feedback_ratings"].update_one(query, update).modified_count > 0
+
+def finalize_feedback_if_done(feedback_id, database=None):
+    """
+    Complete a feedback request once every one of its calls has finished.
+
+    The average is computed by the server inside a single conditional update,
+    so concurrent webhooks cannot both finalize or overwrite each other's counts.
+
+    Returns:
+        bool: True if this call finalized the feedback request
+    """
+    database = database if database is not None else db
+    feedback = database["feedback_ratings"].find_one_and_update(
+        {
+            "_id": feedback_id,
+            "status": {"$ne": "completed"},
+            "$expr": {"$gte": ["$calls_finished", "$total_students"]}
+        },
+        [{"$set": {
+            "status": "completed",
+            "completed_at": "$$NOW",
+            "average_rating": {"$cond": [
+                {"$gt": ["$calls_completed", 0]},
+                {"$round": [{"$divide": ["$rating_sum", "$calls_completed"]}, 1]},
+                0
+            ]}
+        }}],
+        projection={"teacher_email": 1, "average_rating": 1, "calls_completed": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    if not feedback:
         return False
+    
+    logger.info(f"Feedback {feedback_id} completed - Average rating: {feedback['average_rating']}")
+    if feedback.get("calls_completed", 0) > 0:
+        update_teacher_rating(feedback["teacher_email"], feedback["average_rating"], database, feedback_id)
+    return True
 
-def simulate_student_feedback(feedback_id, student_count=None):
+def record_ivr_outcome(call_sid, rating=None, call_status="completed", call_id=None):
     """
-    Collect student feedback via Twilio IVR calls.
-    In simulation mode, this will generate random feedback.
-    In production mode, this will initiate actual calls through Twilio.
+    Apply the outcome of one real IVR call, identified by the campaign call id
+    from the webhook URL or, for calls dialed without one, its Twilio CallSid.
+
+    The outcome is counted on the feedback request under the call's id before
+    the call record is flagged, and counting the same call twice is a no-op.
+    A crash between the two writes therefore never loses the count, and a
+    retried webhook neither counts it again nor changes the recorded outcome.
+
+    Returns:
+        bool: True if the outcome was applied, False for unknown or already-processed calls
+    """
+    call = calls_collection.find_one({"_id": call_id} if call_id else {"call_sid": call_sid},
+                                     {"feedback_id": 1, "outcome_recorded": 1})
+    if not call or call.get("outcome_recorded"):
+        logger.info(f"Ignoring outcome for unknown or already processed call {call_id or call_sid}")
+        return False
     
-    Args:
-        feedback_id (str): The ID of the feedback request
-        student_count (int, optional): The number of students to call. If None, a random number is chosen.
+    counted = record_call_outcome(call["feedback_id"], rating, call_id=call["_id"])
+    calls_collection.update_one(
+        {"_id": call["_id"], "outcome_recorded": {"$ne": True}},
+        {"$set": {
+            "outcome_recorded": True,
+            "rating": rating,
+            "status": call_status,
+            "updated_at": datetime.now()
+        }}
+    )
+    finalize_feedback_if_done(call["feedback_id"])
+    if counted and metrics is not None:
+        metrics.ivr_calls.labels(call_status).inc()
+    return counted
+
+def _finish_campaign_feedback(campaign, database):
+    """Mark live feedback requests as waiting for their IVR webhooks; simulated ones finalize per call"""
+    if campaign["live"]:
+        database["feedback_ratings"].update_many(
+            {"campaign_id": campaign["_id"], "status": "scheduled"},
+            {"$set": {"status": "in_progress", "started_at": datetime.now()}}
+        )
+
+def resume_feedback_campaigns(twilio_client=None, database=None):
+    """
+    Run campaigns whose runner stopped sending heartbeats, e.g. after a crash or redeploy.
+    Each campaign is claimed atomically, so several processes can call this safely.
+
+    Returns:
+        list: IDs of the campaigns that were resumed
+    """
+    database = database if database is not None else db
+    resumed = []
+    while True:
+        stale_before = datetime.now() - timedelta(seconds=app.config['CAMPAIGN_STALE_SECONDS'])
+        campaign = database["feedback_campaigns"].find_one_and_update(
+            {"status": {"$in": ["queued", "running"]}, "heartbeat_at": {"$lt": stale_before}},
+            {"$set": {"heartbeat_at": datetime.now()}}
+        )
+        if not campaign:
+            return resumed
+        logger.info(f"Resuming feedback campaign {campaign['_id']}")
+        run_feedback_campaign(campaign["_id"], twilio_client=twilio_client, database=database)
+        resumed.append(campaign["_id"])
+
+def schedule_weekly_feedback_calls():
+    """
+    Schedule weekly feedback calls to students for all teachers.
+    In a production environment, this would be scheduled to run automatically
+    once per week using a task scheduler.
+
+    Returns:
+        dict: The queued campaign document, or None if nothing was scheduled
     """
     try:
-        # Get the feedback request
-        feedback = feedback_ratings_collection.find_one({"_id": feedback_id})
-        if not feedback:
-            logger.error(f"Feedback request {feedback_id} not found")
-            return False
-        
-        # Determine if we're in production or simulation mode
-        is_simulation = not all([
-            app.config.get('TWILIO_ACCOUNT_SID'),
-            app.config.get('TWILIO_AUTH_TOKEN'),
-            app.config.get('TWILIO_PHONE_NUMBER')
-        ])
-        
-        # Initialize the appropriate client
-        if is_simulation:
-            # Use the simulated client for testing
-            twilio = SimulatedTwilioClient()
-            logger.info(f"Starting IVR call SIMULATION for {feedback.get('teacher_name', 'Unknown Teacher')}")
-        else:
-            # Use real Twilio client for production
-            twilio = TwilioClient()
-            logger.info(f"Starting REAL IVR calls for {feedback.get('teacher_name', 'Unknown Teacher')}")
-            
-        # In a real application, we would get a list of student phone numbers from a database
-        # For simulation or demo, we'll generate random phone numbers if no real data
-        if student_count is None:
-            student_count = random.randint(20, 30)
-        
-        logger.info(f"Initiating {student_count} calls for {feedback.get('teacher_email', 'unknown')}")
-        
-        # For each student, track ratings (1-5)
-        ratings = {
-            "1": 0,
-            "2": 0,
-            "3": 0,
-            "4": 0,
-            "5": 0
-        }
-        
-        # In production, we would retrieve actual student phone numbers
-        # For demo purposes, if you have a test phone number, you can use it
-        test_phone_numbers = []
-        if not is_simulation and 'TEST_PHONE_NUMBERS' in app.config:
-            try:
-                test_phone_numbers = app.config['TEST_PHONE_NUMBERS'].split(',')
-                logger.info(f"Using {len(test_phone_numbers)} test phone numbers from configuration")
-            except:
-                logger.warning("Failed to parse TEST_PHONE_NUMBERS config, falling back to simulation")
-        
-        call_records = []
-        completed_calls = 0
-        
-        # Begin the call process
-        for i in range(student_count):
-            try:
-                # In production with real phone numbers
-                if not is_simulation and test_phone_numbers:
-                    # Use test phone numbers in rotation
-                    student_phone = test_phone_numbers[i % len(test_phone_numbers)]
-                else:
-                    # Generate a random phone number for simulation
-                    student_phone = f"+1555{random.randint(1000000, 9999999)}"
-                
-                # In a real application, this would be your server's callback URL for the IVR script
-                callback_url = app.config.get('TWILIO_CALLBACK_URL', 'https://example.com/ivr/callback')
-                
-                # Make the call
-                teacher_name = feedback.get('teacher_name', 'Unknown Teacher')
-                class_name = feedback.get('class', 'Unknown Class')
-                subject = feedback.get('subject', 'Unknown Subject')
-                
-                call = twilio.make_ivr_call(
-                    student_phone, 
-                    teacher_name, 
-                    class_name, 
-                    subject,
-                    callback_url
-                )
-                
-                if not call:
-                    logger.warning(f"Failed to make call to student {i+1}")
-                    continue
-                
-                # Record the call for tracking
-                call_records.append(call)
-                
-                # For simulation, we immediately check call status and generate rating
-                # In production, ratings would come in asynchronously via the IVR callback
-                if is_simulation:
-                    call_status = twilio.get_call_status(call['sid'])
-                    logger.debug(f"Call to {student_phone} status: {call_status}")
-                    
-                    # If the call was "completed", get the simulated rating
-                    if call_status == "completed":
-                        rating = twilio.get_ivr_response(call['sid'])
-                        if rating in ratings:
-                            ratings[rating] += 1
-                            completed_calls += 1
-                            logger.debug(f"Student {i+1}: Rating = {rating}")
-                        else:
-                            logger.warning(f"Invalid rating received: {rating}")
-                else:
-                    # In production, we just record that the call was initiated
-                    # Actual ratings come in through the webhook
-                    logger.info(f"Initiated call to {student_phone} with SID {call['sid']}")
-                    
-                    # Store call SID to feedback ID mapping for later processing
-                    calls_collection.insert_one({
-                        "call_sid": call['sid'],
-                        "feedback_id": feedback_id,
-                        "to": student_phone,
-                        "status": call['status'],
-                        "created_at": datetime.now()
-                    })
-            except Exception as call_error:
-                logger.error(f"Error making call to student {i+1}: {call_error}")
+        logger.info("Starting weekly feedback call scheduling process...")
         
-        # For simulation, we calculate and update immediately
-        # In production, we'd just record that calls were initiated, but we'd need a background
-        # job to periodically check status and update once all calls are complete
+        # Skip the work when the health monitor already knows the database is down
+        if not health_monitor.database_available():
+            logger.error("Database is unavailable - cannot schedule feedback calls")
+            return None
         
-        if is_simulation:
-            logger.info(f"Completed {completed_calls} out of {student_count} attempted calls")
-            
-            # Calculate average rating
-            total_ratings = sum(int(k) * v for k, v in ratings.items())
-            average_rating = round(total_ratings / completed_calls, 1) if completed_calls > 0 else 0
-            
-            logger.info(f"Calculated average rating for {feedback.get('teacher_email', 'unknown')}: {average_rating}")
-            
-            # Update the feedback document
-            update_result = feedback_ratings_collection.update_one(
-                {"_id": feedback_id},
-                {
-                    "$set": {
-                        "status": "completed",
-                        "calls_completed": completed_calls,
-                        "total_students": student_count,
-                        "ratings": ratings,
-                        "average_rating": average_rating,
-                        "completed_at": datetime.now(),
-                        "call_records": [
-                            {
-                                "sid": call["sid"],
-                                "to": call["to"],
-                                "status": twilio.get_call_status(call["sid"]),
-                                "date": call["date_created"]
-                            } for call in call_records[:5]  # Store only first 5 call records to save space
-                        ]
-                    }
-                }
-            )
-            
-            if not update_result.modified_count:
-                logger.warning(f"Failed to update feedback document {feedback_id}")
-                return False
-                
-            logger.info(f"Simulated feedback for {feedback_id} - Average rating: {average_rating}")
-            
-            # Update teacher's overall rating in their record
-            teacher_update_result = update_teacher_rating(feedback["teacher_email"], average_rating)
-            
-            return teacher_update_result
-        else:
-            # In production, mark the feedback as in progress and return success
-            # A separate process would need to check and update the status later
-            update_result = feedback_ratings_collection.update_one(
-                {"_id": feedback_id},
-                {
-                    "$set": {
-                        "status": "in_progress",
-                        "total_students": student_count,
-                        "calls_initiated": len(call_records),
-                        "started_at": datetime.now()
-                    }
-                }
-            )
-            
-            if not update_result.modified_count:
-                logger.warning(f"Failed to update feedback document {feedback_id}")
-                return False
-                
-            logger.info(f"Initiated real feedback calls for {feedback_id} - {len(call_records)} calls started")
-            return True
-            
+        return start_feedback_campaign()
     except Exception as e:
-        logger.error(f"Error collecting feedback: {e}")
-        return False
+        logger.error(f"Error scheduling weekly feedback: {e}")
+        return None
 
-def update_teacher_rating(teacher_email, new_rating):
+# Weight of the newest rating in the exponentially weighted moving average
+RATING_EWMA_ALPHA = 0.3
+
+def rating_star(rating):
+    """Histogram bucket (1-5 stars) for a rating, which may be a fractional average"""
+    return str(min(5, max(1, int(round(rating)))))
+
+def update_teacher_rating(teacher_email, new_rating, database=None, feedback_id=None):
     """
-    Update the teacher's overall rating in their user record
+    Fold a new rating into the teacher's running rating statistics.
+
+    rating_stats holds the count, sum, min, max, EWMA and a per-star histogram,
+    so the user document stays the same size however many ratings arrive. All
+    of it is updated by one atomic pipeline update, so concurrent ratings are
+    never lost. Each rating is also appended to rating_history.
     """
+    database = database if database is not None else db
     try:
         if not teacher_email:
             logger.error("Teacher email is required to update rating")
@@ -473,51 +1827,135 @@ def update_teacher_rating(teacher_email, new_rating):
             
         logger.info(f"Updating rating for teacher: {teacher_email} with new rating: {new_rating}")
         
-        teacher = users_collection.find_one({"email": teacher_email})
-        if not teacher:
-            logger.error(f"Teacher not found with email: {teacher_email}")
-            return False
-            
-        # Get current ratings or initialize
-        current_ratings = teacher.get("ratings", [])
-        if not isinstance(current_ratings, list):
-            logger.warning(f"Ratings for {teacher_email} was not a list, resetting to empty list")
-            current_ratings = []
-            
-        # Add the new rating
-        current_ratings.append(new_rating)
-        
-        # Calculate new average (with bounds check)
-        if current_ratings:
-            overall_rating = round(sum(current_ratings) / len(current_ratings), 1)
-        else:
-            overall_rating = 0.0
-            
-        logger.info(f"New overall rating for {teacher_email}: {overall_rating} (based on {len(current_ratings)} ratings)")
-        
-        # Update teacher record
-        update_result = users_collection.update_one(
+        now = datetime.now()
+        count = {"$ifNull": ["$rating_stats.count", 0]}
+        star = rating_star(new_rating)
+        update_result = database["users"].update_one(
             {"email": teacher_email},
-            {
-                "$set": {
-                    "ratings": current_ratings,
-                    "overall_rating": overall_rating,
+            [
+                {"$set": {
+                    "rating_stats.count": {"$add": [count, 1]},
+                    "rating_stats.sum": {"$add": [{"$ifNull": ["$rating_stats.sum", 0]}, new_rating]},
+                    "rating_stats.min": {"$min": [{"$ifNull": ["$rating_stats.min", new_rating]}, new_rating]},
+                    "rating_stats.max": {"$max": [{"$ifNull": ["$rating_stats.max", new_rating]}, new_rating]},
+                    "rating_stats.ewma": {"$cond": [
+                        {"$gt": [count, 0]},
+                        {"$add": [
+                            RATING_EWMA_ALPHA * new_rating,
+                            {"$multiply": [1 - RATING_EWMA_ALPHA, "$rating_stats.ewma"]}
+                        ]},
+                        new_rating
+                    ]},
+                    f"rating_stats.histogram.{star}": {"$add": [{"$ifNull": [f"$rating_stats.histogram.{star}", 0]}, 1]},
                     "last_rating": new_rating,
-                    "last_rating_date": datetime.now()
-                }
-            }
+                    "last_rating_date": now
+                }},
+                {"$set": {
+                    "overall_rating": {"$round": [{"$divide": ["$rating_stats.sum", "$rating_stats.count"]}, 1]}
+                }}
+            ]
         )
         
-        if not update_result.modified_count:
-            logger.warning(f"Failed to update rating for {teacher_email}")
+        if not update_result.matched_count:
+            logger.error(f"Teacher not found with email: {teacher_email}")
             return False
+        
+        database["rating_history"].insert_one({
+            "teacher_email": teacher_email,
+            "rating": new_rating,
+            "feedback_id": feedback_id,
+            "created_at": now
+        })
             
-        logger.info(f"Successfully updated rating for {teacher_email}: {overall_rating}")
+        logger.info(f"Successfully updated rating for {teacher_email}")
         return True
     except Exception as e:
         logger.error(f"Error updating teacher rating for {teacher_email}: {e}")
         return False
 
+def get_rating_history(teacher_email, start=None, end=None, limit=100):
+    """Ratings for a teacher in time order, optionally limited to [start, end)"""
+    query = {"teacher_email": teacher_email}
+    if start or end:
+        query["created_at"] = {}
+        if start:
+            query["created_at"]["$gte"] = start
+        if end:
+            query["created_at"]["$lt"] = end
+    return list(rating_history_collection.find(query, {"_id": 0}).sort("created_at", ASCENDING).limit(limit))
+
+def migrate_rating_stats(database=None, batch_size=500):
+    """
+    Fold the legacy per-teacher `ratings` arrays into rating_stats and drop the arrays.
+    Also backfills rating_history from completed feedback requests. Safe to re-run.
+
+    Returns:
+        dict: number of teachers migrated and history entries added
+    """
+    database = database if database is not None else db
+    users = database["users"]
+    
+    migrated = 0
+    operations = []
+    for teacher in users.find({"ratings": {"$type": "array"}}, {"email": 1, "ratings": 1}):
+        ratings = [rating for rating in teacher["ratings"] if isinstance(rating, (int, float))]
+        update = [{"$unset": "ratings"}]
+        if ratings:
+            ewma = ratings[0]
+            for rating in ratings[1:]:
+                ewma = RATING_EWMA_ALPHA * rating + (1 - RATING_EWMA_ALPHA) * ewma
+            histogram = {}
+            for rating in ratings:
+                histogram[rating_star(rating)] = histogram.get(rating_star(rating), 0) + 1
+            # Merged into stats update_teacher_rating may already have started after the deploy.
+            # The legacy ratings are older, so an existing EWMA is kept.
+            merged = {
+                "rating_stats.count": {"$add": [{"$ifNull": ["$rating_stats.count", 0]}, len(ratings)]},
+                "rating_stats.sum": {"$add": [{"$ifNull": ["$rating_stats.sum", 0]}, sum(ratings)]},
+                "rating_stats.min": {"$min": [{"$ifNull": ["$rating_stats.min", min(ratings)]}, min(ratings)]},
+                "rating_stats.max": {"$max": [{"$ifNull": ["$rating_stats.max", max(ratings)]}, max(ratings)]},
+                "rating_stats.ewma": {"$ifNull": ["$rating_stats.ewma", ewma]}
+            }
+            for star, star_count in histogram.items():
+                merged[f"rating_stats.histogram.{star}"] = {
+                    "$add": [{"$ifNull": [f"$rating_stats.histogram.{star}", 0]}, star_count]
+                }
+            update = [
+                {"$set": merged},
+                {"$set": {
+                    "overall_rating": {"$round": [{"$divide": ["$rating_stats.sum", "$rating_stats.count"]}, 1]}
+                }},
+                {"$unset": "ratings"}
+            ]
+        # Matching the array too means a re-run can never fold the same ratings twice
+        operations.append(UpdateOne({"_id": teacher["_id"], "ratings": {"$type": "array"}}, update))
+        if len(operations) >= batch_size:
+            migrated += users.bulk_write(operations, ordered=False).modified_count
+            operations = []
+    if operations:
+        migrated += users.bulk_write(operations, ordered=False).modified_count
+    
+    # Backfill the history from feedback requests that don't have an entry yet
+    recorded = set(database["rating_history"].distinct("feedback_id"))
+    history = [
+        {
+            "teacher_email": feedback["teacher_email"],
+            "rating": feedback["average_rating"],
+            "feedback_id": feedback["_id"],
+            "created_at": feedback["completed_at"]
+        }
+        for feedback in database["feedback_ratings"].find(
+            {"status": "completed", "calls_completed": {"$gt": 0}, "completed_at": {"$ne": None}},
+            {"teacher_email": 1, "average_rating": 1, "completed_at": 1}
+        )
+        if feedback["_id"] not in recorded
+    ]
+    if history:
+        database["rating_history"].insert_many(history)
+    
+    logger.info(f"Migrated rating statistics for {migrated} teachers, added {len(history)} history entries")
+    return {"teachers": migrated, "history": len(history)}
+
 def get_teacher_ratings(teacher_email=None):
     """
     Get ratings for all teachers or a specific teacher
@@ -654,23 +2092,23 @@ def signup():
     subject = request.form['subject']
     class_level = request.form['class']
 
-    if users_collection.find_one({"email": email}):
+    # Uniqueness of email and teacher ID is enforced by the users indexes
+    try:
+        users_collection.insert_one({
+            "name": name, 
+            "email": email, 
+            "password": password,
+            "school": school,
+            "teacher_id": teacher_id,
+            "subject": subject,
+            "class": class_level,
+            "role": "teacher",
+            "created_at": datetime.now()
+        })
+    except DuplicateKeyError as e:
+        if duplicate_key_field(e) == "teacher_id":
+            return jsonify({"status": "fail", "message": "Teacher ID already registered."})
         return jsonify({"status": "fail", "message": "Email already registered."})
-
-    if users_collection.find_one({"teacher_id": teacher_id}):
-        return jsonify({"status": "fail", "message": "Teacher ID already registered."})
-
-    users_collection.insert_one({
-        "name": name, 
-        "email": email, 
-        "password": password,
-        "school": school,
-        "teacher_id": teacher_id,
-        "subject": subject,
-        "class": class_level,
-        "role": "teacher",
-        "created_at": datetime.now()
-    })
     
     return jsonify({"status": "success", "message": "Signup successful!"})
 
@@ -724,6 +2162,7 @@ def login():
 
 @app.route("/teacher_dashboard")
 @app.route("/teacher_dashboard/<class_level>")
+@query_budget('DASHBOARD_QUERY_BUDGET')
 def teacher_dashboard(class_level=None):
     if "email" not in session:
         return redirect(url_for("login"))
@@ -739,21 +2178,21 @@ def teacher_dashboard(class_level=None):
         
         logger.info(f"Loading dashboard for {session['email']}, class: {current_class}, subject: {subject}")
         
+        # Progress and recent activities are fetched once and shared below
+        context = load_dashboard_context(session["email"], current_class, subject, session.get("name"))
+        
         # Get or initialize teacher's progress
-        progress = get_or_initialize_progress(session["email"], current_class, subject)
+        progress = get_or_initialize_progress(session["email"], current_class, subject, context)
         
         # Get curriculum for this class and subject
-        curriculum = curriculum_collection.find_one({
-            "class": current_class,
-            "subject": subject
-        })
+        curriculum = get_curriculum(current_class, subject)
         
         # Get today's random activity
-        daily_activity = get_daily_activity(session["email"], current_class, subject)
+        daily_activity = get_daily_activity(session["email"], current_class, subject, context)
         logger.info(f"Daily activity data: {daily_activity}")
         
         # Generate weekly schedule
-        weekly_schedule = generate_weekly_schedule(session["email"], current_class, subject)
+        weekly_schedule = generate_weekly_schedule(session["email"], current_class, subject, context)
         logger.info(f"Weekly schedule generated with {len(weekly_schedule)} days")
         
         # Calculate attendance percentage for current month
@@ -771,52 +2210,1155 @@ def teacher_dashboard(class_level=None):
             attendance=attendance_data
         )
     except Exception as e:
-        logger.error(f"Error loading dashboard: {e}")
-        flash(f"An error occurred while loading your dashboard. Please try again later.", "error")
-        # Return a basic dashboard with error information
-        return render_template(
-            "teacher_dashboard.html",
-            progress=None,
-            curriculum=None,
-            daily_activity=None,
-            weekly_schedule=None,
-            current_class=class_level or session.get("class", "class9"),
-            activity_types=ACTIVITY_TYPES,
-            error_message="We encountered an error loading your dashboard. Please try again later."
+        logger.error(f"Error loading dashboard: {e}")
+        flash(f"An error occurred while loading your dashboard. Please try again later.", "error")
+        # Return a basic dashboard with error information
+        return render_template(
+            "teacher_dashboard.html",
+            progress=None,
+            curriculum=None,
+            daily_activity=None,
+            weekly_schedule=None,
+            current_class=class_level or session.get("class", "class9"),
+            activity_types=ACTIVITY_TYPES,
+            error_message="We encountered an error loading your dashboard. Please try again later."
+        )
+
+@app.route("/social_science")
+def social_science():
+    if "email" not in session:
+        return redirect(url_for("login"))
+    return render_template("social_science.html")
+
+@app.route("/science")
+def science():
+    if "email" not in session:
+        return redirect(url_for("login"))
+    return render_template("science.html")
+
+@app.route("/english")
+def english():
+    if "email" not in session:
+        return redirect(url_for("login"))
+    return render_template("english.html")
+
+# The daily_attendance record marking a teacher present on a day
+def daily_attendance_document(teacher, class_level, current_date):
+    return {
+        "teacher_id": teacher.get("teacher_id", ""),
+        "teacher_email": teacher["email"],
+        "teacher_name": teacher.get("name", "Unknown"),
+        "school": teacher.get("school", "Unknown"),
+        "subject": teacher.get("subject", ""),
+        "class": class_level,
+        "date": current_date,
+        "date_str": current_date.strftime("%Y-%m-%d"),
+        "time_in": current_date.strftime("%H:%M:%S"),
+        "status": "present",
+        "attendance_method": "activity_completion",
+        "created_at": current_date
+    }
+
+# Record a teacher as present today and update the attendance rollups on the first submission
+def record_daily_attendance(teacher, class_level, current_date):
+    """
+    Upsert today's daily_attendance record for a teacher.
+
+    The per-teacher (teacher_monthly_stats) and per-school-per-day
+    (school_daily_attendance) counters are only incremented when this call
+    created the record, so repeat submissions on the same day are not counted.
+
+    Returns:
+        bool: True if this was the teacher's first submission today
+    """
+    today_str = current_date.strftime("%Y-%m-%d")
+    daily_attendance = daily_attendance_document(teacher, class_level, current_date)
+    
+    try:
+        attendance_result = daily_attendance_collection.update_one(
+            {
+                "teacher_email": teacher["email"],
+                "date_str": today_str
+            },
+            {"$setOnInsert": daily_attendance},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        # A concurrent submission inserted today's record first
+        return False
+    
+    if not attendance_result.acknowledged:
+        raise Exception("Failed to record attendance")
+    
+    if attendance_result.upserted_id is None:
+        return False
+    
+    apply_attendance_rollups(teacher, current_date)
+    return True
+
+def apply_attendance_rollups(teacher, current_date):
+    """Count one present day for the teacher's month and the school's day"""
+    school = teacher.get("school", "Unknown")
+    
+    teacher_monthly_stats.update_one(
+        {
+            "teacher_email": teacher["email"],
+            "year": current_date.year,
+            "month": current_date.month
+        },
+        {
+            "$inc": {"days_present": 1},
+            "$set": {"last_updated": current_date},
+            "$setOnInsert": {
+                "teacher_name": teacher.get("name", "Unknown"),
+                "teacher_id": teacher.get("teacher_id", ""),
+                "school": school,
+                "subject": teacher.get("subject", ""),
+                "class": teacher.get("class", ""),
+                "created_at": current_date
+            }
+        },
+        upsert=True
+    )
+    
+    school_daily_attendance.update_one(
+        {
+            "school": school,
+            "date_str": current_date.strftime("%Y-%m-%d")
+        },
+        {
+            "$inc": {"present_count": 1},
+            "$set": {"last_updated": current_date},
+            "$setOnInsert": {
+                "year": current_date.year,
+                "month": current_date.month
+            }
+        },
+        upsert=True
+    )
+
+def rebuild_attendance_rollups(database=None, year=None, month=None):
+    """
+    Recompute the attendance rollups from the raw daily_attendance records.
+
+    Used to backfill after deploying the rollups and to repair drift. Restrict
+    to one month by passing year and month; otherwise every month is rebuilt.
+
+    Rebuilt values are written in place and stamped; afterwards only rollups
+    without the stamp are zeroed or deleted, and not those a submission
+    updated since shortly before the rebuild began, so dashboards never read
+    a blanket reset and concurrent submissions are kept.
+
+    Returns:
+        dict: number of teacher-month and school-day rollups written
+    """
+    database = database if database is not None else db
+    rebuilt_at = datetime.now()
+    
+    match = {"status": "present"}
+    if year and month:
+        last_day = calendar.monthrange(year, month)[1]
+        match["date_str"] = {
+            "$gte": f"{year:04d}-{month:02d}-01",
+            "$lte": f"{year:04d}-{month:02d}-{last_day:02d}"
+        }
+    
+    # Distinct present days per teacher and month
+    teacher_rollups = database["daily_attendance"].aggregate([
+        {"$match": match},
+        {"$group": {"_id": {"email": "$teacher_email", "day": "$date_str"}, "school": {"$first": "$school"}}},
+        {"$group": {
+            "_id": {"email": "$_id.email", "month": {"$substr": ["$_id.day", 0, 7]}},
+            "school": {"$first": "$school"},
+            "days_present": {"$sum": 1}
+        }}
+    ])
+    teacher_ops = []
+    for row in teacher_rollups:
+        row_year, row_month = (int(part) for part in row["_id"]["month"].split("-"))
+        teacher_ops.append(UpdateOne(
+            {"teacher_email": row["_id"]["email"], "year": row_year, "month": row_month},
+            {
+                "$set": {"days_present": row["days_present"], "last_updated": datetime.now(), "rebuilt_at": rebuilt_at},
+                "$setOnInsert": {"school": row.get("school"), "created_at": datetime.now()}
+            },
+            upsert=True
+        ))
+    
+    # Present teachers per school and day
+    school_rollups = database["daily_attendance"].aggregate([
+        {"$match": match},
+        {"$group": {"_id": {"email": "$teacher_email", "day": "$date_str"}, "school": {"$first": "$school"}}},
+        {"$group": {"_id": {"school": "$school", "day": "$_id.day"}, "present_count": {"$sum": 1}}}
+    ])
+    school_ops = []
+    for row in school_rollups:
+        day = datetime.strptime(row["_id"]["day"], "%Y-%m-%d")
+        school_ops.append(UpdateOne(
+            {"school": row["_id"]["school"], "date_str": row["_id"]["day"]},
+            {"$set": {"present_count": row["present_count"], "year": day.year, "month": day.month,
+                      "rebuilt_at": rebuilt_at}},
+            upsert=True
+        ))
+    
+    if teacher_ops:
+        database["teacher_monthly_stats"].bulk_write(teacher_ops, ordered=False)
+    if school_ops:
+        database["school_daily_attendance"].bulk_write(school_ops, ordered=False)
+    
+    # Rollups missing from the rebuilt set have no present day left; a submission's rollup
+    # is kept even when its record was written after the aggregation read the records
+    stale_filter = {
+        "rebuilt_at": {"$ne": rebuilt_at},
+        "last_updated": {"$not": {"$gte": rebuilt_at - timedelta(minutes=1)}}
+    }
+    if year and month:
+        stale_filter.update({"year": year, "month": month})
+    database["teacher_monthly_stats"].update_many(stale_filter, {"$set": {"days_present": 0}})
+    database["school_daily_attendance"].delete_many(stale_filter)
+    
+    logger.info(f"Rebuilt {len(teacher_ops)} teacher-month and {len(school_ops)} school-day attendance rollups")
+    return {"teacher_months": len(teacher_ops), "school_days": len(school_ops)}
+
+# Idempotency key of the current request, from the Idempotency-Key header or the idempotency_key form field
+def request_idempotency_key():
+    key = request.headers.get("Idempotency-Key") or request.form.get("idempotency_key")
+    return key.strip()[:128] if key and key.strip() else None
+
+# Run a handler once per idempotency key and replay its stored response afterwards
+def run_idempotent(scope, key, handler, database=None):
+    """
+    Run handler for the first request carrying (scope, key) and store its
+    response; later requests with the same key get that response back
+    without running the handler again.
+
+    Successful responses are stored. A failed or crashed attempt that
+    wrote nothing releases the key so the client can retry with it; one
+    that may have written is stored as failed_after_write and replayed like
+    a success, so a retry cannot write the records a second time. A request
+    that arrives while the first one is still running gets a 409; an
+    attempt unfinished after IDEMPOTENCY_STALE_SECONDS is taken over.
+    Entries expire through the TTL index on created_at.
+    """
+    database = database if database is not None else db
+    idempotency_keys = database["idempotency_keys"]
+    key_id = f"{scope}:{key}"
+    now = datetime.now()
+    
+    try:
+        idempotency_keys.insert_one({"_id": key_id, "status": "in_progress", "created_at": now})
+    except DuplicateKeyError:
+        stored = idempotency_keys.find_one({"_id": key_id})
+        if stored and stored.get("status") in ("completed", "failed_after_write"):
+            logger.info(f"Replaying stored response for idempotency key {key_id}")
+            response = app.response_class(stored["body"], status=stored["status_code"], mimetype=stored["mimetype"])
+            response.headers["Idempotent-Replayed"] = "true"
+            return response
+        
+        # Take over an attempt whose request died before finishing
+        abandoned = idempotency_keys.find_one_and_update(
+            {
+                "_id": key_id,
+                "status": "in_progress",
+                "created_at": {"$lt": now - timedelta(seconds=app.config['IDEMPOTENCY_STALE_SECONDS'])}
+            },
+            {"$set": {"created_at": now}}
+        )
+        if not abandoned:
+            response = jsonify({"status": "fail", "message": "This submission is still being processed. Please wait a moment."})
+            response.status_code = 409
+            return response
+    
+    def store(status, stored_response):
+        idempotency_keys.update_one(
+            {"_id": key_id},
+            {"$set": {
+                "status": status,
+                "body": stored_response.get_data(as_text=True),
+                "status_code": stored_response.status_code,
+                "mimetype": stored_response.mimetype,
+                "completed_at": datetime.now()
+            }}
+        )
+    
+    # Writes of the handler are told apart from the key's own by the commands issued after this point
+    mark = request_query_counter.mark()
+    try:
+        response = make_response(handler())
+    except Exception:
+        if RequestQueryCounter.wrote(request_query_counter.since(mark)):
+            failure = jsonify({"status": "fail", "message": "This submission failed after it was partly saved."})
+            failure.status_code = 500
+            store("failed_after_write", failure)
+        else:
+            idempotency_keys.delete_one({"_id": key_id})
+        raise
+    
+    payload = response.get_json(silent=True)
+    if payload and payload.get("status") == "success":
+        store("completed", response)
+    elif RequestQueryCounter.wrote(request_query_counter.since(mark)):
+        store("failed_after_write", response)
+    else:
+        # Attempts that wrote nothing may be retried with the same key
+        idempotency_keys.delete_one({"_id": key_id})
+    return response
+
+# Make a logged-in view replay its stored response when a client retries with the same idempotency key
+def idempotent(view):
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request_idempotency_key()
+        if not key or "email" not in session:
+            return view(*args, **kwargs)
+        return run_idempotent(f"{session['email']}:{request.endpoint}", key, lambda: view(*args, **kwargs))
+    return wrapper
+
+# Teacher profile kept in the login session, sparing a users lookup; None for other sessions
+def session_teacher_profile():
+    if session.get("role") != "teacher" or "teacher_id" not in session:
+        return None
+    profile = {"email": session["email"]}
+    # Empty values are left out so callers fall back to their usual defaults
+    for key in ("name", "teacher_id", "school", "subject", "class"):
+        if session.get(key):
+            profile[key] = session[key]
+    return profile
+
+# Whether the deployment supports multi-document transactions (replica set or sharded cluster)
+def supports_transactions(mongo_client):
+    topology = getattr(mongo_client, "topology_description", None)
+    return topology is not None and topology.topology_type_name in ("ReplicaSetWithPrimary", "Sharded")
+
+# Whether every writable server accepts one bulk write spanning several collections (MongoDB 8.0+)
+def supports_client_bulk_write(mongo_client):
+    topology = getattr(mongo_client, "topology_description", None)
+    if topology is None:
+        return False
+    servers = [server for server in topology.server_descriptions().values() if server.is_writable]
+    return bool(servers) and all(server.max_wire_version >= 25 for server in servers)
+
+# Whether each database has the daily_attendance unique index that lets an insert stand in for the
+# upsert, with the time it was checked; re-checked so workers notice the index being built or dropped
+_attendance_index_checked = {}
+
+def has_daily_attendance_unique_index(database):
+    checked = _attendance_index_checked.get(database.name)
+    if checked is None or time.monotonic() - checked[1] > app.config['ATTENDANCE_INDEX_CHECK_SECONDS']:
+        checked = ("teacher_date_unique" in database["daily_attendance"].index_information(), time.monotonic())
+        _attendance_index_checked[database.name] = checked
+    return checked[0]
+
+# Writes that follow the daily_attendance record of a submission, as (collection, operation, arguments)
+def attendance_submission_writes(teacher, subject, activity_type, file_paths, current_date, first_today,
+                                 activity_fields=None):
+    """
+    The activity record comes first and the derived counters last; the
+    counters can always be recomputed (rebuild-attendance-rollups), the
+    records cannot. days_present and the school's present_count are only
+    incremented for the first submission of the day.
+    """
+    today_str = current_date.strftime("%Y-%m-%d")
+    school = teacher.get("school", "Unknown")
+    
+    # Record activity completion with photos
+    activity_record = {
+        "teacher_id": teacher.get("teacher_id", ""),
+        "teacher_email": teacher["email"],
+        "teacher_name": teacher.get("name", "Unknown"),
+        "school": school,
+        "subject": subject,
+        "class": teacher.get("class", ""),
+        "activity_type": activity_type,
+        "completion_date": current_date,
+        "date_str": today_str,
+        "completion_time": current_date.strftime("%H:%M:%S"),
+        "photo_paths": file_paths,
+        "photo_count": len(file_paths),
+        "status": "completed",
+        "verified": True,
+        "created_at": current_date
+    }
+    activity_record.update(activity_fields or {})
+    
+    # Monthly activity statistics, with the attendance rollup folded into the same update
+    monthly_increments = {"activities_completed": 1, "photos_submitted": activity_record["photo_count"]}
+    if first_today:
+        monthly_increments["days_present"] = 1
+    
+    writes = [
+        ("activities", InsertOne, {"document": activity_record}),
+        ("teacher_monthly_stats", UpdateOne, {
+            "filter": {"teacher_email": teacher["email"], "year": current_date.year, "month": current_date.month},
+            "update": {
+                "$inc": monthly_increments,
+                "$set": {"last_activity_date": current_date, "last_updated": current_date},
+                "$setOnInsert": {
+                    "teacher_name": teacher.get("name", "Unknown"),
+                    "teacher_id": teacher.get("teacher_id", ""),
+                    "school": school,
+                    "subject": teacher.get("subject", ""),
+                    "class": teacher.get("class", ""),
+                    "created_at": current_date
+                }
+            },
+            "upsert": True
+        }),
+        # Subject-wise activity tracking
+        ("subject_activity_stats", UpdateOne, {
+            "filter": {
+                "teacher_email": teacher["email"],
+                "subject": subject,
+                "class": teacher.get("class", ""),
+                "year": current_date.year,
+                "month": current_date.month
+            },
+            "update": {
+                "$inc": {"total_activities": 1, f"activity_counts.{activity_type}": 1},
+                "$set": {"last_activity_date": current_date, "last_activity_type": activity_type},
+                "$setOnInsert": {
+                    "teacher_name": teacher.get("name", "Unknown"),
+                    "teacher_id": teacher.get("teacher_id", ""),
+                    "school": school,
+                    "class": teacher.get("class", ""),
+                    "created_at": current_date
+                }
+            },
+            "upsert": True
+        })
+    ]
+    if first_today:
+        writes.append(("school_daily_attendance", UpdateOne, {
+            "filter": {"school": school, "date_str": today_str},
+            "update": {
+                "$inc": {"present_count": 1},
+                "$set": {"last_updated": current_date},
+                "$setOnInsert": {"year": current_date.year, "month": current_date.month}
+            },
+            "upsert": True
+        }))
+    return writes
+
+# Store one /mark_attendance submission with as few round trips as the deployment allows
+def record_attendance_submission(teacher, subject, activity_type, file_paths, current_date, database=None,
+                                 activity_fields=None):
+    """
+    Store the daily_attendance record, the activity record and the counters
+    of one submission.
+
+    On a replica set everything runs in one transaction, so a failure leaves
+    nothing half-written. Otherwise, on MongoDB 8.0+ with the unique
+    (teacher_email, date_str) index in place, the writes go out as one
+    ordered client bulk write led by the daily_attendance insert: a repeat
+    submission stops at that insert before anything is counted and is then
+    written again without the attendance counters. Elsewhere the writes are
+    sent one at a time in the same order.
+
+    activity_fields are merged into the activity record, e.g. the photos
+    still being processed. Give the activity an _id derived from the
+    request's idempotency key to make a retry safe: when the activity is
+    already stored, the retry only refreshes its pending photos and counts
+    nothing again. Counters an earlier attempt failed to write are left to
+    rebuild-attendance-rollups.
+
+    Returns:
+        bool: True if this was the teacher's first submission today
+    """
+    database = database if database is not None else db
+    mongo_client = database.client
+    activity_fields = {"_id": ObjectId(), **(activity_fields or {})}
+    submission = (teacher, subject, activity_type, file_paths, current_date)
+    daily_record = daily_attendance_document(teacher, teacher.get("class", ""), current_date)
+    
+    def refresh_pending_photos(session=None):
+        # The photos staged by an earlier attempt were discarded with its request
+        if "photos_pending" in activity_fields:
+            database["activities"].update_one(
+                {"_id": activity_fields["_id"], "photo_status": {"$ne": "ready"}},
+                {
+                    "$set": {"photos_pending": activity_fields["photos_pending"], "photo_status": "processing"},
+                    "$unset": {"photo_error": ""}
+                },
+                session=session
+            )
+        logger.info(f"Activity {activity_fields['_id']} was stored by an earlier attempt; not counting it again")
+    
+    def write_in_order(session=None):
+        try:
+            result = database["daily_attendance"].update_one(
+                {"teacher_email": teacher["email"], "date_str": daily_record["date_str"]},
+                {"$setOnInsert": daily_record},
+                upsert=True,
+                session=session
+            )
+            first_today = result.upserted_id is not None
+        except DuplicateKeyError:
+            # Inside a transaction the error has aborted it; with_transaction retries the
+            # conflict, which concurrent upserts report as a transient WriteConflict
+            if session is not None:
+                raise
+            # A concurrent submission inserted today's record first
+            first_today = False
+        
+        activity_write, *counter_writes = attendance_submission_writes(*submission, first_today, activity_fields)
+        result = database["activities"].update_one(
+            {"_id": activity_fields["_id"]},
+            {"$setOnInsert": activity_write[2]["document"]},
+            upsert=True,
+            session=session
+        )
+        if result.upserted_id is None:
+            refresh_pending_photos(session)
+            return first_today
+        for collection_name, operation, arguments in counter_writes:
+            database[collection_name].bulk_write([operation(**arguments)], session=session)
+        return first_today
+    
+    def client_bulk_write(writes):
+        mongo_client.bulk_write(
+            [operation(**arguments, namespace=f"{database.name}.{collection_name}")
+             for collection_name, operation, arguments in writes],
+            ordered=True
+        )
+    
+    def duplicate_position(error):
+        # An ordered bulk write stops at its first error
+        duplicates = [write_error.get("idx") for write_error in error.write_errors if write_error.get("code") == 11000]
+        return duplicates[0] if duplicates and len(error.write_errors) == 1 else None
+    
+    if supports_transactions(mongo_client):
+        with mongo_client.start_session() as session:
+            return session.with_transaction(write_in_order)
+    
+    if supports_client_bulk_write(mongo_client) and has_daily_attendance_unique_index(database):
+        try:
+            client_bulk_write(
+                [("daily_attendance", InsertOne, {"document": daily_record})]
+                + attendance_submission_writes(*submission, True, activity_fields)
+            )
+            return True
+        except ClientBulkWriteException as e:
+            # Anything but a duplicate daily record at position 0 is a real failure
+            if duplicate_position(e) != 0:
+                raise
+        try:
+            client_bulk_write(attendance_submission_writes(*submission, False, activity_fields))
+        except ClientBulkWriteException as e:
+            # A duplicate activity at position 0 is a retry of a stored submission
+            if duplicate_position(e) != 0:
+                raise
+            refresh_pending_photos()
+        return False
+    
+    return write_in_order()
+
+# Background pool that strips, scales and places uploaded photos after the request has returned
+photo_executor = ThreadPoolExecutor(max_workers=app.config['PHOTO_WORKERS'], thread_name_prefix="photo")
+
+# Describe an uploaded photo's staged file for processing
+def staged_upload(file_storage):
+    upload = file_storage.stream
+    if not isinstance(upload, HashingUploadFile):
+        # Parts werkzeug kept in memory are staged the same way
+        upload = HashingUploadFile(upload_staging_folder(), app.config['PHOTO_MAX_BYTES'])
+        shutil.copyfileobj(file_storage.stream, upload)
+        request.__dict__.setdefault("upload_files", []).append(upload)
+        file_storage.stream = upload
+    upload.flush()
+    return {
+        "staged_path": upload.name,
+        "sha256": upload.sha256.hexdigest(),
+        "size": upload.size,
+        "filename": file_storage.filename
+    }
+
+# Strip EXIF, scale down and move one staged photo to its final path; returns the image format, if any
+def finalize_photo(staged_path, final_path):
+    if Image is not None:
+        try:
+            with Image.open(staged_path) as original:
+                image_format = original.format
+                image = ImageOps.exif_transpose(original)
+                image.thumbnail((app.config['PHOTO_MAX_DIMENSION'], app.config['PHOTO_MAX_DIMENSION']))
+                # Saving without exif= drops the EXIF block, GPS position included
+                options = {"quality": 85} if image_format == "JPEG" else {}
+                image.save(final_path, format=image_format, **options)
+            os.remove(staged_path)
+            return image_format
+        except Exception as e:
+            # Not an image Pillow can rewrite; keep the upload as it is
+            logger.warning(f"Storing {staged_path} unprocessed: {e}")
+            if os.path.exists(final_path):
+                os.remove(final_path)
+    os.replace(staged_path, final_path)
+    return None
+
+# Whether a photo_paths entry is a blob digest rather than a legacy file path
+def is_photo_digest(value):
+    return len(value) == 64 and all(char in "0123456789abcdef" for char in value)
+
+# Photos are stored once per content, named by the SHA-256 of the uploaded bytes and
+# fanned out over two key levels (blobs/ab/cd/<digest>)
+def photo_blob_key(digest):
+    return f"blobs/{digest[:2]}/{digest[2:4]}/{digest}"
+
+def photo_content_type(image_format, filename):
+    if image_format and Image is not None and image_format in Image.MIME:
+        return Image.MIME[image_format]
+    return mimetypes.guess_type(filename)[0] or "application/octet-stream"
+
+# Count one reference per digest occurrence, creating the blob record on first use
+def add_photo_blob_references(digests, content_types, sizes, database=None):
+    database = database if database is not None else db
+    now = datetime.now()
+    database["photo_blobs"].bulk_write([
+        UpdateOne(
+            {"_id": digest},
+            {
+                "$inc": {"refcount": 1},
+                "$unset": {"released_at": ""},
+                "$setOnInsert": {
+                    "size": sizes[digest],
+                    "content_type": content_types[digest],
+                    "created_at": now
+                }
+            },
+            upsert=True
+        )
+        for digest in digests
+    ], ordered=False)
+
+# Drop one reference per digest occurrence. Blobs left without references are only marked
+# released; sweep_photo_blobs deletes them once they stayed unreferenced for a grace period.
+def remove_photo_blob_references(digests, database=None):
+    database = database if database is not None else db
+    if not digests:
+        return
+    counts = {}
+    for digest in digests:
+        counts[digest] = counts.get(digest, 0) + 1
+    database["photo_blobs"].bulk_write([
+        UpdateOne({"_id": digest}, {"$inc": {"refcount": -count}}) for digest, count in counts.items()
+    ], ordered=False)
+    database["photo_blobs"].update_many(
+        {"_id": {"$in": list(counts)}, "refcount": {"$lte": 0}, "released_at": {"$exists": False}},
+        {"$set": {"released_at": datetime.now()}}
+    )
+
+# Rendition formats: Pillow format name, file extension and content type
+RENDITION_FORMATS = {
+    "avif": ("AVIF", "avif", "image/avif"),
+    "webp": ("WEBP", "webp", "image/webp"),
+    "jpeg": ("JPEG", "jpg", "image/jpeg")
+}
+
+def photo_rendition_key(digest, width, format_name):
+    return f"{photo_blob_key(digest)}.w{width}.{RENDITION_FORMATS[format_name][1]}"
+
+# 64-bit difference hash: whether each pixel of a 9x8 grayscale thumbnail is brighter than its right neighbour.
+# Recompression, rescaling and small edits change only a few bits.
+def photo_dhash(image):
+    pixels = list(image.convert("L").resize((9, 8), Image.LANCZOS).getdata())
+    value = 0
+    for row in range(8):
+        for column in range(8):
+            value = (value << 1) | (pixels[row * 9 + column] > pixels[row * 9 + column + 1])
+    return value
+
+# Write scaled renditions of a local photo beside it and hash it. Runs in the transcoding processes, so
+# it touches only files: returns {"width", "dhash", "renditions"}, or None if the file is not an image.
+def render_photo_renditions(source_path, widths, format_names):
+    if Image is None:
+        return None
+    # Registers every writer Pillow has, WebP and AVIF included, not just the common ones
+    Image.init()
+    try:
+        with Image.open(source_path) as source:
+            source.load()
+            renditions = []
+            for width in sorted(widths):
+                # Wider than the original gains nothing over serving the original
+                if width >= source.width:
+                    break
+                height = max(1, round(source.height * width / source.width))
+                scaled = source.resize((width, height), Image.LANCZOS)
+                for format_name in format_names:
+                    pillow_format, extension, content_type = RENDITION_FORMATS[format_name]
+                    if pillow_format not in Image.SAVE:
+                        continue
+                    path = f"{source_path}.w{width}.{extension}"
+                    image = scaled if pillow_format != "JPEG" or scaled.mode == "RGB" else scaled.convert("RGB")
+                    image.save(path, format=pillow_format, quality=80)
+                    renditions.append({
+                        "width": width,
+                        "height": height,
+                        "format": format_name,
+                        "content_type": content_type,
+                        "size": os.path.getsize(path),
+                        "path": path
+                    })
+            return {"width": source.width, "dhash": f"{photo_dhash(source):016x}", "renditions": renditions}
+    except (OSError, ValueError) as e:
+        logger.info(f"No renditions for {source_path}: {e}")
+        return None
+
+# Transcoding is CPU-bound, so it runs in worker processes started on first use
+_transcode_pool = None
+_transcode_pool_lock = threading.Lock()
+
+def transcode_pool():
+    global _transcode_pool
+    with _transcode_pool_lock:
+        if _transcode_pool is None:
+            _transcode_pool = ProcessPoolExecutor(max_workers=app.config['PHOTO_TRANSCODE_PROCESSES'])
+        return _transcode_pool
+
+# Remove a working file if it is still there
+def discard_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+# Fetch a stored photo into the staging folder to work on
+def fetch_photo_blob(digest):
+    with tempfile.NamedTemporaryFile(dir=upload_staging_folder(), prefix="blob-", delete=False) as file:
+        local_path = file.name
+    photo_storage.fetch(photo_blob_key(digest), local_path)
+    return local_path
+
+# Render, store and hash photos and record the results on their blobs and on the activity, or on every
+# activity showing them when no activity is given. sources maps digests to local copies of newly stored
+# photos; other digests reuse what their blobs recorded, or are fetched and rendered if they have nothing.
+# Returns {digest: result}.
+def create_photo_renditions(sources, digests=(), activity_id=None, database=None):
+    database = database if database is not None else db
+    widths = app.config['PHOTO_RENDITION_WIDTHS']
+    format_names = [name for name in app.config['PHOTO_RENDITION_FORMATS'] if name in RENDITION_FORMATS]
+    
+    sources = dict(sources)
+    results = {}
+    known = [digest for digest in dict.fromkeys(digests) if digest not in sources]
+    if known:
+        for blob in database["photo_blobs"].find({"_id": {"$in": known}, "renditions": {"$exists": True}},
+                                                 {"width": 1, "dhash": 1, "renditions": 1}):
+            results[blob["_id"]] = blob if blob.get("dhash") else None
+    fetched = {digest: fetch_photo_blob(digest) for digest in known if digest not in results}
+    sources.update(fetched)
+    
+    try:
+        futures = {digest: transcode_pool().submit(render_photo_renditions, path, widths, format_names)
+                   for digest, path in sources.items()}
+        blob_updates = []
+        for digest, future in futures.items():
+            result = results[digest] = future.result()
+            if result is None:
+                # Not an image; an empty list keeps render-photos from trying again
+                blob_updates.append(UpdateOne({"_id": digest}, {"$set": {"renditions": []}}))
+                continue
+            for rendition in result["renditions"]:
+                local_path = rendition.pop("path")
+                photo_storage.put_file(photo_rendition_key(digest, rendition["width"], rendition["format"]),
+                                       local_path, rendition["content_type"])
+                discard_file(local_path)
+            blob_updates.append(UpdateOne(
+                {"_id": digest},
+                {"$set": {"width": result["width"], "dhash": result["dhash"], "renditions": result["renditions"]}}
+            ))
+        if blob_updates:
+            database["photo_blobs"].bulk_write(blob_updates, ordered=False)
+    finally:
+        for local_path in fetched.values():
+            discard_file(local_path)
+    
+    activity_fields = {
+        digest: {f"photo_renditions.{digest}": result["renditions"], f"photo_dhashes.{digest}": result["dhash"]}
+        for digest, result in results.items() if result is not None
+    }
+    if activity_fields and activity_id is not None:
+        database["activities"].update_one(
+            {"_id": activity_id},
+            {"$set": {field: value for fields in activity_fields.values() for field, value in fields.items()}}
+        )
+    elif activity_fields:
+        # Photos moved in by migrate-photos join the reuse index unchecked
+        now = datetime.now()
+        database["activities"].bulk_write([
+            UpdateMany({"photo_paths": digest}, {"$set": {**fields, "photo_hashed_at": now}})
+            for digest, fields in activity_fields.items()
+        ], ordered=False)
+    return results
+
+class MultiIndexHashTable:
+    """
+    Multi-index hashing over 64-bit hashes. Each hash is cut into
+    max_distance + 1 chunks, and any hash within max_distance of it matches
+    at least one chunk exactly, so a lookup only compares the hashes that
+    share a chunk with it. Unlike a BK-tree, this stays fast on hashes that
+    are spread evenly over the 64 bits.
+    """
+    
+    def __init__(self, max_distance):
+        self.max_distance = max_distance
+        chunk_count = max_distance + 1
+        bounds = [round(64 * index / chunk_count) for index in range(chunk_count + 1)]
+        self._chunks = [(low, (1 << (high - low)) - 1) for low, high in zip(bounds, bounds[1:])]
+        self._tables = [{} for _ in self._chunks]
+        self._values = []
+        self._items = []
+    
+    def add(self, value, item):
+        position = len(self._values)
+        self._values.append(value)
+        self._items.append(item)
+        for table, (shift, mask) in zip(self._tables, self._chunks):
+            table.setdefault((value >> shift) & mask, []).append(position)
+    
+    def search(self, value):
+        """Return (distance, item) for every item within max_distance of value"""
+        values = self._values
+        found = {}
+        for table, (shift, mask) in zip(self._tables, self._chunks):
+            for position in table.get((value >> shift) & mask, ()):
+                distance = (values[position] ^ value).bit_count()
+                if distance <= self.max_distance:
+                    found[position] = distance
+        return [(distance, self._items[position]) for position, distance in found.items()]
+    
+    def __len__(self):
+        return len(self._values)
+
+class PhotoHashIndex:
+    """
+    Process-local index of activity photo hashes, one multi-index hash table
+    per school.
+
+    Loaded from the activities collection at startup and topped up from it
+    before each check, so photos hashed by other processes are seen too.
+    """
+    
+    # Re-read this far behind the newest hash seen, for clocks of other processes running behind
+    REFRESH_OVERLAP = timedelta(minutes=1)
+    PROJECTION = {"school": 1, "teacher_email": 1, "date_str": 1, "photo_dhashes": 1, "photo_hashed_at": 1}
+    
+    def __init__(self, max_distance):
+        self.max_distance = max_distance
+        self._tables = {}
+        self._indexed = set()
+        self._hashed_since = None
+        self._lock = threading.Lock()
+    
+    def _add(self, activity):
+        if activity["_id"] in self._indexed:
+            return
+        self._indexed.add(activity["_id"])
+        table = self._tables.get(activity.get("school", ""))
+        if table is None:
+            table = self._tables[activity.get("school", "")] = MultiIndexHashTable(self.max_distance)
+        for digest, dhash in (activity.get("photo_dhashes") or {}).items():
+            table.add(int(dhash, 16), (activity["_id"], activity.get("teacher_email"), activity.get("date_str"), digest))
+    
+    def add(self, activity):
+        with self._lock:
+            self._add(activity)
+    
+    def refresh(self, database=None):
+        database = database if database is not None else db
+        query = {"photo_hashed_at": {"$exists": True}}
+        if self._hashed_since is not None:
+            query = {"photo_hashed_at": {"$gte": self._hashed_since - self.REFRESH_OVERLAP}}
+        activities = list(database["activities"].find(query, self.PROJECTION))
+        with self._lock:
+            for activity in activities:
+                self._add(activity)
+                if self._hashed_since is None or activity["photo_hashed_at"] > self._hashed_since:
+                    self._hashed_since = activity["photo_hashed_at"]
+        return len(activities)
+    
+    def find(self, school, dhash, exclude_activity=None):
+        with self._lock:
+            table = self._tables.get(school)
+            matches = table.search(int(dhash, 16)) if table else []
+        return sorted(
+            [(distance, item) for distance, item in matches if item[0] != exclude_activity],
+            key=lambda match: match[0]
+        )
+    
+    def __len__(self):
+        return sum(len(table) for table in self._tables.values())
+
+# Filled on the first reuse check in each process
+photo_hash_index = PhotoHashIndex(app.config['PHOTO_REUSE_MAX_DISTANCE'])
+
+# Compare an activity's photo hashes with the school's earlier photos and flag close matches
+def flag_photo_reuse(activity_id, dhashes, database=None):
+    database = database if database is not None else db
+    activity = database["activities"].find_one(
+        {"_id": activity_id}, {"school": 1, "teacher_email": 1, "date_str": 1, "photo_count": 1})
+    if activity is None:
+        return []
+    
+    photo_hash_index.refresh(database)
+    matches = []
+    for digest, dhash in dhashes.items():
+        for distance, (other_id, teacher_email, date_str, other_digest) in photo_hash_index.find(
+                activity.get("school", ""), dhash, exclude_activity=activity_id):
+            matches.append({
+                "digest": digest,
+                "activity_id": other_id,
+                "teacher_email": teacher_email,
+                "date_str": date_str,
+                "matched_digest": other_digest,
+                "distance": distance
+            })
+    matches.sort(key=lambda match: match["distance"])
+    
+    # Verified only when every photo could be hashed and none looks reused
+    all_hashed = len(dhashes) == activity.get("photo_count", len(dhashes))
+    database["activities"].update_one(
+        {"_id": activity_id},
+        {"$set": {
+            "suspected_reuse": bool(matches),
+            "reuse_matches": matches[:10],
+            "verified": all_hashed and not matches,
+            "photo_hashed_at": datetime.now()
+        }}
+    )
+    photo_hash_index.add({**activity, "_id": activity_id, "photo_dhashes": dhashes})
+    if matches:
+        logger.warning(f"Activity {activity_id} by {activity.get('teacher_email')} reuses "
+                       f"{len({match['digest'] for match in matches})} earlier photo(s)")
+    return matches
+
+# Local working copy of a photo: the staged upload, or a copy fetched from storage when the client
+# uploaded it there directly. Returns (path, digest).
+def stage_activity_photo(photo):
+    if "storage_key" not in photo:
+        return photo["staged_path"], photo["sha256"]
+    with tempfile.NamedTemporaryFile(dir=upload_staging_folder(), prefix="fetch-", delete=False) as file:
+        local_path = file.name
+    photo_storage.fetch(photo["storage_key"], local_path)
+    return local_path, file_sha256(local_path)
+
+# Place an activity's photos in the blob store and record their digests on the activity
+def process_activity_photos(activity_id, photos, database=None):
+    database = database if database is not None else db
+    # Local copies of the blobs stored by this run, kept for rendering
+    sources = {}
+    
+    try:
+        digests = []
+        content_types = {}
+        sizes = {}
+        for photo in photos:
+            local_path, digest = stage_activity_photo(photo)
+            digests.append(digest)
+            if digest in content_types or photo_storage.exists(photo_blob_key(digest)):
+                # The same bytes were stored before; the new copy is not needed
+                content_types.setdefault(digest, photo_content_type(None, photo["filename"]))
+                sizes.setdefault(digest, photo["size"])
+                discard_file(local_path)
+                continue
+            processed_path = f"{local_path}.stored"
+            image_format = finalize_photo(local_path, processed_path)
+            content_types[digest] = photo_content_type(image_format, photo["filename"])
+            sizes[digest] = os.path.getsize(processed_path)
+            sources[digest] = processed_path
+            photo_storage.put_file(photo_blob_key(digest), processed_path, content_types[digest])
+        
+        # Only the run that marks the activity ready counts its references
+        result = database["activities"].update_one(
+            {"_id": activity_id, "photo_status": {"$ne": "ready"}},
+            {
+                "$set": {"photo_paths": digests, "photo_status": "ready", "photos_processed_at": datetime.now()},
+                "$unset": {"photos_pending": "", "photo_error": ""}
+            }
+        )
+        if result.modified_count and digests:
+            add_photo_blob_references(digests, content_types, sizes, database)
+        for photo in photos:
+            if "storage_key" in photo:
+                photo_storage.delete(photo["storage_key"])
+        logger.info(f"Processed {len(digests)} photo(s) for activity {activity_id}")
+    except Exception as e:
+        logger.error(f"Error processing photos for activity {activity_id}: {e}")
+        update = {"$set": {"photo_status": "failed", "photo_error": str(e)}}
+        if isinstance(e, FileNotFoundError):
+            # The staged upload is gone; retrying it later cannot succeed
+            update["$unset"] = {"photos_pending": ""}
+        database["activities"].update_one({"_id": activity_id}, update)
+        for local_path in sources.values():
+            discard_file(local_path)
+        return None
+    
+    # The originals are in place; failing renditions or checks leave the photos ready
+    try:
+        results = create_photo_renditions(sources, digests, activity_id, database)
+        flag_photo_reuse(activity_id, {digest: result["dhash"] for digest, result in results.items() if result},
+                         database)
+    except Exception as e:
+        logger.error(f"Error rendering or checking photos for activity {activity_id}: {e}")
+    finally:
+        for local_path in sources.values():
+            discard_file(local_path)
+    return digests
+
+# Keep staged uploads past the request once they are recorded
+def claim_uploads(files):
+    for file in files:
+        file.stream.claimed = True
+
+# Hand an activity's photos to the background pool
+def queue_activity_photos(activity_id, photos):
+    return photo_executor.submit(process_activity_photos, activity_id, photos)
+
+# Process photos left pending by a stopped or failed worker
+def process_pending_photos(older_than_minutes=10, database=None):
+    database = database if database is not None else db
+    pending = database["activities"].find(
+        {
+            "photo_status": {"$in": ["processing", "failed"]},
+            "photos_pending": {"$exists": True},
+            "created_at": {"$lt": datetime.now() - timedelta(minutes=older_than_minutes)}
+        },
+        {"photos_pending": 1}
+    )
+    processed = failed = 0
+    for activity in pending:
+        result = process_activity_photos(activity["_id"], activity["photos_pending"], database)
+        if result is None:
+            failed += 1
+        else:
+            processed += 1
+    return {"processed": processed, "failed": failed}
+
+# Hash a file on disk in chunks
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Move photos saved under uploads/<date>/ before the blob store into it
+def migrate_legacy_photos(database=None):
+    database = database if database is not None else db
+    report = {"activities": 0, "photos": 0, "missing": 0}
+    for activity in database["activities"].find({"photo_paths.0": {"$exists": True}}, {"photo_paths": 1}):
+        legacy_paths = [path for path in activity["photo_paths"] if not is_photo_digest(path)]
+        if not legacy_paths:
+            continue
+        
+        photo_paths = []
+        digests = []
+        content_types = {}
+        sizes = {}
+        for path in activity["photo_paths"]:
+            if is_photo_digest(path) or not os.path.exists(path):
+                report["missing"] += path in legacy_paths
+                photo_paths.append(path)
+                continue
+            digest = file_sha256(path)
+            content_types[digest] = photo_content_type(None, path)
+            sizes[digest] = os.path.getsize(path)
+            if not photo_storage.exists(photo_blob_key(digest)):
+                photo_storage.put_file(photo_blob_key(digest), path, content_types[digest])
+            photo_paths.append(digest)
+            digests.append(digest)
+        
+        if not digests:
+            continue
+        result = database["activities"].update_one(
+            {"_id": activity["_id"], "photo_paths": activity["photo_paths"]},
+            {"$set": {"photo_paths": photo_paths}}
         )
+        if not result.modified_count:
+            continue
+        add_photo_blob_references(digests, content_types, sizes, database)
+        for path in legacy_paths:
+            if os.path.exists(path):
+                os.remove(path)
+        report["activities"] += 1
+        report["photos"] += len(digests)
+    
+    return report
 
-@app.route("/social_science")
-def social_science():
-    if "email" not in session:
-        return redirect(url_for("login"))
-    return render_template("social_science.html")
+# Remove an activity's photos, e.g. on a takedown request; returns how many were removed
+def delete_activity_photos(activity_id, database=None):
+    database = database if database is not None else db
+    activity = database["activities"].find_one_and_update(
+        {"_id": activity_id, "photo_paths.0": {"$exists": True}},
+        {
+            "$set": {"photo_paths": [], "photos_deleted_at": datetime.now()},
+            "$unset": {"photo_renditions": "", "photo_dhashes": ""}
+        },
+        projection={"photo_paths": 1}
+    )
+    if not activity:
+        return 0
+    remove_photo_blob_references([path for path in activity["photo_paths"] if is_photo_digest(path)], database)
+    for path in activity["photo_paths"]:
+        if not is_photo_digest(path):
+            discard_file(path)
+    return len(activity["photo_paths"])
 
-@app.route("/science")
-def science():
-    if "email" not in session:
-        return redirect(url_for("login"))
-    return render_template("science.html")
+# Delete blobs, with their renditions, that have had no references for grace_hours
+def sweep_photo_blobs(grace_hours=24, database=None):
+    """
+    The grace period leaves a just-released photo in place for a resubmission
+    of the same bytes, which reuses the stored blob instead of uploading it.
 
-@app.route("/english")
-def english():
-    if "email" not in session:
-        return redirect(url_for("login"))
-    return render_template("english.html")
+    Returns:
+        dict: blobs deleted, and blobs skipped because an activity still lists them
+    """
+    database = database if database is not None else db
+    report = {"deleted": 0, "still_referenced": 0}
+    released_before = datetime.now() - timedelta(hours=grace_hours)
+    for blob in database["photo_blobs"].find(
+            {"released_at": {"$lt": released_before}, "refcount": {"$lte": 0}}, {"renditions": 1}):
+        digest = blob["_id"]
+        # Counts can drift if activities are edited by hand; never delete a photo still in use
+        if database["activities"].find_one({"photo_paths": digest}, {"_id": 1}):
+            logger.warning(f"Photo blob {digest} has no counted references but is still used; keeping it")
+            report["still_referenced"] += 1
+            continue
+        if not database["photo_blobs"].delete_one({"_id": digest, "refcount": {"$lte": 0}}).deleted_count:
+            continue
+        for rendition in blob.get("renditions", []):
+            photo_storage.delete(photo_rendition_key(digest, rendition["width"], rendition["format"]))
+        photo_storage.delete(photo_blob_key(digest))
+        report["deleted"] += 1
+    logger.info(f"Swept {report['deleted']} unreferenced photo blob(s)")
+    return report
+
+# Activity _id of an attendance submission; derived from the idempotency key so a retry writes the same activity
+def submission_activity_id(email, idempotency_key):
+    if not idempotency_key:
+        return ObjectId()
+    return ObjectId(hashlib.sha256(f"{email}:mark_attendance:{idempotency_key}".encode()).digest()[:12])
+
+# Stop photo processing for a submission that failed part way; its staged photos go with the request
+def abandon_submission_photos(activity_id):
+    try:
+        activities_collection.update_one(
+            {"_id": activity_id, "photo_status": "processing"},
+            {
+                "$set": {"photo_status": "failed", "photo_error": "Submission failed before its photos were kept"},
+                "$unset": {"photos_pending": ""}
+            }
+        )
+    except PyMongoError as e:
+        logger.error(f"Error abandoning photos of activity {activity_id}: {e}")
 
 @app.route("/mark_attendance", methods=["POST"])
+@requires_database
+@round_trip_budget('ATTENDANCE_ROUND_TRIP_BUDGET')
+@idempotent
 def mark_attendance():
     if "email" not in session:
         logger.warning("Unauthorized attendance marking attempt")
         return jsonify({"status": "fail", "message": "Please login first"})
     
-    # Verify database connection before proceeding
-    if not verify_db_connection():
-        logger.error("Database connection error during attendance marking")
-        return jsonify({
-            "status": "fail",
-            "message": "Database connection error. Please try again."
-        })
-    
     try:
         logger.info(f"Received attendance marking request from: {session['email']}")
         
@@ -841,183 +3383,67 @@ def mark_attendance():
         current_date = datetime.now()
         today = current_date.strftime("%Y-%m-%d")
         
-        # Get teacher details
-        teacher = users_collection.find_one({"email": session["email"]})
+        # Get teacher details, from the session when it carries them
+        teacher = session_teacher_profile() or users_collection.find_one({"email": session["email"]})
         if not teacher:
             logger.error(f"Teacher not found: {session['email']}")
             return jsonify({"status": "fail", "message": "Teacher not found"})
 
-        # Handle file upload
-        if 'activity_photos' not in request.files:
-            logger.warning("No activity photos in request")
-            return jsonify({"status": "fail", "message": "Activity photos are required for attendance"})
-        
-        files = request.files.getlist('activity_photos')
-        if not files or files[0].filename == '':
-            logger.warning("Empty file selection")
-            return jsonify({"status": "fail", "message": "Please select at least one photo"})
-        
-        # Create date-based directory for photos
-        date_folder = os.path.join(app.config['UPLOAD_FOLDER'], today)
-        if not os.path.exists(date_folder):
-            os.makedirs(date_folder)
-            logger.info(f"Created date folder: {date_folder}")
-        
-        # Save files with timestamps
-        file_paths = []
-        for file in files:
-            if file and file.filename:
-                timestamp = datetime.now().strftime("%H%M%S")
-                filename = secure_filename(f"{session['email']}_{timestamp}_{file.filename}")
-                file_path = os.path.join(date_folder, filename)
-                try:
-                    file.save(file_path)
-                    logger.info(f"Saved file: {file_path}")
-                    file_paths.append(file_path)
-                except Exception as e:
-                    logger.error(f"Error saving file {filename}: {e}")
-                    return jsonify({
-                        "status": "fail",
-                        "message": f"Error saving file: {str(e)}"
-                    })
-
-        # First mark the daily attendance
-        daily_attendance = {
-            "teacher_id": teacher.get("teacher_id", ""),
-            "teacher_email": session["email"],
-            "teacher_name": teacher.get("name", "Unknown"),
-            "school": teacher.get("school", "Unknown"),
-            "subject": teacher.get("subject", ""),
-            "class": teacher.get("class", ""),
-            "date": current_date,
-            "date_str": today,
-            "time_in": current_date.strftime("%H:%M:%S"),
-            "status": "present",
-            "attendance_method": "activity_completion",
-            "created_at": current_date
-        }
+        # Photos uploaded straight to storage arrive as keys
+        photo_keys = request.form.getlist("photo_keys")
+        files = []
+        if photo_keys:
+            photos, error_message = direct_upload_photos(photo_keys, session["email"])
+            if error_message:
+                logger.warning(f"Rejected uploaded photo keys from {session['email']}: {error_message}")
+                return jsonify({"status": "fail", "message": error_message})
+        else:
+            # Handle file upload
+            if 'activity_photos' not in request.files:
+                logger.warning("No activity photos in request")
+                return jsonify({"status": "fail", "message": "Activity photos are required for attendance"})
+            
+            files = request.files.getlist('activity_photos')
+            if not files or files[0].filename == '':
+                logger.warning("Empty file selection")
+                return jsonify({"status": "fail", "message": "Please select at least one photo"})
+            
+            # Photos were streamed to staging; they are stripped, scaled and placed after the response
+            files = [file for file in files if file and file.filename]
+            photos = [staged_upload(file) for file in files]
+        activity_id = submission_activity_id(session["email"], request_idempotency_key())
 
-        # Insert or update daily attendance with error handling
+        # Record attendance, the activity and the statistics together
         try:
-            attendance_result = daily_attendance_collection.update_one(
-                {
-                    "teacher_email": session["email"],
-                    "date_str": today
-                },
-                {"$setOnInsert": daily_attendance},
-                upsert=True
+            first_today = record_attendance_submission(
+                teacher, subject, activity_type, [], current_date,
+                activity_fields={
+                    "_id": activity_id,
+                    "photo_count": len(photos),
+                    "photos_pending": photos,
+                    "photo_status": "processing",
+                    # Set once the photos have been checked for reuse
+                    "verified": False
+                }
             )
-            
-            logger.info(f"Attendance result: {attendance_result.acknowledged}")
-            
-            if not attendance_result.acknowledged:
-                raise Exception("Failed to record attendance")
-                
-        except Exception as e:
-            logger.error(f"Error recording attendance: {e}")
+            logger.info(f"Attendance recorded, first submission today: {first_today}")
+        except (ConnectionFailure, ServerSelectionTimeoutError) as e:
+            logger.error(f"Database connection error during attendance marking: {e}")
+            abandon_submission_photos(activity_id)
             return jsonify({
                 "status": "fail",
-                "message": "Failed to record attendance in database"
+                "message": "Database connection error. Please try again."
             })
-        
-        # Record activity completion with photos
-        activity_record = {
-            "teacher_id": teacher.get("teacher_id", ""),
-            "teacher_email": session["email"],
-            "teacher_name": teacher.get("name", "Unknown"),
-            "school": teacher.get("school", "Unknown"),
-            "subject": subject,
-            "class": teacher.get("class", ""),
-            "activity_type": activity_type,
-            "completion_date": current_date,
-            "date_str": today,
-            "completion_time": current_date.strftime("%H:%M:%S"),
-            "photo_paths": file_paths,
-            "photo_count": len(file_paths),
-            "status": "completed",
-            "verified": True,
-            "created_at": current_date
-        }
-        
-        # Insert activity record with error handling
-        try:
-            activity_result = activities_collection.insert_one(activity_record)
-            logger.info(f"Activity result: {activity_result.acknowledged}")
-            
-            if not activity_result.acknowledged:
-                raise Exception("Failed to record activity")
         except Exception as e:
-            logger.error(f"Error recording activity: {e}")
+            logger.error(f"Error recording attendance: {e}")
+            abandon_submission_photos(activity_id)
             return jsonify({
                 "status": "fail",
-                "message": "Failed to record activity in database"
+                "message": "Failed to record attendance in database"
             })
         
-        # Update statistics with error handling
-        try:
-            # Update monthly attendance statistics
-            monthly_stats_result = teacher_monthly_stats.update_one(
-                {
-                    "teacher_email": session["email"],
-                    "year": current_date.year,
-                    "month": current_date.month
-                },
-                {
-                    "$inc": {
-                        "days_present": 1,
-                        "activities_completed": 1,
-                        "photos_submitted": len(file_paths)
-                    },
-                    "$set": {
-                        "last_activity_date": current_date,
-                        "last_updated": current_date
-                    },
-                    "$setOnInsert": {
-                        "teacher_name": teacher.get("name", "Unknown"),
-                        "teacher_id": teacher.get("teacher_id", ""),
-                        "school": teacher.get("school", "Unknown"),
-                        "subject": teacher.get("subject", ""),
-                        "class": teacher.get("class", ""),
-                        "created_at": current_date
-                    }
-                },
-                upsert=True
-            )
-            logger.info(f"Monthly stats update result: {monthly_stats_result.acknowledged}")
-
-            # Update subject-wise activity tracking
-            subject_stats_result = subject_activity_stats.update_one(
-                {
-                    "teacher_email": session["email"],
-                    "subject": subject,
-                    "class": teacher.get("class", ""),
-                    "year": current_date.year,
-                    "month": current_date.month
-                },
-                {
-                    "$inc": {
-                        "total_activities": 1,
-                        f"activity_counts.{activity_type}": 1
-                    },
-                    "$set": {
-                        "last_activity_date": current_date,
-                        "last_activity_type": activity_type
-                    },
-                    "$setOnInsert": {
-                        "teacher_name": teacher.get("name", "Unknown"),
-                        "teacher_id": teacher.get("teacher_id", ""),
-                        "school": teacher.get("school", "Unknown"),
-                        "class": teacher.get("class", ""),
-                        "created_at": current_date
-                    }
-                },
-                upsert=True
-            )
-            logger.info(f"Subject stats update result: {subject_stats_result.acknowledged}")
-
-        except Exception as e:
-            logger.error(f"Error updating statistics: {e}")
-            # Continue as the main records are saved
+        claim_uploads(files)
+        queue_activity_photos(activity_id, photos)
         
         logger.info("Attendance and activity recorded successfully")
         return jsonify({
@@ -1028,8 +3454,9 @@ def mark_attendance():
                 "attendance_time": current_date.strftime("%H:%M:%S"),
                 "subject": subject,
                 "activity_type": activity_type,
-                "photos_uploaded": len(file_paths),
-                "attendance_verified": True
+                "photos_uploaded": len(photos),
+                # Verified once the photos have been checked for reuse in the background
+                "attendance_verified": "pending"
             }
         })
         
@@ -1148,167 +3575,396 @@ def debug_check_attendance():
             "message": f"Error checking attendance: {str(e)}"
         })
 
+CURRICULUM_CLASSES = ["class8", "class9", "class10"]
+CURRICULUM_SUBJECTS = ["science", "social_science", "english", "mathematics"]
+# Activity types the daily and weekly schedules pick from, in selection order
+SCHEDULE_ACTIVITY_TYPES = ["quiz", "video", "interactive", "pdf", "discussion"]
+
+# Build the default curriculum document for a class and subject
+def build_curriculum(class_level, subject):
+    # Create curriculum data with modules for each class-subject combination
+    modules = [
+        {
+            "module_id": 1,
+            "title": f"Introduction to {subject.replace('_', ' ').title()}",
+            "activities": [
+                {"activity_id": 1, "type": "video", "title": "Course Overview", "duration": 15},
+                {"activity_id": 2, "type": "pdf", "title": "Reading Materials", "duration": 30},
+                {"activity_id": 3, "type": "quiz", "title": "Basic Concepts Quiz", "duration": 20},
+                {"activity_id": 4, "type": "interactive", "title": "Engage with Concepts", "duration": 25}
+            ]
+        },
+        {
+            "module_id": 2,
+            "title": "Core Concepts",
+            "activities": [
+                {"activity_id": 5, "type": "video", "title": "Key Principles", "duration": 20},
+                {"activity_id": 6, "type": "interactive", "title": "Hands-on Exercise", "duration": 35},
+                {"activity_id": 7, "type": "discussion", "title": "Group Discussion", "duration": 40},
+                {"activity_id": 8, "type": "quiz", "title": "Progress Check", "duration": 15}
+            ]
+        },
+        {
+            "module_id": 3,
+            "title": "Advanced Topics",
+            "activities": [
+                {"activity_id": 9, "type": "pdf", "title": "Research Materials", "duration": 45},
+                {"activity_id": 10, "type": "video", "title": "Expert Insights", "duration": 25},
+                {"activity_id": 11, "type": "interactive", "title": "Problem Solving", "duration": 40},
+                {"activity_id": 12, "type": "quiz", "title": "Mastery Test", "duration": 30}
+            ]
+        },
+        {
+            "module_id": 4,
+            "title": "Practical Applications",
+            "activities": [
+                {"activity_id": 13, "type": "interactive", "title": "Real-world Applications", "duration": 50},
+                {"activity_id": 14, "type": "video", "title": "Case Studies", "duration": 30},
+                {"activity_id": 15, "type": "pdf", "title": "Additional Resources", "duration": 35},
+                {"activity_id": 16, "type": "discussion", "title": "Reflection Session", "duration": 25}
+            ]
+        },
+        {
+            "module_id": 5,
+            "title": "Final Assessment",
+            "activities": [
+                {"activity_id": 17, "type": "video", "title": "Review Session", "duration": 20},
+                {"activity_id": 18, "type": "pdf", "title": "Study Guide", "duration": 30},
+                {"activity_id": 19, "type": "interactive", "title": "Preparation Exercise", "duration": 35},
+                {"activity_id": 20, "type": "quiz", "title": "Final Examination", "duration": 60}
+            ]
+        }
+    ]
+    
+    # Calculate total activities and duration
+    total_activities = sum(len(module["activities"]) for module in modules)
+    total_duration = sum(activity["duration"] for module in modules for activity in module["activities"])
+    
+    return {
+        "class": class_level,
+        "subject": subject,
+        "title": f"{class_level.replace('class', 'Class ')} {subject.replace('_', ' ').title()}",
+        "modules": modules,
+        "total_activities": total_activities,
+        "total_duration": total_duration,
+        "created_at": datetime.now()
+    }
+
+# Bump the curriculum version so every process reloads its curriculum store
+def bump_curriculum_version(database=None):
+    database = database if database is not None else db
+    migration = database["schema_migrations"].find_one_and_update(
+        {"_id": "curriculum"},
+        {"$inc": {"version": 1}, "$set": {"updated_at": datetime.now()}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    logger.info(f"Curriculum version bumped to {migration['version']}")
+    return migration["version"]
+
 # Initialize curriculum for different classes and subjects if not present
 def initialize_curriculum():
     try:
-        # Check if curriculum already exists
-        if curriculum_collection.count_documents({}) == 0:
-            logger.info("Initializing curriculum data...")
-            
-            # Sample curriculum structure for different classes and subjects
-            classes = ["class8", "class9", "class10"]
-            subjects = ["science", "social_science", "english", "mathematics"]
-            
-            for class_level in classes:
-                for subject in subjects:
-                    # Create curriculum data with modules for each class-subject combination
-                    modules = [
-                        {
-                            "module_id": 1,
-                            "title": f"Introduction to {subject.replace('_', ' ').title()}",
-                            "activities": [
-                                {"activity_id": 1, "type": "video", "title": "Course Overview", "duration": 15},
-                                {"activity_id": 2, "type": "pdf", "title": "Reading Materials", "duration": 30},
-                                {"activity_id": 3, "type": "quiz", "title": "Basic Concepts Quiz", "duration": 20},
-                                {"activity_id": 4, "type": "interactive", "title": "Engage with Concepts", "duration": 25}
-                            ]
-                        },
-                        {
-                            "module_id": 2,
-                            "title": "Core Concepts",
-                            "activities": [
-                                {"activity_id": 5, "type": "video", "title": "Key Principles", "duration": 20},
-                                {"activity_id": 6, "type": "interactive", "title": "Hands-on Exercise", "duration": 35},
-                                {"activity_id": 7, "type": "discussion", "title": "Group Discussion", "duration": 40},
-                                {"activity_id": 8, "type": "quiz", "title": "Progress Check", "duration": 15}
-                            ]
-                        },
-                        {
-                            "module_id": 3,
-                            "title": "Advanced Topics",
-                            "activities": [
-                                {"activity_id": 9, "type": "pdf", "title": "Research Materials", "duration": 45},
-                                {"activity_id": 10, "type": "video", "title": "Expert Insights", "duration": 25},
-                                {"activity_id": 11, "type": "interactive", "title": "Problem Solving", "duration": 40},
-                                {"activity_id": 12, "type": "quiz", "title": "Mastery Test", "duration": 30}
-                            ]
-                        },
-                        {
-                            "module_id": 4,
-                            "title": "Practical Applications",
-                            "activities": [
-                                {"activity_id": 13, "type": "interactive", "title": "Real-world Applications", "duration": 50},
-                                {"activity_id": 14, "type": "video", "title": "Case Studies", "duration": 30},
-                                {"activity_id": 15, "type": "pdf", "title": "Additional Resources", "duration": 35},
-                                {"activity_id": 16, "type": "discussion", "title": "Reflection Session", "duration": 25}
-                            ]
-                        },
-                        {
-                            "module_id": 5,
-                            "title": "Final Assessment",
-                            "activities": [
-                                {"activity_id": 17, "type": "video", "title": "Review Session", "duration": 20},
-                                {"activity_id": 18, "type": "pdf", "title": "Study Guide", "duration": 30},
-                                {"activity_id": 19, "type": "interactive", "title": "Preparation Exercise", "duration": 35},
-                                {"activity_id": 20, "type": "quiz", "title": "Final Examination", "duration": 60}
-                            ]
-                        }
-                    ]
-                    
-                    # Calculate total activities and duration
-                    total_activities = sum(len(module["activities"]) for module in modules)
-                    total_duration = sum(activity["duration"] for module in modules for activity in module["activities"])
-                    
-                    curriculum_data = {
-                        "class": class_level,
-                        "subject": subject,
-                        "title": f"{class_level.replace('class', 'Class ')} {subject.replace('_', ' ').title()}",
-                        "modules": modules,
-                        "total_activities": total_activities,
-                        "total_duration": total_duration,
-                        "created_at": datetime.now()
-                    }
-                    
-                    curriculum_collection.insert_one(curriculum_data)
-            
-            logger.info(f"Curriculum initialized for {len(classes)} classes and {len(subjects)} subjects")
-        else:
-            # Ensure all class-subject combinations have curriculum data
-            classes = ["class8", "class9", "class10"]
-            subjects = ["science", "social_science", "english", "mathematics"]
-            
-            for class_level in classes:
-                for subject in subjects:
-                    # Check if this class-subject combination exists
-                    existing = curriculum_collection.find_one({
-                        "class": class_level,
-                        "subject": subject
-                    })
-                    
-                    if not existing:
-                        logger.info(f"Adding missing curriculum for {class_level} {subject}")
-                        
-                        # Create curriculum data with modules for this class-subject combination
-                        modules = [
-                            {
-                                "module_id": 1,
-                                "title": f"Introduction to {subject.replace('_', ' ').title()}",
-                                "activities": [
-                                    {"activity_id": 1, "type": "video", "title": "Course Overview", "duration": 15},
-                                    {"activity_id": 2, "type": "pdf", "title": "Reading Materials", "duration": 30},
-                                    {"activity_id": 3, "type": "quiz", "title": "Basic Concepts Quiz", "duration": 20},
-                                    {"activity_id": 4, "type": "interactive", "title": "Engage with Concepts", "duration": 25}
-                                ]
-                            },
-                            {
-                                "module_id": 2,
-                                "title": "Core Concepts",
-                                "activities": [
-                                    {"activity_id": 5, "type": "video", "title": "Key Principles", "duration": 20},
-                                    {"activity_id": 6, "type": "interactive", "title": "Hands-on Exercise", "duration": 35},
-                                    {"activity_id": 7, "type": "discussion", "title": "Group Discussion", "duration": 40},
-                                    {"activity_id": 8, "type": "quiz", "title": "Progress Check", "duration": 15}
-                                ]
-                            }
-                        ]
-                        
-                        # Calculate total activities and duration
-                        total_activities = sum(len(module["activities"]) for module in modules)
-                        total_duration = sum(activity["duration"] for module in modules for activity in module["activities"])
-                        
-                        curriculum_data = {
-                            "class": class_level,
-                            "subject": subject,
-                            "title": f"{class_level.replace('class', 'Class ')} {subject.replace('_', ' ').title()}",
-                            "modules": modules,
-                            "total_activities": total_activities,
-                            "total_duration": total_duration,
-                            "created_at": datetime.now()
-                        }
-                        
-                        curriculum_collection.insert_one(curriculum_data)
+        # Ensure all class-subject combinations have curriculum data
+        existing = {
+            (curriculum["class"], curriculum["subject"])
+            for curriculum in curriculum_collection.find({}, {"class": 1, "subject": 1})
+        }
+        missing = [
+            build_curriculum(class_level, subject)
+            for class_level in CURRICULUM_CLASSES
+            for subject in CURRICULUM_SUBJECTS
+            if (class_level, subject) not in existing
+        ]
+        
+        if missing:
+            logger.info(f"Adding curriculum for {len(missing)} class-subject combinations")
+            curriculum_collection.insert_many(missing)
+            bump_curriculum_version()
     except Exception as e:
         logger.error(f"Error initializing curriculum: {e}")
 
-# Initialize curriculum after app startup
-initialize_curriculum()
+# Group a curriculum's activities by schedule type, in module order
+def group_activities_by_type(curriculum):
+    activities_by_type = {activity_type: [] for activity_type in SCHEDULE_ACTIVITY_TYPES}
+    for module in curriculum["modules"]:
+        for activity in module["activities"]:
+            if activity["type"] not in activities_by_type:
+                continue
+            activities_by_type[activity["type"]].append({
+                "module_id": module["module_id"],
+                "module_title": module["title"],
+                "activity_id": activity["activity_id"],
+                "activity_title": activity["title"],
+                "activity_type": activity["type"]
+            })
+    return activities_by_type
+
+class CurriculumStore:
+    """
+    Process-local copy of every curriculum, keyed by (class, subject).
+
+    The whole collection is loaded on first use together with the version in
+    schema_migrations {_id: "curriculum"}. Afterwards the version is polled at
+    most once every poll_seconds and the store reloads only when it changed,
+    so requests never read curriculum documents themselves. Each entry also
+    carries the activities grouped by type, ready for schedule selection.
+    """
+    
+    def __init__(self, poll_seconds):
+        self.poll_seconds = poll_seconds
+        self.version = None
+        self._entries = {}
+        self._checked_at = None
+        self._lock = threading.Lock()
+    
+    def _current_version(self):
+        migration = schema_migrations_collection.find_one({"_id": "curriculum"}, {"version": 1})
+        return migration.get("version", 0) if migration else 0
+    
+    def load(self):
+        version = self._current_version()
+        entries = {}
+        for curriculum in curriculum_collection.find({}):
+            entries[(curriculum["class"], curriculum["subject"])] = {
+                "curriculum": curriculum,
+                "activities_by_type": group_activities_by_type(curriculum)
+            }
+        
+        self._entries = entries
+        self.version = version
+        self._checked_at = time.monotonic()
+        logger.info(f"Curriculum store loaded {len(entries)} curricula at version {version}")
+    
+    def _refresh(self):
+        if self._checked_at is not None and time.monotonic() - self._checked_at < self.poll_seconds:
+            return
+        with self._lock:
+            if self._checked_at is None:
+                self.load()
+            elif time.monotonic() - self._checked_at >= self.poll_seconds:
+                if self._current_version() != self.version:
+                    self.load()
+                else:
+                    self._checked_at = time.monotonic()
+    
+    def _entry(self, class_level, subject):
+        try:
+            self._refresh()
+        except Exception as e:
+            # Keep serving the copy we have if the version check fails
+            logger.error(f"Error refreshing curriculum store: {e}")
+        return self._entries.get((class_level, subject))
+    
+    def get(self, class_level, subject):
+        entry = self._entry(class_level, subject)
+        return entry["curriculum"] if entry else None
+    
+    def activities_by_type(self, class_level, subject):
+        entry = self._entry(class_level, subject)
+        return entry["activities_by_type"] if entry else {}
+
+# Loaded on first use in each process
+curriculum_store = CurriculumStore(app.config['CURRICULUM_POLL_SECONDS'])
+
+# Get the curriculum for a class and subject from the process-local store
+def get_curriculum(class_level, subject):
+    return curriculum_store.get(class_level, subject)
+
+# Activity ids must fit a signed 64-bit bitmap for the compact format
+PROGRESS_BITSET_MAX_ID = 62
+
+# Whether every activity of a curriculum can be stored as one bit of completed_bits
+def curriculum_fits_bitset(curriculum):
+    return all(
+        isinstance(activity["activity_id"], int) and 0 <= activity["activity_id"] <= PROGRESS_BITSET_MAX_ID
+        for module in curriculum["modules"] for activity in module["activities"]
+    )
+
+# Build a fresh progress document with nothing completed, in the full or compact format
+def build_progress_document(teacher_email, teacher_name, class_level, subject, curriculum, compact=False):
+    progress_data = {
+        "teacher_email": teacher_email,
+        "teacher_name": teacher_name,
+        "class": class_level,
+        "subject": subject,
+        "completed_activities": 0,
+        "total_activities": curriculum["total_activities"],
+        "progress_percentage": 0,
+        "last_activity_date": None,
+        "created_at": datetime.now(),
+        "updated_at": datetime.now()
+    }
+    
+    if compact and curriculum_fits_bitset(curriculum):
+        # Bit n of completed_bits is set once activity n is completed
+        progress_data["format"] = "bitset"
+        progress_data["completed_bits"] = Int64(0)
+        progress_data["completion_dates"] = {}
+        return progress_data
+    
+    # Initialize progress data with all activities marked as not completed
+    modules_progress = []
+    for module in curriculum["modules"]:
+        module_activities = []
+        for activity in module["activities"]:
+            module_activities.append({
+                "activity_id": activity["activity_id"],
+                "type": activity["type"],
+                "title": activity["title"],
+                "completed": False,
+                "completion_date": None
+            })
+        
+        modules_progress.append({
+            "module_id": module["module_id"],
+            "title": module["title"],
+            "activities": module_activities,
+            "completed_activities": 0,
+            "total_activities": len(module_activities)
+        })
+    
+    progress_data["modules_progress"] = modules_progress
+    return progress_data
+
+# Expand a compact progress document into the full modules_progress tree, joined from the curriculum
+def expand_progress(progress):
+    if not progress or progress.get("format") != "bitset":
+        return progress
+    
+    completed_bits = int(progress.get("completed_bits", 0))
+    completion_dates = progress.get("completion_dates", {})
+    curriculum = get_curriculum(progress["class"], progress["subject"])
+    
+    modules_progress = []
+    for module in (curriculum["modules"] if curriculum else []):
+        module_activities = []
+        for activity in module["activities"]:
+            completed = bool(completed_bits >> activity["activity_id"] & 1)
+            module_activities.append({
+                "activity_id": activity["activity_id"],
+                "type": activity["type"],
+                "title": activity["title"],
+                "completed": completed,
+                "completion_date": completion_dates.get(str(activity["activity_id"])) if completed else None
+            })
+        
+        modules_progress.append({
+            "module_id": module["module_id"],
+            "title": module["title"],
+            "activities": module_activities,
+            "completed_activities": sum(activity["completed"] for activity in module_activities),
+            "total_activities": len(module_activities)
+        })
+    
+    return {**progress, "modules_progress": modules_progress}
+
+# Group a teacher's incomplete activities by type from the curriculum store's prebuilt lists
+def incomplete_activities_by_type(progress, activities_by_type=None):
+    if progress.get("format") == "bitset":
+        completed_bits = int(progress.get("completed_bits", 0))
+        completed_ids = {activity_id for activity_id in range(PROGRESS_BITSET_MAX_ID + 1) if completed_bits >> activity_id & 1}
+    else:
+        completed_ids = {
+            activity["activity_id"]
+            for module in progress.get("modules_progress", [])
+            for activity in module.get("activities", [])
+            if activity.get("completed")
+        }
+    
+    if activities_by_type is None:
+        activities_by_type = curriculum_store.activities_by_type(progress["class"], progress["subject"])
+    return {
+        activity_type: [activity for activity in activities_by_type.get(activity_type, [])
+                        if activity["activity_id"] not in completed_ids]
+        for activity_type in SCHEDULE_ACTIVITY_TYPES
+    }
+
+# Stable 64-bit hash of the given parts, identical across threads and processes
+def stable_hash(*parts):
+    key = "\x1f".join(str(part) for part in parts).encode()
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "big")
+
+# Identity of a selection candidate: the activity id for activities, the value itself otherwise
+def _candidate_key(candidate):
+    return candidate["activity_id"] if isinstance(candidate, dict) else candidate
+
+# Pick one candidate from a stable hash of the key and the candidate set, without touching any RNG
+def stable_choice(candidates, *key):
+    candidate_set = ",".join(str(_candidate_key(candidate)) for candidate in candidates)
+    return candidates[stable_hash(*key, candidate_set) % len(candidates)]
+
+# Order candidates by a stable hash of the key and each candidate
+def stable_shuffle(candidates, *key):
+    return sorted(candidates, key=lambda candidate: stable_hash(*key, _candidate_key(candidate)))
+
+# Load everything one teacher's dashboard needs in two queries
+def load_dashboard_context(teacher_email, class_level, subject, teacher_name=None, database=None):
+    """
+    Fetch a teacher's progress and recent activities once per request.
+
+    The activities window covers the last 7 days through the end of the
+    current week, which is what get_daily_activity and
+    generate_weekly_schedule look at. It is not filtered by class or
+    subject, because the weekly completion check is not either. Both
+    functions add the assignments they store back into the window, so a
+    later reader sees them without querying again.
+    """
+    today = datetime.now().date()
+    start_of_week = today - timedelta(days=today.weekday())
+    end_of_week = start_of_week + timedelta(days=6)
+    window_start = min(today - timedelta(days=7), start_of_week)
+    database = database if database is not None else db
+    
+    progress = database["course_progress"].find_one({
+        "teacher_email": teacher_email,
+        "class": class_level,
+        "subject": subject
+    })
+    activities = list(database["activities"].find({
+        "teacher_email": teacher_email,
+        "date_str": {
+            "$gte": window_start.strftime("%Y-%m-%d"),
+            "$lte": end_of_week.strftime("%Y-%m-%d")
+        }
+    }).sort("date_str", 1))
+    
+    return {
+        "teacher_email": teacher_email,
+        "teacher_name": teacher_name,
+        "class": class_level,
+        "subject": subject,
+        "today": today,
+        "database": database,
+        "progress": progress,
+        "activities": activities
+    }
+
+# Activities from a dashboard context for one day, optionally limited to the context's class and subject
+def context_activities(context, date_str=None, same_course=True):
+    return [
+        activity for activity in context["activities"]
+        if (date_str is None or activity.get("date_str") == date_str)
+        and (not same_course or (activity.get("class") == context["class"] and activity.get("subject") == context["subject"]))
+    ]
 
 # Get or initialize teacher's course progress 
-def get_or_initialize_progress(teacher_email, class_level, subject):
+def get_or_initialize_progress(teacher_email, class_level, subject, context=None):
+    database = context["database"] if context is not None else db
     try:
         # Check if progress exists
-        progress = course_progress_collection.find_one({
-            "teacher_email": teacher_email,
-            "class": class_level,
-            "subject": subject
-        })
-        
-        if not progress:
-            # Get curriculum for this class and subject
-            curriculum = curriculum_collection.find_one({
+        if context is not None:
+            progress = context["progress"]
+        else:
+            progress = database["course_progress"].find_one({
+                "teacher_email": teacher_email,
                 "class": class_level,
                 "subject": subject
             })
+        
+        if not progress:
+            # Get curriculum for this class and subject
+            curriculum = get_curriculum(class_level, subject)
             
             if not curriculum:
                 logger.error(f"No curriculum found for {class_level} {subject}")
@@ -1326,61 +3982,31 @@ def get_or_initialize_progress(teacher_email, class_level, subject):
                     "updated_at": datetime.now()
                 }
             
-            # Initialize progress data with all activities marked as not completed
-            modules_progress = []
-            for module in curriculum["modules"]:
-                module_activities = []
-                for activity in module["activities"]:
-                    module_activities.append({
-                        "activity_id": activity["activity_id"],
-                        "type": activity["type"],
-                        "title": activity["title"],
-                        "completed": False,
-                        "completion_date": None
-                    })
-                
-                modules_progress.append({
-                    "module_id": module["module_id"],
-                    "title": module["title"],
-                    "activities": module_activities,
-                    "completed_activities": 0,
-                    "total_activities": len(module_activities)
-                })
-            
-            # Calculate total stats
-            total_activities = curriculum["total_activities"]
-            
             # Create progress record
-            try:
-                teacher = users_collection.find_one({"email": teacher_email})
-                teacher_name = teacher["name"] if teacher else "Unknown Teacher"
-            except Exception as e:
-                logger.error(f"Error getting teacher details: {e}")
-                teacher_name = "Unknown Teacher"
+            teacher_name = context.get("teacher_name") if context is not None else None
+            if not teacher_name:
+                try:
+                    teacher = database["users"].find_one({"email": teacher_email})
+                    teacher_name = teacher["name"] if teacher else "Unknown Teacher"
+                except Exception as e:
+                    logger.error(f"Error getting teacher details: {e}")
+                    teacher_name = "Unknown Teacher"
             
-            progress_data = {
-                "teacher_email": teacher_email,
-                "teacher_name": teacher_name,
-                "class": class_level,
-                "subject": subject,
-                "modules_progress": modules_progress,
-                "completed_activities": 0,
-                "total_activities": total_activities,
-                "progress_percentage": 0,
-                "last_activity_date": None,
-                "created_at": datetime.now(),
-                "updated_at": datetime.now()
-            }
+            progress_data = build_progress_document(teacher_email, teacher_name, class_level, subject,
+                                                    curriculum, compact=app.config['COMPACT_PROGRESS'])
             
             try:
-                course_progress_collection.insert_one(progress_data)
+                database["course_progress"].insert_one(progress_data)
                 progress = progress_data
             except Exception as e:
                 logger.error(f"Error inserting new progress: {e}")
                 # Still return the data even if we couldn't save it
                 progress = progress_data
+            
+            if context is not None:
+                context["progress"] = progress
         
-        return progress
+        return expand_progress(progress)
     
     except Exception as e:
         logger.error(f"Error getting or initializing progress: {e}")
@@ -1429,59 +4055,88 @@ def generate_next_activity(modules_progress):
         return None
 
 # Mark an activity as completed and update progress
-def mark_activity_completed(teacher_email, class_level, subject, activity_id):
+def mark_activity_completed(teacher_email, class_level, subject, activity_id, database=None):
+    """
+    Mark one activity complete with a single atomic update.
+
+    Array filters address the matching incomplete activity in place, and the
+    module and total counters are incremented in the same update. Concurrent
+    completions therefore cannot overwrite each other, and completing an
+    activity twice does nothing. progress_percentage is then derived from the
+    counters on the server.
+
+    Compact progress documents get the same guarantee from $bitsAllClear on the
+    activity's bit. The configured format is tried first and the other one
+    only when nothing matched.
+    """
+    database = database if database is not None else db
+    course_progress = database["course_progress"]
     try:
-        # Get the teacher's progress
-        progress = course_progress_collection.find_one({
+        now = datetime.now()
+        progress_filter = {
             "teacher_email": teacher_email,
             "class": class_level,
             "subject": subject
-        })
-        
-        if not progress:
-            logger.error(f"No progress found for {teacher_email} in {class_level} {subject}")
-            return False
-        
-        # Find and update the activity
-        activity_found = False
-        modules_progress = progress["modules_progress"]
+        }
+        pending_activity = {"activity_id": activity_id, "completed": False}
         
-        for module in modules_progress:
-            for activity in module["activities"]:
-                if activity["activity_id"] == activity_id and not activity["completed"]:
-                    activity["completed"] = True
-                    activity["completion_date"] = datetime.now()
-                    module["completed_activities"] += 1
-                    activity_found = True
-                    break
-            
-            if activity_found:
+        tree_update = {
+            "filter": {**progress_filter, "modules_progress.activities": {"$elemMatch": pending_activity}},
+            "update": {
+                "$set": {
+                    "modules_progress.$[module].activities.$[activity].completed": True,
+                    "modules_progress.$[module].activities.$[activity].completion_date": now,
+                    "last_activity_date": now,
+                    "updated_at": now
+                },
+                "$inc": {
+                    "modules_progress.$[module].completed_activities": 1,
+                    "completed_activities": 1
+                }
+            },
+            "array_filters": [
+                {"module.activities": {"$elemMatch": pending_activity}},
+                {"activity.activity_id": activity_id, "activity.completed": False}
+            ]
+        }
+        attempts = [tree_update]
+        
+        if isinstance(activity_id, int) and 0 <= activity_id <= PROGRESS_BITSET_MAX_ID:
+            activity_bit = Int64(1 << activity_id)
+            bitset_update = {
+                "filter": {**progress_filter, "format": "bitset", "completed_bits": {"$bitsAllClear": activity_bit}},
+                "update": {
+                    "$bit": {"completed_bits": {"or": activity_bit}},
+                    "$set": {
+                        f"completion_dates.{activity_id}": now,
+                        "last_activity_date": now,
+                        "updated_at": now
+                    },
+                    "$inc": {"completed_activities": 1}
+                }
+            }
+            if app.config['COMPACT_PROGRESS']:
+                attempts.insert(0, bitset_update)
+            else:
+                attempts.append(bitset_update)
+        
+        for attempt in attempts:
+            result = course_progress.update_one(**attempt)
+            if result.modified_count:
                 break
         
-        if not activity_found:
-            logger.warning(f"Activity {activity_id} not found or already completed")
+        if not result.modified_count:
+            logger.warning(f"Activity {activity_id} not found or already completed for {teacher_email} in {class_level} {subject}")
             return False
         
-        # Update total completed activities and percentage
-        completed_activities = sum(module["completed_activities"] for module in modules_progress)
-        progress_percentage = int((completed_activities / progress["total_activities"]) * 100)
-        
-        # Update the progress record
-        course_progress_collection.update_one(
-            {
-                "teacher_email": teacher_email,
-                "class": class_level,
-                "subject": subject
-            },
-            {
-                "$set": {
-                    "modules_progress": modules_progress,
-                    "completed_activities": completed_activities,
-                    "progress_percentage": progress_percentage,
-                    "last_activity_date": datetime.now(),
-                    "updated_at": datetime.now()
-                }
-            }
+        # Derive the percentage from the counters
+        course_progress.update_one(
+            progress_filter,
+            [{"$set": {"progress_percentage": {"$cond": [
+                {"$gt": ["$total_activities", 0]},
+                {"$toInt": {"$trunc": {"$multiply": [{"$divide": ["$completed_activities", "$total_activities"]}, 100]}}},
+                0
+            ]}}}]
         )
         
         return True
@@ -1491,20 +4146,19 @@ def mark_activity_completed(teacher_email, class_level, subject, activity_id):
         return False
 
 # Generate a daily random activity based on date for consistency
-def get_daily_activity(teacher_email, class_level, subject):
+def get_daily_activity(teacher_email, class_level, subject, context=None):
     try:
-        today = datetime.now().date()
+        if context is None:
+            context = load_dashboard_context(teacher_email, class_level, subject)
+        
+        today = context["today"]
         today_str = today.strftime("%Y-%m-%d")
         yesterday = today - timedelta(days=1)
         yesterday_str = yesterday.strftime("%Y-%m-%d")
         
         # Check if we already have an assigned activity for today (completed or not)
-        today_activity = activities_collection.find_one({
-            "teacher_email": teacher_email,
-            "class": class_level,
-            "subject": subject,
-            "date_str": today_str
-        })
+        today_activities = context_activities(context, today_str)
+        today_activity = today_activities[0] if today_activities else None
         
         # If there's an activity for today that's completed, return it
         if today_activity and today_activity.get("status") == "completed":
@@ -1534,44 +4188,20 @@ def get_daily_activity(teacher_email, class_level, subject):
             }
         
         # Get teacher's progress
-        progress = course_progress_collection.find_one({
-            "teacher_email": teacher_email,
-            "class": class_level,
-            "subject": subject
-        })
+        progress = context["progress"]
         
         if not progress:
             # Need to initialize progress first
-            progress = get_or_initialize_progress(teacher_email, class_level, subject)
+            progress = get_or_initialize_progress(teacher_email, class_level, subject, context)
             if not progress or not progress.get("modules_progress"):
                 logger.error(f"Failed to get or initialize progress for {teacher_email}, {class_level}, {subject}")
                 return {"completed": False, "activity": None, "message": "No curriculum found"}
         
         # Get all incomplete activities grouped by type
-        activities_by_type = {
-            "quiz": [],
-            "video": [],
-            "interactive": [],
-            "pdf": [],
-            "discussion": []
-        }
+        activities_by_type = incomplete_activities_by_type(progress)
         
         # Track total activities found
-        total_activities_found = 0
-        
-        for module in progress.get("modules_progress", []):
-            for activity in module.get("activities", []):
-                total_activities_found += 1
-                if not activity.get("completed", True):
-                    activity_type = activity.get("type", "quiz")
-                    if activity_type in activities_by_type:
-                        activities_by_type[activity_type].append({
-                            "module_id": module.get("module_id", 0),
-                            "module_title": module.get("title", "Unknown Module"),
-                            "activity_id": activity.get("activity_id", 0),
-                            "activity_title": activity.get("title", "Unknown Activity"),
-                            "activity_type": activity_type
-                        })
+        total_activities_found = progress.get("total_activities", 0)
         
         # Get all incomplete activities
         incomplete_activities = []
@@ -1587,12 +4217,8 @@ def get_daily_activity(teacher_email, class_level, subject):
                 return {"completed": False, "activity": None, "message": "No activities found for this class and subject"}
         
         # Check what activity type was assigned yesterday
-        yesterday_activity = activities_collection.find_one({
-            "teacher_email": teacher_email,
-            "class": class_level,
-            "subject": subject,
-            "date_str": yesterday_str
-        })
+        yesterday_activities = context_activities(context, yesterday_str)
+        yesterday_activity = yesterday_activities[0] if yesterday_activities else None
         
         yesterday_activity_type = yesterday_activity.get("activity_type", None) if yesterday_activity else None
         
@@ -1607,26 +4233,20 @@ def get_daily_activity(teacher_email, class_level, subject):
             available_types = [t for t, activities in activities_by_type.items() if activities]
         
         # Get previously assigned activities from the past 7 days to avoid repetition
-        recent_date = today - timedelta(days=7)
-        recent_activities = list(activities_collection.find({
-            "teacher_email": teacher_email,
-            "class": class_level,
-            "subject": subject,
-            "completion_date": {"$gte": datetime.combine(recent_date, datetime.min.time())}
-        }))
+        recent_date = datetime.combine(today - timedelta(days=7), datetime.min.time())
+        recent_activities = [
+            act for act in context_activities(context)
+            if act.get("completion_date") and act["completion_date"] >= recent_date
+        ]
         
         # Extract activity IDs that were recently completed
         recent_activity_ids = [act.get("activity_id") for act in recent_activities if act.get("activity_id")]
         
-        # Use the date as a seed for random selection to ensure the same activity is shown all day
-        import random
-        # Create a seed from the date and teacher email to keep it consistent for the whole day
-        seed = f"{today_str}_{teacher_email}"
-        random.seed(seed)
+        # Picks are hashed from the teacher and the date so the same activity is shown all day
         
         # Randomly select an activity type for today, preferring one different from yesterday
         if available_types:
-            selected_type = random.choice(available_types)
+            selected_type = stable_choice(available_types, "daily-type", teacher_email, today_str)
             
             # Filter out recently completed activities for variety
             fresh_activities = [
@@ -1639,7 +4259,7 @@ def get_daily_activity(teacher_email, class_level, subject):
                 fresh_activities = activities_by_type[selected_type]
             
             # Select one random activity for today
-            daily_activity = random.choice(fresh_activities)
+            daily_activity = stable_choice(fresh_activities, "daily-activity", teacher_email, today_str)
         else:
             # Fallback to any incomplete activity
             # Filter out recently completed activities for variety
@@ -1650,7 +4270,7 @@ def get_daily_activity(teacher_email, class_level, subject):
                 fresh_activities = incomplete_activities
             
             # Select one random activity for today
-            daily_activity = random.choice(fresh_activities)
+            daily_activity = stable_choice(fresh_activities, "daily-activity", teacher_email, today_str)
         
         # Store today's assigned activity in a separate collection for reference
         try:
@@ -1662,13 +4282,13 @@ def get_daily_activity(teacher_email, class_level, subject):
                 "activity_type": daily_activity["activity_type"],
                 "activity_title": daily_activity["activity_title"],
                 "module_title": daily_activity["module_title"],
-                "assigned_date": today,
+                "assigned_date": datetime.combine(today, datetime.min.time()),
                 "date_str": today_str,
                 "status": "assigned",
                 "completed": False,
                 "created_at": datetime.now()
             }
-            assign_result = activities_collection.update_one(
+            assign_result = context["database"]["activities"].update_one(
                 {
                     "teacher_email": teacher_email,
                     "class": class_level, 
@@ -1679,6 +4299,8 @@ def get_daily_activity(teacher_email, class_level, subject):
                 {"$setOnInsert": today_assignment},
                 upsert=True
             )
+            if assign_result.upserted_id is not None:
+                context["activities"].append(today_assignment)
             logger.info(f"Activity assignment result: matched={assign_result.matched_count}, modified={assign_result.modified_count}, upserted={assign_result.upserted_id is not None}")
         except Exception as e:
             logger.warning(f"Failed to store today's activity assignment: {e}")
@@ -1689,7 +4311,132 @@ def get_daily_activity(teacher_email, class_level, subject):
         logger.error(f"Error getting daily activity: {e}")
         return {"completed": False, "activity": None, "message": f"Error: {str(e)}"}
 
+# Storage keys for photos a teacher uploads directly; the prefix ties them to the teacher
+def direct_upload_prefix(email):
+    return f"incoming/{hashlib.sha256(email.encode()).hexdigest()[:16]}/"
+
+# Hand out a presigned URL the client can PUT one photo to, so the bytes bypass the web workers
+@app.route("/photos/upload_url", methods=["POST"])
+def photo_upload_url():
+    if "email" not in session:
+        return jsonify({"status": "fail", "message": "Please login first"})
+    
+    content_type = request.form.get("content_type", "")
+    if not content_type.startswith("image/"):
+        return jsonify({"status": "fail", "message": "Only photos can be uploaded"})
+    filename = secure_filename(request.form.get("filename", "")) or "photo"
+    key = f"{direct_upload_prefix(session['email'])}{uuid.uuid4().hex}/{filename}"
+    expires_in = app.config['PHOTO_PRESIGNED_URL_SECONDS']
+    
+    return jsonify({
+        "status": "success",
+        "data": {
+            "key": key,
+            "url": photo_storage.presigned_put(key, content_type, expires_in),
+            "method": "PUT",
+            "headers": {"Content-Type": content_type},
+            "max_bytes": app.config['PHOTO_MAX_BYTES'],
+            "expires_in": expires_in
+        }
+    })
+
+# Target of the local backend's presigned upload URLs
+@app.route("/storage/<path:key>", methods=["PUT"])
+def local_storage_put(key):
+    if not isinstance(photo_storage.backend(), LocalDiskStorage) or not key.startswith("incoming/"):
+        return jsonify({"status": "fail", "message": "Not found"}), 404
+    if not photo_storage.verify_put(key, request.headers.get("Content-Type", ""),
+                                    request.args.get("expires"), request.args.get("signature")):
+        return jsonify({"status": "fail", "message": "Upload URL is invalid or has expired"}), 403
+    
+    upload = HashingUploadFile(upload_staging_folder(), app.config['PHOTO_MAX_BYTES'])
+    request.__dict__.setdefault("upload_files", []).append(upload)
+    shutil.copyfileobj(request.stream, upload)
+    upload.flush()
+    photo_storage.put_file(key, upload.name)
+    return "", 200
+
+# Check photos the teacher uploaded straight to storage; returns (photos, error message)
+def direct_upload_photos(photo_keys, email):
+    photos = []
+    for key in photo_keys:
+        size = photo_storage.size(key) if key.startswith(direct_upload_prefix(email)) else None
+        if size is None:
+            return None, "Uploaded photo not found. Please upload it again."
+        if size > app.config['PHOTO_MAX_BYTES']:
+            return None, f"Each photo may be at most {app.config['PHOTO_MAX_BYTES'] // (1024 * 1024)} MB"
+        photos.append({"storage_key": key, "size": size, "filename": key.rsplit("/", 1)[1]})
+    return photos, None
+
+# Client hints that size a photo request, most specific first
+PHOTO_WIDTH_HINTS = ["Sec-CH-Width", "Sec-CH-Viewport-Width", "Viewport-Width"]
+PHOTO_DPR_HINTS = ["Sec-CH-DPR", "DPR"]
+
+# Width in device pixels the client will show a photo at, from ?w=&dpr= or client hints; 0 if unknown
+def requested_photo_width():
+    def hint(names, default):
+        try:
+            return next((float(request.headers[name]) for name in names if request.headers.get(name)), default)
+        except ValueError:
+            return default
+    
+    if request.args.get("w", type=int):
+        width, dpr = request.args.get("w", type=int), request.args.get("dpr", 1.0, type=float)
+    elif request.headers.get("Sec-CH-Width"):
+        # Already in device pixels
+        width, dpr = hint(["Sec-CH-Width"], 0), 1.0
+    else:
+        width, dpr = hint(PHOTO_WIDTH_HINTS[1:], 0), hint(PHOTO_DPR_HINTS, 1.0)
+    return int(width * min(max(dpr, 1.0), 4.0))
+
+# Smallest rendition covering target_width in the most compact format the client accepts,
+# or None when the original should be served
+def choose_photo_rendition(renditions, source_width, target_width, accepted_types):
+    if not target_width or not renditions or (source_width and target_width >= source_width):
+        return None
+    for format_name, (_, _, content_type) in RENDITION_FORMATS.items():
+        if content_type != "image/jpeg" and content_type not in accepted_types:
+            continue
+        covering = [rendition for rendition in renditions
+                    if rendition["format"] == format_name and rendition["width"] >= target_width]
+        if covering:
+            return min(covering, key=lambda rendition: rendition["width"])
+    return None
+
+# Serve a stored photo by digest, scaled down to the client's viewport when a rendition fits.
+# A digest's content never changes, so responses are cached for good.
+@app.route("/photos/<digest>")
+def serve_photo(digest):
+    if "email" not in session:
+        return redirect(url_for("login"))
+    
+    if not is_photo_digest(digest):
+        return jsonify({"status": "fail", "message": "Photo not found"}), 404
+    blob = photo_blobs_collection.find_one({"_id": digest}, {"content_type": 1, "width": 1, "renditions": 1})
+    if not blob:
+        return jsonify({"status": "fail", "message": "Photo not found"}), 404
+    
+    accepted_types = {value for value, quality in request.accept_mimetypes if quality > 0}
+    rendition = choose_photo_rendition(blob.get("renditions"), blob.get("width"), requested_photo_width(), accepted_types)
+    try:
+        if rendition:
+            response = photo_storage.send(photo_rendition_key(digest, rendition["width"], rendition["format"]),
+                                          rendition["content_type"], f"{digest}.w{rendition['width']}.{rendition['format']}",
+                                          365 * 24 * 3600)
+        else:
+            response = photo_storage.send(photo_blob_key(digest), blob["content_type"], digest, 365 * 24 * 3600)
+    except NotFound:
+        return jsonify({"status": "fail", "message": "Photo not found"}), 404
+    
+    # Attendance photos are only for signed-in users, so shared caches must not keep them
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.vary.update(["Accept", *PHOTO_WIDTH_HINTS, *PHOTO_DPR_HINTS])
+    response.headers["Accept-CH"] = ", ".join(PHOTO_WIDTH_HINTS[:2] + PHOTO_DPR_HINTS[:1])
+    return response
+
 @app.route("/complete_activity", methods=["POST"])
+@idempotent
 def complete_activity():
     if "email" not in session:
         return jsonify({"status": "fail", "message": "Please login first"})
@@ -1711,30 +4458,7 @@ def complete_activity():
             teacher = users_collection.find_one({"email": session["email"]})
             
             # Mark daily attendance
-            daily_attendance = {
-                "teacher_id": teacher.get("teacher_id", ""),
-                "teacher_email": session["email"],
-                "teacher_name": teacher.get("name", "Unknown"),
-                "school": teacher.get("school", "Unknown"),
-                "subject": teacher.get("subject", ""),
-                "class": class_level,
-                "date": today,
-                "date_str": today_str,
-                "time_in": today.strftime("%H:%M:%S"),
-                "status": "present",
-                "attendance_method": "activity_completion",
-                "created_at": today
-            }
-            
-            # Update attendance record
-            daily_attendance_collection.update_one(
-                {
-                    "teacher_email": session["email"],
-                    "date_str": today_str
-                },
-                {"$setOnInsert": daily_attendance},
-                upsert=True
-            )
+            record_daily_attendance(teacher, class_level, today)
             
             # Record in activities collection too
             activity_record = {
@@ -1777,322 +4501,390 @@ def complete_activity():
         logger.error(f"Error completing activity: {e}")
         return jsonify({"status": "fail", "message": f"Error: {str(e)}"})
 
-# Generate a weekly schedule with random activities for each day
-def generate_weekly_schedule(teacher_email, class_level, subject):
-    try:
-        # Get teacher's progress
-        progress = course_progress_collection.find_one({
-            "teacher_email": teacher_email,
-            "class": class_level,
-            "subject": subject
-        })
+# Plan a teacher's Monday-Friday schedule for the week containing today, without touching the database
+def plan_weekly_schedule(teacher_email, class_level, subject, activities_by_type, week_activities, today):
+    """
+    Pure selection step shared by generate_weekly_schedule and the nightly
+    precompute job.
+
+    week_activities are the teacher's activity records for the week, across
+    all classes and subjects. Returns the schedule and the assignment
+    documents still to be stored, one per day from today on that has none.
+    """
+    # Check if we have activities available
+    all_incomplete_activities = []
+    for activities in activities_by_type.values():
+        all_incomplete_activities.extend(activities)
+    
+    if not all_incomplete_activities:
+        logger.info(f"No incomplete activities found for {teacher_email} in {class_level} {subject}")
+        return [], []
+    
+    # Get current week start and end dates
+    start_of_week = today - timedelta(days=today.weekday())  # Monday
+    end_of_week = start_of_week + timedelta(days=6)  # Sunday
+    
+    # Get all assigned activities for the current week to maintain consistency
+    this_week_activities = sorted(
+        (act for act in week_activities
+         if act.get("class") == class_level and act.get("subject") == subject
+         and act.get("status") in ("assigned", "completed")
+         and start_of_week.strftime("%Y-%m-%d") <= act.get("date_str", "") <= end_of_week.strftime("%Y-%m-%d")),
+        key=lambda act: act["date_str"]
+    )  # Sort by date
+    
+    # Create a map of date -> activity_id for already assigned/completed activities
+    existing_activities_map = {}
+    for act in this_week_activities:
+        existing_activities_map[act.get("date_str")] = {
+            "activity_id": act.get("activity_id"),
+            "activity_title": act.get("activity_title"),
+            "activity_type": act.get("activity_type"),
+            "module_title": act.get("module_title", "Unknown Module"),
+            "completed": act.get("status") == "completed"
+        }
+    
+    # Picks are hashed from the teacher and the week number for consistent selection
+    week_number = start_of_week.isocalendar()[1]  # Week number of the year
+    year = start_of_week.year
+    week_key = f"{year}_{week_number}"
+    
+    # Create a schedule for Monday to Friday
+    weekdays = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday"]
+    weekly_schedule = []
+    new_assignments = []
+    
+    # Track assigned activity IDs and types to prevent duplicates
+    assigned_activity_ids = [act.get("activity_id") for act in this_week_activities if act.get("activity_id")]
+    assigned_activity_types = []
+    
+    # Get existing activity types for this week to maintain consistency
+    for day_str, activity in existing_activities_map.items():
+        if activity.get("activity_type") and activity.get("activity_type") not in assigned_activity_types:
+            assigned_activity_types.append(activity.get("activity_type"))
+    
+    # Define a priority list of activity types to ensure variety
+    activity_types_priority = ["quiz", "video", "interactive", "pdf", "discussion"]
+    
+    # Shuffle the priority list using the week key for consistency
+    activity_types_copy = stable_shuffle(activity_types_priority, "weekly-types", teacher_email, week_key)
+    
+    # For days that already have activities assigned, use those
+    # For days that don't have activities assigned, select new ones
+    for i, day in enumerate(weekdays):
+        day_date = start_of_week + timedelta(days=i)
+        day_str = day_date.strftime("%Y-%m-%d")
+        is_past = day_date < today
+        is_today = day_date == today
+        
+        # Check if this day already has an activity assigned
+        if day_str in existing_activities_map:
+            activity = existing_activities_map[day_str]
+            completed = activity.get("completed", False)
+            
+            # If this was already assigned or completed, use that activity
+            weekly_schedule.append({
+                "day": day,
+                "date": day_date,
+                "date_str": day_str,
+                "activity": {
+                    "activity_id": activity.get("activity_id"),
+                    "activity_title": activity.get("activity_title"),
+                    "activity_type": activity.get("activity_type"),
+                    "module_title": activity.get("module_title")
+                },
+                "is_past": is_past,
+                "is_today": is_today,
+                "completed": completed
+            })
+            
+            # Make sure we don't reuse this activity for other days
+            if activity.get("activity_id") not in assigned_activity_ids:
+                assigned_activity_ids.append(activity.get("activity_id"))
+            continue
         
-        if not progress:
-            # Need to initialize progress first
-            progress = get_or_initialize_progress(teacher_email, class_level, subject)
-            if not progress or not progress.get("modules_progress"):
-                logger.error(f"No progress found for {teacher_email} in {class_level} {subject}")
-                return []
+        # Need to assign a new activity for this day
+        # Try to find an activity type that hasn't been used yet this week
+        available_types = [t for t in activity_types_copy if t not in assigned_activity_types]
         
-        # Get all incomplete activities grouped by type
-        activities_by_type = {
-            "quiz": [],
-            "video": [],
-            "interactive": [],
-            "pdf": [],
-            "discussion": []
-        }
+        if not available_types:
+            # If all types have been used, allow repeating but prioritize types with the most activities
+            available_types = sorted(
+                activities_by_type.keys(), 
+                key=lambda t: len(activities_by_type[t]), 
+                reverse=True
+            )
         
-        for module in progress.get("modules_progress", []):
-            for activity in module.get("activities", []):
-                if not activity.get("completed", True):
-                    activity_type = activity.get("type", "quiz")
-                    if activity_type in activities_by_type:
-                        activities_by_type[activity_type].append({
-                            "module_id": module.get("module_id", 0),
-                            "module_title": module.get("title", "Unknown Module"),
-                            "activity_id": activity.get("activity_id", 0),
-                            "activity_title": activity.get("title", "Unknown Activity"),
-                            "activity_type": activity_type
-                        })
-        
-        # Check if we have activities available
-        all_incomplete_activities = []
-        for activities in activities_by_type.values():
-            all_incomplete_activities.extend(activities)
-            
-        if not all_incomplete_activities:
-            logger.info(f"No incomplete activities found for {teacher_email} in {class_level} {subject}")
-            return []
+        # Take the first available type with activities
+        selected_type = None
+        for activity_type in available_types:
+            if activities_by_type[activity_type]:
+                selected_type = activity_type
+                break
         
-        # Get current week start and end dates
-        import random
-        from datetime import datetime, timedelta
+        # If no activities of the preferred types, pick any type with activities
+        if not selected_type:
+            for activity_type, activities in activities_by_type.items():
+                if activities:
+                    selected_type = activity_type
+                    break
         
-        today = datetime.now().date()
-        start_of_week = today - timedelta(days=today.weekday())  # Monday
-        end_of_week = start_of_week + timedelta(days=6)  # Sunday
+        # If still no activities found, use any incomplete activity
+        if not selected_type or not activities_by_type[selected_type]:
+            # Choose random activity from all incomplete
+            random_activity = stable_choice(all_incomplete_activities, "weekly-fallback", teacher_email, week_key, day_str)
+            selected_type = random_activity["activity_type"]
         
-        # Get all assigned activities for the current week to maintain consistency
-        this_week_activities = list(activities_collection.find({
-            "teacher_email": teacher_email,
-            "class": class_level,
-            "subject": subject,
-            "$or": [
-                {"status": "assigned"},
-                {"status": "completed"}
-            ],
-            "date_str": {
-                "$gte": start_of_week.strftime("%Y-%m-%d"),
-                "$lte": end_of_week.strftime("%Y-%m-%d")
-            }
-        }).sort("date_str", 1))  # Sort by date
-        
-        # Create a map of date -> activity_id for already assigned/completed activities
-        existing_activities_map = {}
-        for act in this_week_activities:
-            existing_activities_map[act.get("date_str")] = {
-                "activity_id": act.get("activity_id"),
-                "activity_title": act.get("activity_title"),
-                "activity_type": act.get("activity_type"),
-                "module_title": act.get("module_title", "Unknown Module"),
-                "completed": act.get("status") == "completed"
-            }
+        # Get available activities of this type that haven't been assigned yet
+        available_activities = [
+            a for a in activities_by_type[selected_type] 
+            if a["activity_id"] not in assigned_activity_ids
+        ]
+        
+        # If no available activities of this type, use any activities of this type
+        if not available_activities:
+            available_activities = activities_by_type[selected_type]
+        
+        # Select a random activity for this day
+        activity = stable_choice(available_activities, "weekly-activity", teacher_email, week_key, day_str)
         
-        # Use the week number and teacher email as the seed for consistent random generation
-        week_number = start_of_week.isocalendar()[1]  # Week number of the year
-        year = start_of_week.year
-        seed = f"{year}_{week_number}_{teacher_email}"
-        random.seed(seed)
+        # Add to assigned tracking
+        assigned_activity_ids.append(activity["activity_id"])
+        assigned_activity_types.append(selected_type)
         
-        # Create a schedule for Monday to Friday
-        weekdays = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday"]
-        weekly_schedule = []
+        # For future days, check if there's any record of completion
+        completed = False
+        if is_past or is_today:
+            completed = any(
+                act.get("date_str") == day_str and act.get("status") == "completed"
+                for act in week_activities
+            )
+        
+        # Store this assignment in the activities collection for future reference
+        if not is_past:  # Don't create assignments for past dates
+            new_assignments.append({
+                "teacher_email": teacher_email,
+                "class": class_level,
+                "subject": subject,
+                "activity_id": activity["activity_id"],
+                "activity_type": activity["activity_type"],
+                "activity_title": activity["activity_title"],
+                "module_title": activity["module_title"],
+                "assigned_date": datetime.combine(day_date, datetime.min.time()),
+                "date_str": day_str,
+                "status": "assigned",
+                "completed": completed,
+                "created_at": datetime.now()
+            })
         
-        # Track assigned activity IDs and types to prevent duplicates
-        assigned_activity_ids = [act.get("activity_id") for act in this_week_activities if act.get("activity_id")]
-        assigned_activity_types = []
+        weekly_schedule.append({
+            "day": day,
+            "date": day_date,
+            "date_str": day_str,
+            "activity": activity,
+            "is_past": is_past,
+            "is_today": is_today,
+            "completed": completed
+        })
+    
+    return weekly_schedule, new_assignments
+
+# Upserts that store new day assignments, leaving any existing assignment for the day in place
+def assignment_upserts(assignments):
+    return [
+        UpdateOne(
+            {
+                "teacher_email": assignment["teacher_email"],
+                "date_str": assignment["date_str"],
+                "status": "assigned"
+            },
+            {"$setOnInsert": assignment},
+            upsert=True
+        )
+        for assignment in assignments
+    ]
+
+# Generate a weekly schedule with random activities for each day
+def generate_weekly_schedule(teacher_email, class_level, subject, context=None):
+    try:
+        if context is None:
+            context = load_dashboard_context(teacher_email, class_level, subject)
         
-        # Get existing activity types for this week to maintain consistency
-        for day_str, activity in existing_activities_map.items():
-            if activity.get("activity_type") and activity.get("activity_type") not in assigned_activity_types:
-                assigned_activity_types.append(activity.get("activity_type"))
+        # Get teacher's progress
+        progress = context["progress"]
         
-        # Define a priority list of activity types to ensure variety
-        activity_types_priority = ["quiz", "video", "interactive", "pdf", "discussion"]
+        if not progress:
+            # Need to initialize progress first
+            progress = get_or_initialize_progress(teacher_email, class_level, subject, context)
+            if not progress or not progress.get("modules_progress"):
+                logger.error(f"No progress found for {teacher_email} in {class_level} {subject}")
+                return []
         
-        # Shuffle the priority list using the seed for consistency
-        activity_types_copy = activity_types_priority.copy()
-        random.shuffle(activity_types_copy)
+        # Get all incomplete activities grouped by type
+        activities_by_type = incomplete_activities_by_type(progress)
         
-        # Randomly select activities for each day, ensuring different types
         try:
-            # For days that already have activities assigned, use those
-            # For days that don't have activities assigned, select new ones
-            for i, day in enumerate(weekdays):
-                day_date = start_of_week + timedelta(days=i)
-                day_str = day_date.strftime("%Y-%m-%d")
-                is_past = day_date < today
-                is_today = day_date == today
-                
-                # Check if this day already has an activity assigned
-                if day_str in existing_activities_map:
-                    activity = existing_activities_map[day_str]
-                    completed = activity.get("completed", False)
-                    
-                    # If this was already assigned or completed, use that activity
-                    weekly_schedule.append({
-                        "day": day,
-                        "date": day_date,
-                        "date_str": day_str,
-                        "activity": {
-                            "activity_id": activity.get("activity_id"),
-                            "activity_title": activity.get("activity_title"),
-                            "activity_type": activity.get("activity_type"),
-                            "module_title": activity.get("module_title")
-                        },
-                        "is_past": is_past,
-                        "is_today": is_today,
-                        "completed": completed
-                    })
-                    
-                    # Make sure we don't reuse this activity for other days
-                    if activity.get("activity_id") not in assigned_activity_ids:
-                        assigned_activity_ids.append(activity.get("activity_id"))
-                else:
-                    # Need to assign a new activity for this day
-                    # Try to find an activity type that hasn't been used yet this week
-                    available_types = [t for t in activity_types_copy if t not in assigned_activity_types]
-                    
-                    if not available_types:
-                        # If all types have been used, allow repeating but prioritize types with the most activities
-                        available_types = sorted(
-                            activities_by_type.keys(), 
-                            key=lambda t: len(activities_by_type[t]), 
-                            reverse=True
-                        )
-                    
-                    # Take the first available type with activities
-                    selected_type = None
-                    for activity_type in available_types:
-                        if activities_by_type[activity_type]:
-                            selected_type = activity_type
-                            break
-                    
-                    # If no activities of the preferred types, pick any type with activities
-                    if not selected_type:
-                        for activity_type, activities in activities_by_type.items():
-                            if activities:
-                                selected_type = activity_type
-                                break
-                    
-                    # If still no activities found, use any incomplete activity
-                    if not selected_type or not activities_by_type[selected_type]:
-                        # Choose random activity from all incomplete
-                        random_activity = random.choice(all_incomplete_activities)
-                        selected_type = random_activity["activity_type"]
-                    
-                    # Get available activities of this type that haven't been assigned yet
-                    available_activities = [
-                        a for a in activities_by_type[selected_type] 
-                        if a["activity_id"] not in assigned_activity_ids
-                    ]
-                    
-                    # If no available activities of this type, use any activities of this type
-                    if not available_activities:
-                        available_activities = activities_by_type[selected_type]
-                    
-                    # Select a random activity for this day
-                    activity = random.choice(available_activities)
-                    
-                    # Add to assigned tracking
-                    assigned_activity_ids.append(activity["activity_id"])
-                    assigned_activity_types.append(selected_type)
-                    
-                    # For future days, check if there's any record of completion
-                    completed = False
-                    if is_past or is_today:
-                        completed_activity = activities_collection.find_one({
-                            "teacher_email": teacher_email,
-                            "date_str": day_str,
-                            "status": "completed"
-                        })
-                        completed = bool(completed_activity)
-                    
-                    # Store this assignment in the activities collection for future reference
-                    if not is_past:  # Don't create assignments for past dates
-                        try:
-                            day_assignment = {
-                                "teacher_email": teacher_email,
-                                "class": class_level,
-                                "subject": subject,
-                                "activity_id": activity["activity_id"],
-                                "activity_type": activity["activity_type"],
-                                "activity_title": activity["activity_title"],
-                                "module_title": activity["module_title"],
-                                "assigned_date": day_date,
-                                "date_str": day_str,
-                                "status": "assigned",
-                                "completed": completed,
-                                "created_at": datetime.now()
-                            }
-                            activities_collection.update_one(
-                                {
-                                    "teacher_email": teacher_email,
-                                    "date_str": day_str,
-                                    "status": "assigned"
-                                },
-                                {"$setOnInsert": day_assignment},
-                                upsert=True
-                            )
-                        except Exception as e:
-                            logger.warning(f"Failed to store activity assignment for {day_str}: {e}")
-                    
-                    weekly_schedule.append({
-                        "day": day,
-                        "date": day_date,
-                        "date_str": day_str,
-                        "activity": activity,
-                        "is_past": is_past,
-                        "is_today": is_today,
-                        "completed": completed
-                    })
-            
+            weekly_schedule, new_assignments = plan_weekly_schedule(
+                teacher_email, class_level, subject, activities_by_type, context["activities"], context["today"]
+            )
         except Exception as e:
             logger.error(f"Error generating weekly days: {e}")
             return []
         
+        # Days precomputed by the nightly job are already stored, so this is usually skipped
+        if new_assignments:
+            try:
+                result = context["database"]["activities"].bulk_write(assignment_upserts(new_assignments), ordered=False)
+                context["activities"].extend(new_assignments[index] for index in result.upserted_ids)
+            except Exception as e:
+                logger.warning(f"Failed to store activity assignments for {teacher_email}: {e}")
+        
         return weekly_schedule
     
     except Exception as e:
         logger.error(f"Error generating weekly schedule: {e}")
         return []
 
+# Precompute the week's schedule for every teacher of one school; runs in a worker process
+def precompute_school_schedules(mongo_uri, database_name, school, today_str):
+    """
+    Plan and store the weekly schedule of each teacher in a school.
+
+    Opens its own MongoClient, since clients must not be shared across a
+    fork. Issues four reads (teachers, curricula, progress, activities)
+    and one bulk_write for the whole school.
+
+    Returns:
+        dict: school, teachers planned, assignments stored
+    """
+    today = datetime.strptime(today_str, "%Y-%m-%d").date()
+    start_of_week = today - timedelta(days=today.weekday())
+    end_of_week = start_of_week + timedelta(days=6)
+    
+    worker_client = MongoClient(mongo_uri, serverSelectionTimeoutMS=5000)
+    try:
+        database = worker_client[database_name]
+        teachers = list(database["users"].find(
+            {"role": "teacher", "school": school}, {"email": 1, "class": 1, "subject": 1}
+        ))
+        # Same defaults as teacher_dashboard
+        courses = {
+            teacher["email"]: (teacher.get("class") or "class9", teacher.get("subject") or "science")
+            for teacher in teachers
+        }
+        teacher_emails = list(courses)
+        
+        activities_by_course = {
+            (curriculum["class"], curriculum["subject"]): group_activities_by_type(curriculum)
+            for curriculum in database["curriculum"].find({})
+        }
+        progress_by_teacher = {
+            (progress["teacher_email"], progress["class"], progress["subject"]): progress
+            for progress in database["course_progress"].find({"teacher_email": {"$in": teacher_emails}})
+        }
+        week_activities = {}
+        for activity in database["activities"].find({
+            "teacher_email": {"$in": teacher_emails},
+            "date_str": {"$gte": start_of_week.strftime("%Y-%m-%d"), "$lte": end_of_week.strftime("%Y-%m-%d")}
+        }):
+            week_activities.setdefault(activity["teacher_email"], []).append(activity)
+        
+        planned = 0
+        assignments = []
+        for teacher_email, (class_level, subject) in courses.items():
+            course_activities = activities_by_course.get((class_level, subject))
+            if course_activities is None:
+                continue
+            # Teachers who never opened the course yet have nothing completed
+            progress = progress_by_teacher.get(
+                (teacher_email, class_level, subject), {"class": class_level, "subject": subject}
+            )
+            _, new_assignments = plan_weekly_schedule(
+                teacher_email, class_level, subject,
+                incomplete_activities_by_type(progress, course_activities),
+                week_activities.get(teacher_email, []), today
+            )
+            planned += 1
+            assignments.extend(new_assignments)
+        
+        stored = 0
+        if assignments:
+            stored = database["activities"].bulk_write(assignment_upserts(assignments), ordered=False).upserted_count
+        return {"school": school, "teachers": planned, "assignments": stored}
+    finally:
+        worker_client.close()
+
+# Precompute weekly schedules for every school across a process pool
+def precompute_weekly_schedules(today=None, processes=None, database=None):
+    """
+    Store the schedule of the week containing `today` (default: tomorrow) for
+    every teacher, so dashboard loads only read it. Schools are the unit of
+    work: one worker task and one bulk_write per school.
+
+    Returns:
+        dict: per-school results, totals and throughput in teachers per second
+    """
+    database = database if database is not None else db
+    today = today or (datetime.now() + timedelta(days=1)).date()
+    schools = [school for school in database["users"].distinct("school", {"role": "teacher"}) if school]
+    
+    started = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        results = list(executor.map(
+            precompute_school_schedules,
+            itertools.repeat(app.config['MONGO_URI']),
+            itertools.repeat(database.name),
+            schools,
+            itertools.repeat(today.strftime("%Y-%m-%d"))
+        ))
+    elapsed = time.perf_counter() - started
+    
+    teachers = sum(result["teachers"] for result in results)
+    summary = {
+        "schools": results,
+        "teachers": teachers,
+        "assignments": sum(result["assignments"] for result in results),
+        "seconds": elapsed,
+        "teachers_per_second": teachers / elapsed if elapsed else 0.0
+    }
+    logger.info(f"Precomputed schedules for {teachers} teachers in {len(results)} schools "
+                f"({summary['teachers_per_second']:.0f} teachers/s)")
+    return summary
+
+# Holiday calendar as a NumPy date array for the busday functions
+def holiday_calendar():
+    return np.array(app.config.get('SCHOOL_HOLIDAYS', []), dtype='datetime64[D]')
+
+# Cumulative working days (Monday-Friday, minus holidays) per day of a month, built once per
+# month and holiday list so a changed SCHOOL_HOLIDAYS is picked up
+@functools.lru_cache(maxsize=64)
+def working_day_table(year, month, holidays=()):
+    month_start = np.datetime64(f"{year:04d}-{month:02d}-01", 'D')
+    days = month_start + np.arange(calendar.monthrange(year, month)[1])
+    is_working_day = np.is_busday(days, holidays=np.array(holidays, dtype='datetime64[D]'))
+    return (0,) + tuple(int(total) for total in np.cumsum(is_working_day))
+
+# Count working days from the 1st of a month up to and including upto_day
+def count_working_days(year, month, upto_day):
+    return working_day_table(year, month, tuple(app.config.get('SCHOOL_HOLIDAYS', [])))[upto_day]
+
 # Calculate attendance percentage for a teacher for the current month
 def calculate_teacher_attendance(teacher_email):
+    current_date = datetime.now()
     try:
-        # Get current month and year
-        current_date = datetime.now()
-        current_month = current_date.month
-        current_year = current_date.year
-        
-        # Get the first and last day of the current month
-        last_day = calendar.monthrange(current_year, current_month)[1]
-        first_day_of_month = datetime(current_year, current_month, 1)
-        last_day_of_month = datetime(current_year, current_month, last_day)
-        
-        # First, check if we have monthly stats already calculated
-        monthly_stats = teacher_monthly_stats.find_one({
-            "teacher_email": teacher_email,
-            "year": current_year,
-            "month": current_month
-        })
-        
-        if monthly_stats and "days_present" in monthly_stats:
-            # Get total working days so far this month (exclude weekends)
-            today = current_date.day
-            working_days = 0
-            for day in range(1, today + 1):
-                day_date = datetime(current_year, current_month, day)
-                # Skip weekends (5 is Saturday, 6 is Sunday)
-                if day_date.weekday() not in [5, 6]:
-                    working_days += 1
-            
-            # Calculate attendance percentage
-            days_present = monthly_stats.get("days_present", 0)
-            if working_days > 0:
-                attendance_percentage = min(round((days_present / working_days) * 100), 100)
-            else:
-                attendance_percentage = 0
-                
-            return {
-                "percentage": attendance_percentage,
-                "days_present": days_present,
-                "working_days": working_days,
-                "month": current_date.strftime("%B")
-            }
-        
-        # If no monthly stats, calculate from daily attendance records
-        attendance_records = list(daily_attendance_collection.find({
-            "teacher_email": teacher_email,
-            "date": {
-                "$gte": first_day_of_month,
-                "$lte": last_day_of_month
+        # Days present come from the exact per-teacher rollup, maintained by record_daily_attendance
+        monthly_stats = teacher_monthly_stats.find_one(
+            {
+                "teacher_email": teacher_email,
+                "year": current_date.year,
+                "month": current_date.month
             },
-            "status": "present"
-        }))
-        
-        # Count distinct days with attendance
-        days_present = len(set(record.get("date_str") for record in attendance_records))
+            {"days_present": 1}
+        )
+        days_present = monthly_stats.get("days_present", 0) if monthly_stats else 0
         
         # Get total working days so far this month (exclude weekends)
-        today = current_date.day
-        working_days = 0
-        for day in range(1, today + 1):
-            day_date = datetime(current_year, current_month, day)
-            # Skip weekends (5 is Saturday, 6 is Sunday)
-            if day_date.weekday() not in [5, 6]:
-                working_days += 1
+        working_days = count_working_days(current_date.year, current_date.month, current_date.day)
         
         # Calculate attendance percentage
         if working_days > 0:
@@ -2116,49 +4908,185 @@ def calculate_teacher_attendance(teacher_email):
             "month": current_date.strftime("%B")
         }
 
+# Collect every number shown on the principal dashboard in a fixed number of queries
+def get_dashboard_aggregates(database=None):
+    """
+    Run the principal dashboard queries as a handful of $facet/$group pipelines.
+
+    The number of round-trips is independent of the number of teachers: one
+    find each on users and teacher_monthly_stats, plus one aggregate each on
+    school_daily_attendance, activities and course_progress. Attendance comes
+    from the rollups, never from raw daily_attendance records.
+    get_teacher_stats(), get_chart_data() and get_teacher_performance() shape
+    their results from the returned dict.
+
+    Args:
+        database: Database to query. Defaults to the application database.
+    """
+    database = database if database is not None else db
+
+    current_date = datetime.now()
+    today = current_date.date()
+    today_str = today.strftime("%Y-%m-%d")
+    month_start = datetime(current_date.year, current_date.month, 1)
+    week_start_str = (today - timedelta(days=6)).strftime("%Y-%m-%d")
+
+    teachers = list(database["users"].find(
+        {"role": "teacher"},
+        {"name": 1, "email": 1, "subject": 1, "class": 1}
+    ))
+
+    # Attendance: present teachers per day for the weekly chart, summed over schools
+    attendance_by_day = database["school_daily_attendance"].aggregate([
+        {"$match": {"date_str": {"$gte": week_start_str, "$lte": today_str}}},
+        {"$group": {"_id": "$date_str", "count": {"$sum": "$present_count"}}}
+    ])
+
+    # Attendance: present days per teacher this month
+    monthly_stats = database["teacher_monthly_stats"].find(
+        {"year": current_date.year, "month": current_date.month},
+        {"teacher_email": 1, "days_present": 1}
+    )
+
+    # Activities: completions this month, type distribution and last activity per teacher
+    activity_facets = next(database["activities"].aggregate([
+        {"$facet": {
+            "month_completed": [
+                {"$match": {"status": "completed", "completion_date": {"$gte": month_start}}},
+                {"$count": "count"}
+            ],
+            "by_type": [
+                {"$match": {"status": "completed"}},
+                {"$group": {"_id": "$activity_type", "count": {"$sum": 1}}}
+            ],
+            "last_activity": [
+                {"$group": {"_id": "$teacher_email", "last_active": {"$max": "$created_at"}}}
+            ],
+            "suspected_reuse": [
+                {"$match": {"suspected_reuse": True}},
+                {"$sort": {"created_at": -1}},
+                {"$limit": 20},
+                {"$project": {"teacher_name": 1, "teacher_email": 1, "subject": 1, "activity_type": 1,
+                              "date_str": 1, "reuse_matches": 1}}
+            ]
+        }}
+    ]), {"month_completed": [], "by_type": [], "last_activity": [], "suspected_reuse": []})
+
+    # Progress: most recently updated class-subject combination per teacher
+    latest_progress = database["course_progress"].aggregate([
+        {"$sort": {"updated_at": -1}},
+        {"$group": {"_id": "$teacher_email", "progress_percentage": {"$first": "$progress_percentage"}}}
+    ])
+
+    month_completed = activity_facets["month_completed"]
+    return {
+        "teachers": teachers,
+        "working_days": count_working_days(current_date.year, current_date.month, current_date.day),
+        "attendance_by_day": {row["_id"]: row["count"] for row in attendance_by_day},
+        "days_present": {row["teacher_email"]: row.get("days_present", 0) for row in monthly_stats},
+        "activities_this_month": month_completed[0]["count"] if month_completed else 0,
+        "activities_by_type": {row["_id"]: row["count"] for row in activity_facets["by_type"]},
+        "last_active": {row["_id"]: row["last_active"] for row in activity_facets["last_activity"]},
+        "suspected_reuse": activity_facets["suspected_reuse"],
+        "progress": {row["_id"]: row.get("progress_percentage", 0) for row in latest_progress}
+    }
+
+# Attendance percentage for one teacher from the dashboard aggregates
+def _aggregate_attendance_percentage(aggregates, teacher_email):
+    working_days = aggregates["working_days"]
+    if working_days <= 0:
+        return 0
+    days_present = aggregates["days_present"].get(teacher_email, 0)
+    return min(round((days_present / working_days) * 100), 100)
+
+# Evaluate attendance and progress thresholds for every teacher of a school in one pass
+def evaluate_school_thresholds(school, attendance_threshold, progress_threshold, database=None):
+    """
+    Batch version of the per-teacher attendance and progress checks.
+
+    Loads the school's teachers, their attendance rollups for the current month
+    and their course progress in three queries, then evaluates both thresholds
+    for all teachers at once with NumPy. Working days are counted with
+    numpy.busday_count against the configured holiday calendar.
+
+    Returns:
+        dict: teachers (list of user documents), attendance_percentage and
+        progress_percentage (arrays aligned with teachers), needs_warning
+        (boolean mask) and working_days
+    """
+    database = database if database is not None else db
+    current_date = datetime.now()
+    
+    teachers = list(database["users"].find(
+        {"school": school, "role": "teacher"},
+        {"email": 1, "name": 1, "class": 1, "subject": 1}
+    ))
+    teachers = [teacher for teacher in teachers if teacher.get("email")]
+    emails = [teacher["email"] for teacher in teachers]
+    position = {email: i for i, email in enumerate(emails)}
+    
+    # Present days for the month, scattered into an array aligned with the teacher list
+    days_present = np.zeros(len(teachers), dtype=np.int64)
+    for row in database["teacher_monthly_stats"].find(
+        {"school": school, "year": current_date.year, "month": current_date.month},
+        {"teacher_email": 1, "days_present": 1}
+    ):
+        i = position.get(row.get("teacher_email"))
+        if i is not None:
+            days_present[i] = row.get("days_present", 0)
+    
+    # Progress for each teacher's own class and subject; teachers without a record are at 0%
+    progress_percentage = np.zeros(len(teachers), dtype=np.float64)
+    assigned = {(teacher["email"], teacher.get("class", "class9"), teacher.get("subject", "science")) for teacher in teachers}
+    for row in database["course_progress"].find(
+        {"teacher_email": {"$in": emails}},
+        {"teacher_email": 1, "class": 1, "subject": 1, "progress_percentage": 1}
+    ):
+        if (row.get("teacher_email"), row.get("class"), row.get("subject")) in assigned:
+            progress_percentage[position[row["teacher_email"]]] = row.get("progress_percentage", 0)
+    
+    month_start = np.datetime64(current_date.strftime("%Y-%m-01"), 'D')
+    tomorrow = np.datetime64(current_date.strftime("%Y-%m-%d"), 'D') + 1
+    working_days = int(np.busday_count(month_start, tomorrow, holidays=holiday_calendar()))
+    
+    if working_days > 0:
+        attendance_percentage = np.minimum(np.round(days_present * 100 / working_days), 100)
+    else:
+        attendance_percentage = np.zeros(len(teachers))
+    
+    needs_warning = (attendance_percentage < attendance_threshold) | (progress_percentage < progress_threshold)
+    
+    return {
+        "teachers": teachers,
+        "attendance_percentage": attendance_percentage,
+        "progress_percentage": progress_percentage,
+        "needs_warning": needs_warning,
+        "working_days": working_days
+    }
+
 # Get teacher stats for principal dashboard
-def get_teacher_stats():
+def get_teacher_stats(aggregates=None):
     try:
-        # Get current date info
-        current_date = datetime.now()
-        today_str = current_date.strftime("%Y-%m-%d")
+        if aggregates is None:
+            aggregates = get_dashboard_aggregates()
         
-        # Count total teachers
-        total_count = users_collection.count_documents({"role": "teacher"})
-        
-        # Count teachers present today
-        present_today = daily_attendance_collection.count_documents({
-            "date_str": today_str,
-            "status": "present"
-        })
+        today_str = datetime.now().strftime("%Y-%m-%d")
+        teachers = aggregates["teachers"]
         
         # Calculate average attendance percentage across all teachers
-        # First, get all teachers
-        teachers = list(users_collection.find({"role": "teacher"}))
-        
         if teachers:
-            # Calculate attendance for each teacher
-            attendance_sum = 0
-            for teacher in teachers:
-                attendance_data = calculate_teacher_attendance(teacher["email"])
-                attendance_sum += attendance_data["percentage"]
-            
+            attendance_sum = sum(
+                _aggregate_attendance_percentage(aggregates, teacher["email"]) for teacher in teachers
+            )
             avg_attendance = round(attendance_sum / len(teachers))
         else:
             avg_attendance = 0
         
-        # Count total activities completed this month
-        month_start = datetime(current_date.year, current_date.month, 1)
-        total_activities = activities_collection.count_documents({
-            "status": "completed",
-            "completion_date": {"$gte": month_start}
-        })
-        
         return {
-            "total_count": total_count,
-            "present_today": present_today,
+            "total_count": len(teachers),
+            "present_today": aggregates["attendance_by_day"].get(today_str, 0),
             "avg_attendance": avg_attendance,
-            "total_activities": total_activities
+            "total_activities": aggregates["activities_this_month"]
         }
     
     except Exception as e:
@@ -2171,8 +5099,11 @@ def get_teacher_stats():
         }
 
 # Get chart data for principal dashboard
-def get_chart_data():
+def get_chart_data(aggregates=None):
     try:
+        if aggregates is None:
+            aggregates = get_dashboard_aggregates()
+        
         # Get the last 7 days for weekly attendance chart
         current_date = datetime.now().date()
         dates = []
@@ -2180,31 +5111,13 @@ def get_chart_data():
         
         for i in range(6, -1, -1):
             date = current_date - timedelta(days=i)
-            date_str = date.strftime("%Y-%m-%d")
             dates.append(date.strftime("%a"))
-            
-            # Count attendance for this day
-            count = daily_attendance_collection.count_documents({
-                "date_str": date_str,
-                "status": "present"
-            })
-            attendance_counts.append(count)
+            attendance_counts.append(aggregates["attendance_by_day"].get(date.strftime("%Y-%m-%d"), 0))
         
         # Get activity type distribution
-        activity_counts = {
-            "quiz": activities_collection.count_documents({"activity_type": "quiz", "status": "completed"}),
-            "video": activities_collection.count_documents({"activity_type": "video", "status": "completed"}),
-            "interactive": activities_collection.count_documents({"activity_type": "interactive", "status": "completed"}),
-            "pdf": activities_collection.count_documents({"activity_type": "pdf", "status": "completed"}),
-            "discussion": activities_collection.count_documents({"activity_type": "discussion", "status": "completed"})
-        }
-        
         activity_types = [
-            activity_counts["quiz"],
-            activity_counts["video"],
-            activity_counts["interactive"],
-            activity_counts["pdf"],
-            activity_counts["discussion"]
+            aggregates["activities_by_type"].get(activity_type, 0)
+            for activity_type in ["quiz", "video", "interactive", "pdf", "discussion"]
         ]
         
         return {
@@ -2222,38 +5135,22 @@ def get_chart_data():
         }
 
 # Get teacher list with performance metrics for principal dashboard
-def get_teacher_performance():
+def get_teacher_performance(aggregates=None):
     try:
-        teachers = list(users_collection.find({"role": "teacher"}))
-        teacher_performance = []
+        if aggregates is None:
+            aggregates = get_dashboard_aggregates()
         
-        for teacher in teachers:
-            # Get attendance percentage
-            attendance_data = calculate_teacher_attendance(teacher["email"])
-            
-            # Get progress percentage (use most recent class-subject combination if multiple)
-            progress = course_progress_collection.find_one(
-                {"teacher_email": teacher["email"]},
-                sort=[("updated_at", -1)]
-            )
-            
-            # Get last active timestamp
-            last_activity = activities_collection.find_one(
-                {"teacher_email": teacher["email"]},
-                sort=[("created_at", -1)]
-            )
-            
-            teacher_info = {
+        teacher_performance = []
+        for teacher in aggregates["teachers"]:
+            teacher_performance.append({
                 "name": teacher["name"],
                 "email": teacher["email"],
                 "subject": teacher.get("subject", ""),
-                "class": teacher.get("class", ""),
-                "attendance_percentage": attendance_data["percentage"],
-                "progress_percentage": progress["progress_percentage"] if progress else 0,
-                "last_active": last_activity["created_at"] if last_activity else None
-            }
-            
-            teacher_performance.append(teacher_info)
+                "class": teacher.get("class", ""),
+                "attendance_percentage": _aggregate_attendance_percentage(aggregates, teacher["email"]),
+                "progress_percentage": aggregates["progress"].get(teacher["email"], 0),
+                "last_active": aggregates["last_active"].get(teacher["email"])
+            })
         
         return teacher_performance
     
@@ -2288,20 +5185,24 @@ def principal_dashboard():
                     {"$set": {"school": "Test School"}}
                 )
         
+        # Run the dashboard aggregations once and share them
+        aggregates = get_dashboard_aggregates()
+        
         # Get teacher statistics
-        teacher_stats = get_teacher_stats()
+        teacher_stats = get_teacher_stats(aggregates)
         
         # Get chart data
-        chart_data = get_chart_data()
+        chart_data = get_chart_data(aggregates)
         
         # Get teacher performance metrics
-        teachers = get_teacher_performance()
+        teachers = get_teacher_performance(aggregates)
         
         return render_template(
             "principal_dashboard.html",
             teacher_stats=teacher_stats,
             chart_data=chart_data,
-            teachers=teachers
+            teachers=teachers,
+            suspected_reuse=aggregates["suspected_reuse"]
         )
     
     except Exception as e:
@@ -2311,7 +5212,8 @@ def principal_dashboard():
             error_message="We encountered an error loading your dashboard. Please try again later.",
             teacher_stats={"total_count": 0, "present_today": 0, "avg_attendance": 0, "total_activities": 0},
             chart_data={"weekly_dates": [], "attendance_counts": [], "activity_types": []},
-            teachers=[]
+            teachers=[],
+            suspected_reuse=[]
         )
 
 @app.route("/logout")
@@ -2341,14 +5243,6 @@ def add_teacher():
         if not all([name, email, password, school, teacher_id, subject, class_level]):
             return jsonify({"status": "fail", "message": "All fields are required"})
         
-        # Check if email already exists
-        if users_collection.find_one({"email": email}):
-            return jsonify({"status": "fail", "message": "Email already registered"})
-        
-        # Check if teacher ID already exists
-        if users_collection.find_one({"teacher_id": teacher_id}):
-            return jsonify({"status": "fail", "message": "Teacher ID already registered"})
-        
         # Hash the password
         hashed_password = generate_password_hash(password)
         
@@ -2364,12 +5258,16 @@ def add_teacher():
             "role": "teacher",
             "created_at": datetime.now(),
             "created_by": session.get("email"),
-            "ratings": [],
             "overall_rating": 0.0
         }
         
-        # Insert into database
-        result = users_collection.insert_one(teacher_data)
+        # Insert into database; the users indexes reject duplicate emails and teacher IDs
+        try:
+            result = users_collection.insert_one(teacher_data)
+        except DuplicateKeyError as e:
+            if duplicate_key_field(e) == "teacher_id":
+                return jsonify({"status": "fail", "message": "Teacher ID already registered"})
+            return jsonify({"status": "fail", "message": "Email already registered"})
         
         if result.inserted_id:
             logger.info(f"New teacher added: {email} by principal: {session.get('email')}")
@@ -2411,18 +5309,20 @@ def trigger_weekly_feedback():
         # Log the request
         logger.info("Received request to trigger weekly feedback calls")
         
-        # Schedule the feedback calls
+        # Queue the feedback campaign; calls are dialed in the background
         logger.info("Starting weekly feedback call process...")
-        result = schedule_weekly_feedback_calls()
+        campaign = schedule_weekly_feedback_calls()
         
-        if result:
-            logger.info("Weekly feedback calls completed successfully")
+        if campaign:
+            logger.info(f"Weekly feedback campaign {campaign['_id']} queued")
             return jsonify({
                 "status": "success", 
-                "message": "Weekly feedback calls scheduled successfully"
+                "message": "Weekly feedback calls scheduled successfully",
+                "campaign_id": campaign["_id"],
+                "total_calls": campaign["total_calls"]
             })
         else:
-            logger.error("Failed to complete weekly feedback calls")
+            logger.error("Failed to schedule weekly feedback calls")
             return jsonify({
                 "status": "fail", 
                 "message": "Failed to schedule feedback calls"
@@ -2492,6 +5392,31 @@ def teacher_rating_detail(email):
             error_message="Failed to load teacher rating details"
         )
 
+@app.route("/api/teacher_rating_history/<email>")
+def teacher_rating_history(email):
+    """API route for a teacher's ratings over time, optionally between ?from= and ?to= (YYYY-MM-DD)"""
+    if "email" not in session:
+        return jsonify({"status": "fail", "message": "Please login first"})
+    
+    # Principals can view any teacher, teachers can only view their own
+    if session.get("role") != "principal" and session.get("email") != email:
+        return jsonify({"status": "fail", "message": "Unauthorized access"})
+    
+    try:
+        start = datetime.strptime(request.args["from"], "%Y-%m-%d") if request.args.get("from") else None
+        end = datetime.strptime(request.args["to"], "%Y-%m-%d") + timedelta(days=1) if request.args.get("to") else None
+    except ValueError:
+        return jsonify({"status": "fail", "message": "Dates must be in YYYY-MM-DD format"})
+    
+    history = get_rating_history(email, start, end)
+    for entry in history:
+        entry["created_at"] = entry["created_at"].isoformat()
+    
+    return jsonify({
+        "status": "success",
+        "history": history
+    })
+
 @app.route("/api/send_warnings", methods=["POST"])
 def send_teacher_warnings():
     """API route to send warning messages to teachers with low attendance or progress"""
@@ -2509,74 +5434,37 @@ def send_teacher_warnings():
         school = session.get("school", "")
         logger.info(f"Looking for teachers in school: '{school}'")
         
-        # Debug the session data
-        logger.info(f"Principal session data: {session}")
-        
-        # Check if there are any teachers in the database at all
-        total_teachers = users_collection.count_documents({"role": "teacher"})
-        logger.info(f"Total teachers in database: {total_teachers}")
-        
-        # Check if there are teachers for this school specifically
-        school_teachers = users_collection.count_documents({"school": school, "role": "teacher"})
-        logger.info(f"Teachers for this school '{school}': {school_teachers}")
-        
-        teachers = list(users_collection.find({"school": school, "role": "teacher"}))
+        # Evaluate attendance and progress for the whole school at once
+        evaluation = evaluate_school_thresholds(school, attendance_threshold, progress_threshold)
+        teachers = evaluation["teachers"]
         
         if not teachers:
             return jsonify({"status": "fail", "message": "No teachers found for your school"})
             
         # Track counts for reporting
         total_teachers = len(teachers)
-        warnings_sent = 0
         
-        # For each teacher, check attendance and progress
-        for teacher in teachers:
-            teacher_email = teacher.get("email")
-            if not teacher_email:
-                continue
-                
-            # Calculate attendance
-            attendance_data = calculate_teacher_attendance(teacher_email)
-            attendance_percentage = attendance_data.get("monthly_percentage", 0)
-            
-            # Get progress
-            progress = get_or_initialize_progress(
-                teacher_email, 
-                teacher.get("class", "class9"),
-                teacher.get("subject", "science")
-            )
-            progress_percentage = progress.get("percentage", 0)
-            
-            # Check if warning needed
-            needs_warning = (attendance_percentage < attendance_threshold or 
-                            progress_percentage < progress_threshold)
-                            
-            if needs_warning:
-                # Create warning message
-                warning_data = {
-                    "teacher_email": teacher_email,
-                    "teacher_name": teacher.get("name", ""),
-                    "sent_by": session.get("name", "Principal"),
-                    "principal_email": session.get("email", ""),
-                    "message": message,
-                    "attendance_percentage": attendance_percentage,
-                    "progress_percentage": progress_percentage,
-                    "sent_at": datetime.now(),
-                    "read": False
-                }
-                
-                # Save to warnings collection (create if doesn't exist)
-                if "warnings" not in db.list_collection_names():
-                    db.create_collection("warnings")
-                
-                warnings_collection = db["warnings"]
-                warnings_collection.insert_one(warning_data)
-                
-                # Update count
-                warnings_sent += 1
-                
-                # Log the warning
-                logger.info(f"Warning sent to {teacher_email} by {session.get('email')}")
+        # Create a warning for each teacher below either threshold
+        sent_at = datetime.now()
+        warning_documents = []
+        for i in np.flatnonzero(evaluation["needs_warning"]):
+            teacher = teachers[i]
+            warning_documents.append({
+                "teacher_email": teacher["email"],
+                "teacher_name": teacher.get("name", ""),
+                "sent_by": session.get("name", "Principal"),
+                "principal_email": session.get("email", ""),
+                "message": message,
+                "attendance_percentage": int(evaluation["attendance_percentage"][i]),
+                "progress_percentage": int(evaluation["progress_percentage"][i]),
+                "sent_at": sent_at,
+                "read": False
+            })
+        
+        if warning_documents:
+            warnings_collection.insert_many(warning_documents)
+        warnings_sent = len(warning_documents)
+        logger.info(f"Warnings sent to {warnings_sent} of {total_teachers} teachers by {session.get('email')}")
         
         return jsonify({
             "status": "success", 
@@ -2694,94 +5582,32 @@ def trigger_selective_feedback():
             
         logger.info(f"Received request to trigger selective feedback calls for {len(teacher_emails)} teachers")
         
-        # Track successful calls
-        success_count = 0
-        failed_teachers = []
-        
-        # Process each teacher
-        for teacher_email in teacher_emails:
-            try:
-                # Get teacher details
-                teacher = users_collection.find_one({"email": teacher_email})
-                
-                if not teacher:
-                    logger.warning(f"Teacher not found: {teacher_email}")
-                    failed_teachers.append(teacher_email)
-                    continue
-                    
-                class_level = teacher.get("class")
-                subject = teacher.get("subject")
-                
-                if not class_level or not subject:
-                    logger.warning(f"Teacher {teacher_email} missing class or subject information")
-                    failed_teachers.append(teacher_email)
-                    continue
-                
-                logger.info(f"Processing selective feedback for: {teacher_email}, Class: {class_level}, Subject: {subject}")
-                
-                # Create a feedback request
-                feedback_request = {
-                    "_id": str(uuid.uuid4()),
-                    "teacher_email": teacher_email,
-                    "teacher_name": teacher.get("name", "Unknown Teacher"),
-                    "class": class_level,
-                    "subject": subject,
-                    "status": "scheduled",
-                    "created_at": datetime.now(),
-                    "ratings": {
-                        "1": 0,
-                        "2": 0,
-                        "3": 0,
-                        "4": 0,
-                        "5": 0
-                    },
-                    "average_rating": 0,
-                    "requested_by": session.get("email", "Unknown")
-                }
-                
-                # Insert the feedback request
-                result = feedback_ratings_collection.insert_one(feedback_request)
-                
-                if not result.inserted_id:
-                    logger.error(f"Failed to create feedback request for {teacher_email}")
-                    failed_teachers.append(teacher_email)
-                    continue
-                
-                # Get the feedback ID
-                feedback_id = result.inserted_id
-                logger.info(f"Created selective feedback request with ID: {feedback_id}")
-                
-                # Simulate student feedback with the specified number of students
-                sim_result = simulate_student_feedback(feedback_id, students_per_teacher)
-                
-                if sim_result:
-                    success_count += 1
-                    logger.info(f"Successfully scheduled and simulated feedback for {teacher_email}")
-                else:
-                    logger.error(f"Failed to simulate feedback for {teacher_email}")
-                    failed_teachers.append(teacher_email)
-            
-            except Exception as e:
-                logger.error(f"Error processing teacher {teacher_email}: {e}")
-                failed_teachers.append(teacher_email)
+        # Queue the campaign; calls are dialed in the background
+        campaign = start_feedback_campaign(
+            teacher_emails,
+            students_per_teacher,
+            requested_by=session.get("email", "Unknown")
+        )
         
-        # Prepare the response
-        if success_count == len(teacher_emails):
-            return jsonify({
-                "status": "success",
-                "message": f"Successfully triggered IVR calls for all {success_count} teachers"
-            })
-        elif success_count > 0:
-            return jsonify({
-                "status": "success",
-                "message": f"Triggered IVR calls for {success_count} of {len(teacher_emails)} teachers. Failed for {len(failed_teachers)} teachers."
-            })
-        else:
+        if not campaign:
             return jsonify({
                 "status": "fail",
                 "message": "Failed to trigger IVR calls for any teachers"
             })
         
+        failed_teachers = campaign["skipped_teachers"]
+        if not failed_teachers:
+            message = f"Successfully triggered IVR calls for all {campaign['teacher_count']} teachers"
+        else:
+            message = (f"Triggered IVR calls for {campaign['teacher_count']} of {len(teacher_emails)} teachers. "
+                       f"Failed for {len(failed_teachers)} teachers.")
+        
+        return jsonify({
+            "status": "success",
+            "message": message,
+            "campaign_id": campaign["_id"]
+        })
+        
     except Exception as e:
         logger.error(f"Error triggering selective feedback: {e}")
         return jsonify({
@@ -2789,7 +5615,49 @@ def trigger_selective_feedback():
             "message": f"An error occurred: {str(e)}"
         })
 
+@app.route("/api/feedback_campaign/<campaign_id>")
+def feedback_campaign_status(campaign_id):
+    """API route to follow the progress of a feedback campaign"""
+    if "email" not in session or session.get("role") != "principal":
+        return jsonify({"status": "fail", "message": "Unauthorized access"})
+    
+    campaign = feedback_campaigns_collection.find_one({"_id": campaign_id})
+    if not campaign:
+        return jsonify({"status": "fail", "message": "Campaign not found"})
+    
+    return jsonify({
+        "status": "success",
+        "campaign": {
+            "campaign_id": campaign["_id"],
+            "state": campaign["status"],
+            "teacher_count": campaign["teacher_count"],
+            "total_calls": campaign["total_calls"],
+            "calls_dispatched": campaign["calls_dispatched"],
+            "calls_failed": campaign["calls_failed"],
+            "created_at": campaign["created_at"].isoformat(),
+            "completed_at": campaign["completed_at"].isoformat() if campaign.get("completed_at") else None
+        }
+    })
+
+# Accept a webhook only if Twilio signed it with TWILIO_AUTH_TOKEN; without a token none is accepted
+def twilio_signed(view):
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        # Twilio signs the URL it called; behind a TLS-terminating proxy this app sees plain http
+        url = request.url
+        forwarded_proto = request.headers.get("X-Forwarded-Proto")
+        if forwarded_proto:
+            url = urllib.parse.urlsplit(url)._replace(scheme=forwarded_proto.split(",")[0].strip()).geturl()
+        signature = request.headers.get("X-Twilio-Signature", "")
+        if not (app.config['TWILIO_AUTH_TOKEN'] and signature
+                and RequestValidator(app.config['TWILIO_AUTH_TOKEN']).validate(url, request.form, signature)):
+            logger.warning(f"Rejected {request.path} request without a valid Twilio signature")
+            return ("", 403)
+        return view(*args, **kwargs)
+    return wrapper
+
 @app.route("/ivr/callback", methods=["POST"])
+@twilio_signed
 def ivr_callback():
     """
     Handle Twilio IVR callback when a call is answered.
@@ -2802,6 +5670,7 @@ def ivr_callback():
         teacher = request.args.get('teacher', 'your teacher')
         class_name = request.args.get('class', 'your class')
         subject = request.args.get('subject', 'your subject')
+        call_id = request.args.get('call_id')
         
         # Create TwiML response
         response = VoiceResponse()
@@ -2817,7 +5686,8 @@ def ivr_callback():
         )
         
         # Gather the student's input
-        gather = Gather(num_digits=1, action="/ivr/process", method="POST", timeout=10)
+        action = url_with_query("/ivr/process", {"call_id": call_id})
+        gather = Gather(num_digits=1, action=action, method="POST", timeout=10)
         gather.say(
             "Press a number between 1 and 5 now.",
             voice="Polly.Joanna"
@@ -2838,6 +5708,7 @@ def ivr_callback():
         return str(response)
 
 @app.route("/ivr/process", methods=["POST"])
+@twilio_signed
 def ivr_process():
     """
     Process the input from the student's rating
@@ -2849,20 +5720,13 @@ def ivr_process():
         digit = request.form.get('Digits', '')
         call_sid = request.form.get('CallSid', '')
         
-        # Get call details from database
-        # Normally you'd store call_sid -> feedback_id mapping, but for simplicity
-        # we'll just use a placeholder response
-        
         response = VoiceResponse()
         
         # Check if valid rating
         if digit in ['1', '2', '3', '4', '5']:
-            # Store the rating in the database
-            # In a production app, you'd look up which feedback request this call belongs to
-            # and update that record
-            
-            # For now, we just log it
+            # Store the rating on the call's feedback request (safe if Twilio retries)
             logger.info(f"Received rating {digit} for call {call_sid}")
+            record_ivr_outcome(call_sid, digit, call_id=request.args.get('call_id'))
             
             # Thank the user
             response.say(
@@ -2886,26 +5750,334 @@ def ivr_process():
         response.hangup()
         return str(response)
 
+@app.route("/ivr/status", methods=["POST"])
+@twilio_signed
+def ivr_status():
+    """
+    Twilio status callback, sent when a call ends.
+    Calls that ended without a rating (busy, no answer, hung up) still count as finished.
+    """
+    try:
+        call_sid = request.form.get('CallSid', '')
+        call_status = request.form.get('CallStatus', '')
+        logger.info(f"Call {call_sid} ended with status {call_status}")
+        
+        # A call that was rated has already been recorded by /ivr/process
+        record_ivr_outcome(call_sid, None, call_status, call_id=request.args.get('call_id'))
+        return ("", 204)
+    
+    except Exception as e:
+        logger.error(f"Error in IVR status callback: {e}")
+        return ("", 500)
+
+# Admin endpoints such as /admin/profile need this token in an X-Admin-Token header; unset disables them
+app.config['ADMIN_TOKEN'] = os.environ.get('ADMIN_TOKEN', '')
+# Where profiler captures are written
+app.config['PROFILE_FOLDER'] = os.environ.get(
+    'PROFILE_FOLDER', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'profiles'))
+# Continuous profiling in every worker: sample one in PROFILE_ONE_IN requests (0 turns it off) of the
+# comma-separated PROFILE_ENDPOINTS (all when empty), writing a capture every PROFILE_FLUSH_SECONDS
+app.config['PROFILE_ONE_IN'] = int(os.environ.get('PROFILE_ONE_IN', '0'))
+app.config['PROFILE_ENDPOINTS'] = [
+    name.strip() for name in os.environ.get('PROFILE_ENDPOINTS', '').split(',') if name.strip()
+]
+app.config['PROFILE_FLUSH_SECONDS'] = int(os.environ.get('PROFILE_FLUSH_SECONDS', '300'))
+app.config['PROFILE_INTERVAL_MS'] = float(os.environ.get('PROFILE_INTERVAL_MS', '10'))
+
+class SamplingProfiler:
+    """
+    Statistical profiler for the requests of this process.
+
+    While a capture runs, a background thread wakes every interval and reads
+    the current stack of each thread that is handling a profiled request,
+    through sys._current_frames(). Other requests and threads are never
+    touched, and an unprofiled request only pays for a dictionary lookup.
+    Each sample's root frame is "cpu" when the thread used at least half
+    the interval of CPU time since the previous sample and "wait" otherwise,
+    so a flame graph separates Python work from time blocked on MongoDB,
+    storage or Twilio. Per-request wall and CPU totals are kept as well.
+
+    Captures are written to PROFILE_FOLDER as collapsed stacks ("frame;frame
+    count" lines, readable by flamegraph.pl and speedscope) with a JSON
+    summary beside them. A capture ends after its seconds or requests; one
+    with neither runs until stopped and writes a file every flush_seconds.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.capture = None
+        self._labels = {}
+    
+    def start(self, endpoints=(), seconds=None, max_requests=None, one_in=1, interval=0.01, flush_seconds=None):
+        """Start a capture; returns its description, or None if one is already running"""
+        with self._lock:
+            if self.capture is not None:
+                return None
+            now = time.time()
+            self.capture = {
+                "endpoints": set(endpoints),
+                "one_in": max(1, one_in),
+                "interval": interval,
+                "ends_at": now + seconds if seconds else None,
+                "max_requests": max_requests,
+                "flush_seconds": flush_seconds,
+                "started_at": now,
+                "stopping": False
+            }
+            self._reset_counts()
+            self.capture["thread"] = threading.Thread(target=self._run, args=(self.capture,),
+                                                      name="sampling-profiler", daemon=True)
+            self.capture["thread"].start()
+            return self.describe()
+    
+    def _reset_counts(self):
+        capture = self.capture
+        capture.update({"period_started_at": time.time(), "seen": 0, "requests": 0, "samples": 0,
+                        "wall_seconds": 0.0, "cpu_seconds": 0.0, "stacks": {}, "threads": {}})
+    
+    def describe(self):
+        capture = self.capture
+        if capture is None:
+            return None
+        return {
+            "pid": os.getpid(),
+            "endpoints": sorted(capture["endpoints"]) or "all",
+            "one_in": capture["one_in"],
+            "interval_ms": capture["interval"] * 1000,
+            "ends_at": datetime.fromtimestamp(capture["ends_at"]).isoformat() if capture["ends_at"] else None,
+            "max_requests": capture["max_requests"],
+            "requests": capture["requests"],
+            "samples": capture["samples"]
+        }
+    
+    def stop(self):
+        """End the running capture and write it; returns the files written"""
+        capture = self.capture
+        if capture is None:
+            return []
+        capture["stopping"] = True
+        capture["thread"].join()
+        return capture.get("files", [])
+    
+    # Called from before_request: whether this request is profiled
+    def request_started(self, endpoint):
+        capture = self.capture
+        if capture is None or capture["stopping"] or endpoint == "admin_profile":
+            return False
+        if capture["endpoints"] and endpoint not in capture["endpoints"]:
+            return False
+        with self._lock:
+            if capture is not self.capture:
+                return False
+            if capture["max_requests"] and capture["requests"] + len(capture["threads"]) >= capture["max_requests"]:
+                return False
+            capture["seen"] += 1
+            if capture["seen"] % capture["one_in"]:
+                return False
+            ident = threading.get_ident()
+            try:
+                clock = time.pthread_getcpuclockid(ident)
+                capture["threads"][ident] = [clock, time.clock_gettime(clock)]
+            except (AttributeError, OSError):
+                # No per-thread CPU clock on this platform: every sample counts as wall time
+                capture["threads"][ident] = [None, 0.0]
+        return True
+    
+    # Called when a profiled request ends
+    def request_finished(self, wall_seconds, cpu_seconds):
+        capture = self.capture
+        if capture is None:
+            return
+        with self._lock:
+            if capture["threads"].pop(threading.get_ident(), None) is not None:
+                capture["requests"] += 1
+                capture["wall_seconds"] += wall_seconds
+                capture["cpu_seconds"] += cpu_seconds
+    
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            label = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(";", ":")
+            self._labels[code] = label
+        return label
+    
+    def _sample(self, capture, frames, elapsed):
+        for ident, clock_state in list(capture["threads"].items()):
+            frame = frames.get(ident)
+            if frame is None:
+                continue
+            kind = "wall"
+            if clock_state[0] is not None:
+                try:
+                    cpu = time.clock_gettime(clock_state[0])
+                except OSError:
+                    continue
+                kind = "cpu" if cpu - clock_state[1] >= elapsed / 2 else "wait"
+                clock_state[1] = cpu
+            labels = []
+            while frame is not None:
+                labels.append(self._label(frame.f_code))
+                frame = frame.f_back
+            labels.append(kind)
+            stack = ";".join(reversed(labels))
+            capture["stacks"][stack] = capture["stacks"].get(stack, 0) + 1
+            capture["samples"] += 1
+    
+    def _run(self, capture):
+        last = time.perf_counter()
+        while True:
+            time.sleep(capture["interval"])
+            now = time.perf_counter()
+            with self._lock:
+                self._sample(capture, sys._current_frames(), now - last)
+            last = now
+            
+            finished = (capture["stopping"]
+                        or (capture["ends_at"] is not None and time.time() >= capture["ends_at"])
+                        or (capture["max_requests"] and capture["requests"] >= capture["max_requests"]))
+            if finished or (capture["flush_seconds"]
+                            and time.time() - capture["period_started_at"] >= capture["flush_seconds"]):
+                with self._lock:
+                    capture.setdefault("files", []).extend(self._write(capture))
+                    if finished:
+                        self.capture = None
+                        return
+                    self._reset_counts()
+    
+    def _write(self, capture):
+        if not capture["samples"]:
+            return []
+        folder = app.config['PROFILE_FOLDER']
+        os.makedirs(folder, exist_ok=True)
+        name = "-".join(sorted(capture["endpoints"])) or "all"
+        base = os.path.join(folder, f"{name}-{datetime.now().strftime('%Y%m%d-%H%M%S')}-{os.getpid()}")
+        with open(base + ".collapsed", "w") as file:
+            for stack, count in sorted(capture["stacks"].items()):
+                file.write(f"{stack} {count}\n")
+        summary = {
+            **self.describe(),
+            "started_at": datetime.fromtimestamp(capture["period_started_at"]).isoformat(),
+            "wall_seconds": round(capture["wall_seconds"], 3),
+            "cpu_seconds": round(capture["cpu_seconds"], 3),
+            # Wall time not spent on CPU: waiting for MongoDB, storage, Twilio or the GIL
+            "wait_seconds": round(capture["wall_seconds"] - capture["cpu_seconds"], 3),
+            "cpu_samples": sum(count for stack, count in capture["stacks"].items() if stack.startswith("cpu;")),
+            "wait_samples": sum(count for stack, count in capture["stacks"].items() if stack.startswith("wait;"))
+        }
+        with open(base + ".json", "w") as file:
+            json.dump(summary, file, indent=2)
+        logger.info(f"Profiler wrote {capture['samples']} samples of {capture['requests']} requests to {base}.collapsed")
+        return [base + ".collapsed", base + ".json"]
+
+sampling_profiler = SamplingProfiler()
+_continuous_profiling_pid = None
+
+# Profile the request if a capture wants it, starting continuous profiling in this worker on its first request
+@app.before_request
+def start_request_profile():
+    global _continuous_profiling_pid
+    if app.config['PROFILE_ONE_IN'] and _continuous_profiling_pid != os.getpid():
+        _continuous_profiling_pid = os.getpid()
+        sampling_profiler.start(app.config['PROFILE_ENDPOINTS'], one_in=app.config['PROFILE_ONE_IN'],
+                                interval=app.config['PROFILE_INTERVAL_MS'] / 1000,
+                                flush_seconds=app.config['PROFILE_FLUSH_SECONDS'])
+    if sampling_profiler.capture is not None and sampling_profiler.request_started(request.endpoint):
+        request.__dict__["profile_started"] = (time.perf_counter(), time.thread_time())
+
+@app.teardown_request
+def finish_request_profile(error=None):
+    started = request.__dict__.get("profile_started")
+    if started:
+        sampling_profiler.request_finished(time.perf_counter() - started[0], time.thread_time() - started[1])
+
+# Start, inspect or stop a profiler capture in the worker that serves this request
+@app.route("/admin/profile", methods=["GET", "POST", "DELETE"])
+def admin_profile():
+    if not app.config['ADMIN_TOKEN']:
+        return jsonify({"status": "fail", "message": "Admin endpoints are disabled; set ADMIN_TOKEN"}), 404
+    if not hmac.compare_digest(request.headers.get("X-Admin-Token", ""), app.config['ADMIN_TOKEN']):
+        logger.warning(f"Unauthorized profiler access from {request.remote_addr}")
+        return jsonify({"status": "fail", "message": "Unauthorized access"}), 403
+    
+    if request.method == "GET":
+        return jsonify({"status": "success", "capture": sampling_profiler.describe()})
+    if request.method == "DELETE":
+        files = sampling_profiler.stop()
+        return jsonify({"status": "success", "message": f"Profiler stopped, {len(files)} file(s) written", "files": files})
+    
+    data = request.get_json(silent=True) or request.form
+    try:
+        endpoints = [name.strip() for name in data.get("endpoint", "").split(",") if name.strip()]
+        seconds = float(data.get("seconds", 0 if data.get("requests") else 30))
+        max_requests = int(data.get("requests", 0)) or None
+        one_in = int(data.get("one_in", 1))
+        interval_ms = float(data.get("interval_ms", app.config['PROFILE_INTERVAL_MS']))
+    except (TypeError, ValueError):
+        return jsonify({"status": "fail", "message": "seconds, requests, one_in and interval_ms must be numbers"}), 400
+    unknown = [name for name in endpoints if name not in app.view_functions]
+    if unknown:
+        return jsonify({"status": "fail", "message": f"Unknown endpoint(s): {', '.join(unknown)}"}), 400
+    if not 1 <= interval_ms <= 1000 or seconds < 0 or one_in < 1:
+        return jsonify({"status": "fail", "message": "interval_ms must be 1-1000, seconds >= 0 and one_in >= 1"}), 400
+    
+    # Neither seconds nor requests: profile continuously until stopped, writing a file every flush period
+    flush_seconds = None if seconds or max_requests else app.config['PROFILE_FLUSH_SECONDS']
+    capture = sampling_profiler.start(endpoints, seconds or None, max_requests, one_in, interval_ms / 1000, flush_seconds)
+    if capture is None:
+        return jsonify({"status": "fail", "message": "A capture is already running in this process",
+                        "capture": sampling_profiler.describe()}), 409
+    logger.info(f"Profiler started by {request.remote_addr}: {capture}")
+    return jsonify({"status": "success", "message": f"Profiling in process {os.getpid()}", "capture": capture})
+
+# Prometheus metrics of every worker; restrict access to it at the proxy
+@app.route("/metrics")
+def metrics_endpoint():
+    if metrics is None:
+        return jsonify({"status": "fail", "message": "Metrics are disabled; install prometheus_client to enable them"}), 404
+    return (prometheus_client.generate_latest(metrics_registry()), 200,
+            {"Content-Type": prometheus_client.CONTENT_TYPE_LATEST})
+
+# Liveness: the process is serving requests. Reports the database health without touching it.
+@app.route("/healthz")
+def healthz():
+    return jsonify({"status": "success", "database": health_monitor.snapshot()})
+
+# Readiness: a writable server answered heartbeats recently and its connection pool is not saturated
+@app.route("/readyz")
+def readyz():
+    # Creates this worker's client if no request has yet, so its monitors start heartbeating
+    topology_description = mongo_connection.client().topology_description
+    snapshot = health_monitor.snapshot(topology_description)
+    reasons = HealthMonitor.not_ready_reasons(snapshot, app.config['HEALTH_HEARTBEAT_STALE_SECONDS'],
+                                              app.config['HEALTH_MAX_POOL_SATURATION'])
+    if reasons:
+        return jsonify({"status": "fail", "message": "; ".join(reasons), "database": snapshot}), 503
+    return jsonify({"status": "success", "database": snapshot})
+
 # Simulated Twilio IVR Call Client for development/testing
 class SimulatedTwilioClient:
     """
     A simulated Twilio client for demo purposes.
     In a real application, you would use the actual Twilio client with your Twilio credentials.
     """
-    def __init__(self):
+    def __init__(self, latency=0.0):
         # These would be real Twilio credentials in production
         self.account_sid = "TWILIO_ACCOUNT_SID_PLACEHOLDER"
         self.auth_token = "TWILIO_AUTH_TOKEN_PLACEHOLDER"
         self.from_number = "+15555555555"  # Your Twilio phone number
+        # Seconds each simulated REST call blocks for, to mimic Twilio round-trips in benchmarks
+        self.latency = latency
         logger.info("Initialized simulated Twilio client")
         
-    def make_ivr_call(self, to_number, teacher_name, class_name, subject, callback_url):
+    def make_ivr_call(self, to_number, teacher_name, class_name, subject, callback_url, call_id=None):
         """
         Simulate making an IVR call to a student
         In a real application, this would make an actual Twilio call
         """
         try:
             logger.info(f"SIMULATED: Making IVR call to {to_number} for feedback on {teacher_name}'s {subject} class")
+            if self.latency:
+                time.sleep(self.latency)
             
             # For simulation, we'll just return success
             return {
@@ -2941,6 +6113,853 @@ class SimulatedTwilioClient:
         logger.info(f"SIMULATED: Student pressed {response} for call {call_sid}")
         return str(response)
 
+# Application factory for WSGI servers, e.g. gunicorn "edupulse_app:create_app()".
+# Importing the module neither connects to MongoDB nor touches the disk: each worker
+# creates its MongoDB client, curriculum store and photo hash index on first use,
+# after the server has forked. Seed a new database with `flask db seed`.
+def create_app(config=None):
+    if config:
+        app.config.update(config)
+        # Settings such as MONGO_URI or PHOTO_STORAGE may have changed
+        mongo_connection.reset()
+        photo_storage.reset()
+    return app
+
+# Command-line tools, run with `flask --app edupulse_app <group> <command>`
+db_cli = AppGroup("db", help="Database maintenance and migrations.")
+app.cli.add_command(db_cli)
+jobs_cli = AppGroup("jobs", help="Background jobs.")
+app.cli.add_command(jobs_cli)
+bench_cli = AppGroup("bench", help="Performance benchmarks that run against a scratch database.")
+app.cli.add_command(bench_cli)
+
+@jobs_cli.command("resume-campaigns")
+def resume_campaigns_command():
+    """Finish IVR feedback campaigns whose runner stopped, e.g. after a crash."""
+    resumed = resume_feedback_campaigns()
+    click.echo(f"Resumed {len(resumed)} campaign(s)")
+
+@jobs_cli.command("migrate-photos")
+def migrate_photos_command():
+    """Move photos saved under uploads/<date>/ into the content-addressed blob store."""
+    report = migrate_legacy_photos()
+    click.echo(f"Moved {report['photos']} photo(s) of {report['activities']} activit(ies) into the blob store, "
+               f"{report['missing']} file(s) missing")
+
+@jobs_cli.command("render-photos")
+def render_photos_command():
+    """Create renditions for stored photos that have none, such as those moved in by migrate-photos."""
+    digests = [blob["_id"] for blob in photo_blobs_collection.find({"renditions": {"$exists": False}}, {"_id": 1})]
+    results = create_photo_renditions({}, digests)
+    rendered = sum(result is not None for result in results.values())
+    click.echo(f"Rendered {rendered} of {len(digests)} photo(s) without renditions")
+
+@jobs_cli.command("process-pending-photos")
+@click.option("--older-than-minutes", default=10, show_default=True,
+              help="Only pick up activities submitted at least this long ago, so running workers are left alone.")
+def process_pending_photos_command(older_than_minutes):
+    """Finish photo processing left behind by a restart or a failed worker."""
+    result = process_pending_photos(older_than_minutes)
+    click.echo(f"Processed photos of {result['processed']} activit(ies), {result['failed']} failed")
+
+@jobs_cli.command("delete-activity-photos")
+@click.argument("activity_id")
+def delete_activity_photos_command(activity_id):
+    """Remove the photos of one activity; stored photos no other activity uses are swept later."""
+    try:
+        activity_id = ObjectId(activity_id)
+    except Exception:
+        raise click.BadParameter("expected an activity ObjectId", param_hint="ACTIVITY_ID")
+    click.echo(f"Removed {delete_activity_photos(activity_id)} photo(s) from activity {activity_id}")
+
+@jobs_cli.command("sweep-photos")
+@click.option("--grace-hours", default=24, show_default=True,
+              help="Only delete photos that have had no references for at least this long.")
+def sweep_photos_command(grace_hours):
+    """Delete stored photos and renditions that no activity references any more."""
+    report = sweep_photo_blobs(grace_hours)
+    click.echo(f"Deleted {report['deleted']} photo(s); kept {report['still_referenced']} still listed by an activity")
+
+@jobs_cli.command("precompute-schedules")
+@click.option("--date", "date_str", default=None, metavar="YYYY-MM-DD",
+              help="Plan the week containing this day from this day on. Defaults to tomorrow.")
+@click.option("--processes", default=None, type=int, help="Worker processes. Defaults to the CPU count.")
+def precompute_schedules_command(date_str, processes):
+    """Store this week's activity schedule for every teacher ahead of their first dashboard load."""
+    today = None
+    if date_str:
+        try:
+            today = datetime.strptime(date_str, "%Y-%m-%d").date()
+        except ValueError:
+            raise click.BadParameter("expected YYYY-MM-DD", param_hint="--date")
+    summary = precompute_weekly_schedules(today=today, processes=processes)
+    click.echo(f"Planned {summary['teachers']} teacher(s) in {len(summary['schools'])} school(s), "
+               f"stored {summary['assignments']} assignment(s) in {summary['seconds']:.2f}s "
+               f"({summary['teachers_per_second']:.0f} teachers/s)")
+
+@db_cli.command("ensure-indexes")
+@click.option("--force", is_flag=True, help="Re-apply the manifest even if this version is recorded as applied.")
+def ensure_indexes_command(force):
+    """Create the indexes in INDEX_MANIFEST. Run once per deploy."""
+    report = ensure_indexes(force=force)
+    for collection_name, names in report["created"].items():
+        click.echo(f"{collection_name}: {', '.join(names)}")
+    for collection_name, error in report["errors"].items():
+        click.echo(f"{collection_name}: FAILED - {error}", err=True)
+    if report["missing"]:
+        click.echo(f"Collections without any expected index: {', '.join(report['missing'])}", err=True)
+    if report["errors"] or report["missing"]:
+        raise SystemExit(1)
+    click.echo(f"Index manifest version {report['version']} is in place")
+
+@db_cli.command("migrate-rating-stats")
+def migrate_rating_stats_command():
+    """Fold legacy ratings arrays into running rating statistics."""
+    result = migrate_rating_stats()
+    click.echo(f"Migrated {result['teachers']} teacher(s), added {result['history']} rating history entries")
+
+@db_cli.command("rebuild-attendance-rollups")
+@click.option("--month", "month_str", default=None, metavar="YYYY-MM",
+              help="Only rebuild this month. Rebuilds every month when omitted.")
+def rebuild_attendance_rollups_command(month_str):
+    """Backfill or repair the attendance rollups from daily_attendance."""
+    year = month = None
+    if month_str:
+        try:
+            year, month = (int(part) for part in month_str.split("-"))
+        except ValueError:
+            raise click.BadParameter("expected YYYY-MM", param_hint="--month")
+    result = rebuild_attendance_rollups(year=year, month=month)
+    click.echo(f"Rebuilt {result['teacher_months']} teacher-month and {result['school_days']} school-day rollups")
+
+@db_cli.command("bump-curriculum-version")
+def bump_curriculum_version_command():
+    """Make every running process reload its curriculum store after a curriculum edit."""
+    version = bump_curriculum_version()
+    click.echo(f"Curriculum version is now {version}; processes reload within {app.config['CURRICULUM_POLL_SECONDS']:g}s")
+
+@db_cli.command("seed")
+@click.option("--test-users", is_flag=True, help="Also create the test principal and teachers for development.")
+def seed_command(test_users):
+    """Add the curricula missing from the database, and optionally the test accounts."""
+    initialize_curriculum()
+    if test_users:
+        create_test_users()
+    click.echo(f"{curriculum_collection.count_documents({})} curricula in {app.config['MONGO_DB_NAME']}")
+
+class CommandCounter(monitoring.CommandListener):
+    """
+    Count the MongoDB commands sent by a client and their total server time.
+    Register it with MongoClient(event_listeners=[...]) to measure round-trips.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.count = 0
+            self.duration_micros = 0
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        with self._lock:
+            self.count += 1
+            self.duration_micros += event.duration_micros
+
+    def failed(self, event):
+        with self._lock:
+            self.count += 1
+            self.duration_micros += event.duration_micros
+
+# Open a scratch database with a command counter attached, refusing to touch the live database
+def open_benchmark_database(database_name):
+    if database_name == app.config['MONGO_DB_NAME']:
+        raise click.UsageError("Benchmarks drop their collections; choose a database other than the application database")
+    counter = CommandCounter()
+    bench_client = MongoClient(app.config['MONGO_URI'], serverSelectionTimeoutMS=5000, event_listeners=[counter])
+    return bench_client, bench_client[database_name], counter
+
+# Fill a scratch database with teachers, attendance, activities and progress for the current month
+def seed_dashboard_benchmark(database, teacher_count):
+    for name in ["users", "daily_attendance", "activities", "course_progress",
+                 "teacher_monthly_stats", "school_daily_attendance"]:
+        database[name].drop()
+    
+    current_date = datetime.now()
+    rng = random.Random(teacher_count)
+    teachers, attendance, activities, progress = [], [], [], []
+    for i in range(teacher_count):
+        email = f"bench.teacher{i}@example.com"
+        teachers.append({
+            "name": f"Bench Teacher {i}",
+            "email": email,
+            "school": "Bench School",
+            "teacher_id": f"BENCH{i:05d}",
+            "subject": "science",
+            "class": "class9",
+            "role": "teacher",
+            "created_at": current_date
+        })
+        for day in range(1, current_date.day + 1):
+            if rng.random() < 0.8:
+                day_date = datetime(current_date.year, current_date.month, day, 9)
+                attendance.append({
+                    "teacher_email": email,
+                    "school": "Bench School",
+                    "date": day_date,
+                    "date_str": day_date.strftime("%Y-%m-%d"),
+                    "status": "present",
+                    "created_at": day_date
+                })
+                activities.append({
+                    "teacher_email": email,
+                    "school": "Bench School",
+                    "activity_type": rng.choice(list(ACTIVITY_TYPES)),
+                    "completion_date": day_date,
+                    "date_str": day_date.strftime("%Y-%m-%d"),
+                    "status": "completed",
+                    "created_at": day_date
+                })
+        progress.append({
+            "teacher_email": email,
+            "class": "class9",
+            "subject": "science",
+            "progress_percentage": rng.randint(0, 100),
+            "updated_at": current_date
+        })
+    
+    for name, documents in [("users", teachers), ("daily_attendance", attendance),
+                            ("activities", activities), ("course_progress", progress)]:
+        if documents:
+            database[name].insert_many(documents)
+    rebuild_attendance_rollups(database)
+
+@bench_cli.command("dashboard")
+@click.option("--teachers", "teacher_counts", default="100,200,400,800", show_default=True,
+              help="Comma-separated teacher counts to benchmark.")
+@click.option("--repeat", default=5, show_default=True, help="Timed runs per teacher count.")
+@click.option("--database", "database_name", default="edupulse_bench", show_default=True)
+def bench_dashboard(teacher_counts, repeat, database_name):
+    """Query count and latency of the principal dashboard aggregations as teachers grow."""
+    bench_client, database, counter = open_benchmark_database(database_name)
+    try:
+        click.echo(f"{'teachers':>10} {'queries':>8} {'mean ms':>10} {'best ms':>10}")
+        for teacher_count in [int(n) for n in teacher_counts.split(",")]:
+            seed_dashboard_benchmark(database, teacher_count)
+            timings = []
+            for _ in range(repeat):
+                counter.reset()
+                started = time.perf_counter()
+                aggregates = get_dashboard_aggregates(database)
+                get_teacher_stats(aggregates)
+                get_chart_data(aggregates)
+                get_teacher_performance(aggregates)
+                timings.append((time.perf_counter() - started) * 1000)
+            click.echo(f"{teacher_count:>10} {counter.count:>8} {sum(timings) / len(timings):>10.1f} {min(timings):>10.1f}")
+    finally:
+        bench_client.close()
+
+# The per-teacher threshold loop that evaluate_school_thresholds() replaced, kept for comparison
+def _per_teacher_thresholds(database, school, attendance_threshold, progress_threshold):
+    current_date = datetime.now()
+    working_days = count_working_days(current_date.year, current_date.month, current_date.day)
+    flagged = 0
+    for teacher in database["users"].find({"school": school, "role": "teacher"}):
+        stats = database["teacher_monthly_stats"].find_one(
+            {"teacher_email": teacher["email"], "year": current_date.year, "month": current_date.month}
+        )
+        days_present = stats.get("days_present", 0) if stats else 0
+        attendance_percentage = min(round((days_present / working_days) * 100), 100) if working_days else 0
+        progress = database["course_progress"].find_one(
+            {"teacher_email": teacher["email"], "class": teacher.get("class"), "subject": teacher.get("subject")}
+        )
+        progress_percentage = progress.get("progress_percentage", 0) if progress else 0
+        if attendance_percentage < attendance_threshold or progress_percentage < progress_threshold:
+            flagged += 1
+    return flagged
+
+@bench_cli.command("thresholds")
+@click.option("--teachers", "teacher_counts", default="1000,10000", show_default=True,
+              help="Comma-separated teacher counts to benchmark.")
+@click.option("--database", "database_name", default="edupulse_bench", show_default=True)
+def bench_thresholds(teacher_counts, database_name):
+    """Per-teacher threshold loop versus the vectorized school evaluator."""
+    bench_client, database, counter = open_benchmark_database(database_name)
+    try:
+        click.echo(f"{'teachers':>10} {'loop ms':>10} {'loop q':>8} {'batch ms':>10} {'batch q':>8} {'speedup':>8}")
+        for teacher_count in [int(n) for n in teacher_counts.split(",")]:
+            seed_dashboard_benchmark(database, teacher_count)
+            
+            counter.reset()
+            started = time.perf_counter()
+            loop_flagged = _per_teacher_thresholds(database, "Bench School", 75, 60)
+            loop_ms = (time.perf_counter() - started) * 1000
+            loop_queries = counter.count
+            
+            counter.reset()
+            started = time.perf_counter()
+            evaluation = evaluate_school_thresholds("Bench School", 75, 60, database)
+            batch_ms = (time.perf_counter() - started) * 1000
+            batch_queries = counter.count
+            
+            if int(evaluation["needs_warning"].sum()) != loop_flagged:
+                click.echo(f"Mismatch: loop flagged {loop_flagged}, batch flagged {int(evaluation['needs_warning'].sum())}", err=True)
+            click.echo(f"{teacher_count:>10} {loop_ms:>10.1f} {loop_queries:>8} {batch_ms:>10.1f} {batch_queries:>8} {loop_ms / batch_ms:>7.1f}x")
+    finally:
+        bench_client.close()
+
+@bench_cli.command("campaign")
+@click.option("--teachers", "teacher_count", default=10, show_default=True)
+@click.option("--students", "students_per_teacher", default=20, show_default=True)
+@click.option("--latency", default=0.2, show_default=True, help="Seconds per simulated Twilio REST call.")
+@click.option("--concurrency", "concurrency_levels", default="1,4,16", show_default=True,
+              help="Comma-separated per-account concurrency limits to compare.")
+@click.option("--cps", default=0.0, show_default=True, help="Calls-per-second limit, 0 for unlimited.")
+@click.option("--database", "database_name", default="edupulse_bench", show_default=True)
+def bench_campaign(teacher_count, students_per_teacher, latency, concurrency_levels, cps, database_name):
+    """Wall time of an IVR campaign against the simulated client with injected latency."""
+    bench_client, database, counter = open_benchmark_database(database_name)
+    saved_limits = (app.config['CAMPAIGN_MAX_CONCURRENCY'], app.config['CAMPAIGN_CALLS_PER_SECOND'])
+    try:
+        click.echo(f"{'concurrency':>12} {'calls':>8} {'seconds':>10} {'calls/s':>10}")
+        for concurrency in [int(n) for n in concurrency_levels.split(",")]:
+            seed_dashboard_benchmark(database, teacher_count)
+            for name in ["feedback_ratings", "feedback_campaigns", "campaign_calls", "call_records",
+                         "twilio_accounts"]:
+                database[name].drop()
+            app.config['CAMPAIGN_MAX_CONCURRENCY'] = concurrency
+            app.config['CAMPAIGN_CALLS_PER_SECOND'] = cps
+            
+            campaign = start_feedback_campaign(students_per_teacher=students_per_teacher,
+                                               database=database, background=False)
+            started = time.perf_counter()
+            finished = run_feedback_campaign(campaign["_id"], SimulatedTwilioClient(latency=latency), database)
+            elapsed = time.perf_counter() - started
+            click.echo(f"{concurrency:>12} {finished['calls_dispatched']:>8} {elapsed:>10.2f} {finished['calls_dispatched'] / elapsed:>10.1f}")
+    finally:
+        app.config['CAMPAIGN_MAX_CONCURRENCY'], app.config['CAMPAIGN_CALLS_PER_SECOND'] = saved_limits
+        bench_client.close()
+
+@bench_cli.command("completions")
+@click.option("--threads", default=32, show_default=True)
+@click.option("--rounds", default=20, show_default=True, help="Fresh progress documents to race on.")
+@click.option("--compact", is_flag=True, help="Race on compact bitset progress documents.")
+@click.option("--database", "database_name", default="edupulse_bench", show_default=True)
+def bench_completions(threads, rounds, compact, database_name):
+    """Fire parallel activity completions and check that none are lost or double-counted."""
+    bench_client, database, counter = open_benchmark_database(database_name)
+    try:
+        course_progress = database["course_progress"]
+        course_progress.drop()
+        failures = 0
+        started = time.perf_counter()
+        for round_number in range(rounds):
+            teacher_email = f"bench.race{round_number}@example.com"
+            modules_progress = [
+                {
+                    "module_id": module_id,
+                    "title": f"Module {module_id}",
+                    "activities": [
+                        {"activity_id": (module_id - 1) * 4 + i, "type": "quiz", "title": f"Activity {i}",
+                         "completed": False, "completion_date": None}
+                        for i in range(1, 5)
+                    ],
+                    "completed_activities": 0,
+                    "total_activities": 4
+                }
+                for module_id in range(1, 6)
+            ]
+            progress_document = {
+                "teacher_email": teacher_email,
+                "class": "class9",
+                "subject": "science",
+                "completed_activities": 0,
+                "total_activities": 20,
+                "progress_percentage": 0
+            }
+            if compact:
+                progress_document.update({"format": "bitset", "completed_bits": Int64(0), "completion_dates": {}})
+            else:
+                progress_document["modules_progress"] = modules_progress
+            course_progress.insert_one(progress_document)
+            
+            # Every activity is completed twice, concurrently; exactly one of each pair may succeed
+            activity_ids = list(range(1, 21)) * 2
+            random.shuffle(activity_ids)
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                results = list(executor.map(
+                    lambda activity_id: mark_activity_completed(teacher_email, "class9", "science", activity_id, database),
+                    activity_ids
+                ))
+            
+            progress = course_progress.find_one({"teacher_email": teacher_email})
+            if compact:
+                flags_set = bin(progress["completed_bits"]).count("1")
+                module_counts = [bin(progress["completed_bits"] >> (module_id - 1) * 4 + 1 & 0b1111).count("1")
+                                 for module_id in range(1, 6)]
+            else:
+                flags_set = sum(activity["completed"] for module in progress["modules_progress"] for activity in module["activities"])
+                module_counts = [module["completed_activities"] for module in progress["modules_progress"]]
+            if (sum(results) != 20 or flags_set != 20 or progress["completed_activities"] != 20
+                    or module_counts != [4] * 5 or progress["progress_percentage"] != 100):
+                failures += 1
+                click.echo(f"Round {round_number}: {sum(results)} successes, {flags_set} flags, "
+                           f"counters {progress['completed_activities']} {module_counts}, {progress['progress_percentage']}%", err=True)
+        
+        elapsed = time.perf_counter() - started
+        click.echo(f"{rounds * 40} completions from {threads} threads in {elapsed:.2f}s, {failures} inconsistent round(s)")
+        if failures:
+            raise SystemExit(1)
+    finally:
+        bench_client.close()
+
+@bench_cli.command("schedule-determinism")
+@click.option("--threads", default=32, show_default=True)
+@click.option("--teachers", default=50, show_default=True)
+@click.option("--database", "database_name", default="edupulse_bench", show_default=True)
+def bench_schedule_determinism(threads, teachers, database_name):
+    """Build every teacher's daily activity and weekly schedule from many threads and compare the picks."""
+    curriculum = get_curriculum("class9", "science")
+    if not curriculum:
+        raise click.ClickException("No curriculum for class9 science; start the app once to initialize it")
+    
+    bench_client, database, counter = open_benchmark_database(database_name)
+    try:
+        for name in ["course_progress", "activities"]:
+            database[name].drop()
+        
+        rng = random.Random(teachers)
+        activity_ids = [activity["activity_id"] for module in curriculum["modules"] for activity in module["activities"]]
+        teacher_emails = [f"bench.schedule{index}@example.com" for index in range(teachers)]
+        for teacher_email in teacher_emails:
+            progress = build_progress_document(teacher_email, "Bench Teacher", "class9", "science", curriculum)
+            completed = set(rng.sample(activity_ids, rng.randint(0, len(activity_ids) - 5)))
+            for module in progress["modules_progress"]:
+                for activity in module["activities"]:
+                    activity["completed"] = activity["activity_id"] in completed
+            database["course_progress"].insert_one(progress)
+        
+        def render_all(thread_index):
+            order = teacher_emails.copy()
+            random.Random(thread_index).shuffle(order)
+            picks = {}
+            for teacher_email in order:
+                # Reseed the global RNG the way other request handlers may, which must not change any pick
+                random.seed(thread_index)
+                context = load_dashboard_context(teacher_email, "class9", "science", database=database)
+                daily = get_daily_activity(teacher_email, "class9", "science", context)
+                weekly = generate_weekly_schedule(teacher_email, "class9", "science", context)
+                picks[teacher_email] = (
+                    (daily.get("activity") or {}).get("activity_id"),
+                    tuple((day["date_str"], day["activity"]["activity_id"]) for day in weekly)
+                )
+            return picks
+        
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            results = list(executor.map(render_all, range(threads)))
+        elapsed = time.perf_counter() - started
+        
+        differing = [teacher_email for teacher_email in teacher_emails
+                     if len({result[teacher_email] for result in results}) > 1]
+        
+        # Every stored assignment for a teacher and day must name the same activity
+        conflicting = list(database["activities"].aggregate([
+            {"$match": {"status": "assigned"}},
+            {"$group": {"_id": {"teacher": "$teacher_email", "date": "$date_str"},
+                        "activity_ids": {"$addToSet": "$activity_id"}}},
+            {"$match": {"activity_ids.1": {"$exists": True}}}
+        ]))
+        
+        fingerprint = hashlib.blake2b(repr(sorted(results[0].items())).encode(), digest_size=8).hexdigest()
+        click.echo(f"{threads * teachers} dashboard renders from {threads} threads in {elapsed:.2f}s")
+        click.echo(f"{len(differing)} teacher(s) with differing picks, {len(conflicting)} conflicting assignment(s)")
+        click.echo(f"Pick fingerprint {fingerprint} (compare across runs and processes on the same day)")
+        if differing or conflicting:
+            raise SystemExit(1)
+    finally:
+        bench_client.close()
+
+@bench_cli.command("idempotency")
+@click.option("--replays", default=50, show_default=True)
+@click.option("--threads", default=8, show_default=True)
+@click.option("--database", "database_name", default="edupulse_bench", show_default=True)
+def bench_idempotency(replays, threads, database_name):
+    """Post one attendance submission repeatedly with the same idempotency key and check it is written exactly once."""
+    bench_client, database, counter = open_benchmark_database(database_name)
+    photo_folder = tempfile.mkdtemp(prefix="edupulse-bench-")
+    original_config = {key: app.config[key] for key in
+                       ("MONGO_DB_NAME", "UPLOAD_FOLDER", "UPLOAD_STAGING_FOLDER", "PHOTO_STORAGE")}
+    try:
+        for name in ["idempotency_keys", "daily_attendance", "activities", "teacher_monthly_stats",
+                     "subject_activity_stats", "school_daily_attendance", "photo_blobs"]:
+            database[name].drop()
+        database["idempotency_keys"].create_indexes(INDEX_MANIFEST["idempotency_keys"])
+        database["daily_attendance"].create_indexes(INDEX_MANIFEST["daily_attendance"])
+        # The application itself handles the requests, against the scratch database and photo folder
+        create_app({"MONGO_DB_NAME": database_name, "UPLOAD_FOLDER": photo_folder,
+                    "UPLOAD_STAGING_FOLDER": os.path.join(photo_folder, ".incoming"), "PHOTO_STORAGE": "local"})
+        
+        teacher = {"email": "bench.idempotency@example.com", "name": "Bench Teacher", "teacher_id": "BENCH-IDEM",
+                   "school": "Bench School", "subject": "science", "role": "teacher"}
+        
+        def replay(_):
+            client = app.test_client()
+            with client.session_transaction() as client_session:
+                client_session.update(teacher)
+                client_session["class"] = "class9"
+            while True:
+                response = client.post(
+                    "/mark_attendance",
+                    headers={"Idempotency-Key": "bench-key"},
+                    data={"subject": "science", "activity_type": "quiz",
+                          "activity_photos": [(io.BytesIO(b"bench photo"), "photo.jpg")]},
+                    content_type="multipart/form-data"
+                )
+                # A client backs off and retries while the first attempt is still running
+                if response.status_code != 409:
+                    return response.get_data(as_text=True), response.headers.get("Idempotent-Replayed")
+                time.sleep(0.01)
+        
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            responses = list(executor.map(replay, range(replays)))
+        # Let the queued photo processing finish; the process ends after the benchmark
+        photo_executor.shutdown(wait=True)
+        
+        monthly = database["teacher_monthly_stats"].find_one({"teacher_email": teacher["email"]}) or {}
+        checks = {
+            "handler runs": sum(1 for _, replayed in responses if not replayed),
+            "successful responses": len({body for body, _ in responses if json.loads(body)["status"] == "success"}),
+            "photos stored": database["photo_blobs"].count_documents({}),
+            "daily_attendance records": database["daily_attendance"].count_documents({}),
+            "activities records": database["activities"].count_documents({"photo_status": "ready"}),
+            "activities_completed": monthly.get("activities_completed", 0),
+            "days_present": monthly.get("days_present", 0),
+            "distinct responses": len({body for body, _ in responses})
+        }
+        for name, value in checks.items():
+            click.echo(f"{name:>25}: {value}")
+        staged_left = os.listdir(app.config['UPLOAD_STAGING_FOLDER'])
+        click.echo(f"{sum(1 for _, replayed in responses if replayed)} of {replays} responses were replays, "
+                   f"{len(staged_left)} staged upload(s) left behind")
+        if any(value != 1 for value in checks.values()) or staged_left:
+            raise SystemExit(1)
+    finally:
+        create_app(original_config)
+        shutil.rmtree(photo_folder, ignore_errors=True)
+        bench_client.close()
+
+@bench_cli.command("progress-format")
+@click.option("--documents", default=50000, show_default=True)
+@click.option("--class", "class_level", default="class9", show_default=True)
+@click.option("--subject", default="science", show_default=True)
+@click.option("--database", "database_name", default="edupulse_bench", show_default=True)
+def bench_progress_format(documents, class_level, subject, database_name):
+    """Compare the size of full and compact course progress documents."""
+    curriculum = get_curriculum(class_level, subject)
+    if not curriculum:
+        raise click.ClickException(f"No curriculum for {class_level} {subject}; start the app once to initialize it")
+    if not curriculum_fits_bitset(curriculum):
+        raise click.ClickException(f"Activity ids of {class_level} {subject} do not fit the compact format")
+    
+    activity_ids = [activity["activity_id"] for module in curriculum["modules"] for activity in module["activities"]]
+    
+    # The same completion pattern is applied to both formats
+    def build_documents(compact):
+        rng = random.Random(documents)
+        built = []
+        for index in range(documents):
+            progress = build_progress_document(f"bench.progress{index}@example.com", f"Teacher {index}",
+                                               class_level, subject, curriculum, compact=compact)
+            completed = rng.sample(activity_ids, rng.randint(0, len(activity_ids)))
+            completed_at = datetime.now()
+            for activity_id in completed:
+                if compact:
+                    progress["completed_bits"] = Int64(progress["completed_bits"] | 1 << activity_id)
+                    progress["completion_dates"][str(activity_id)] = completed_at
+                else:
+                    for module in progress["modules_progress"]:
+                        for activity in module["activities"]:
+                            if activity["activity_id"] == activity_id:
+                                activity["completed"] = True
+                                activity["completion_date"] = completed_at
+                                module["completed_activities"] += 1
+            progress["completed_activities"] = len(completed)
+            progress["progress_percentage"] = int(len(completed) / len(activity_ids) * 100)
+            built.append(progress)
+        return built
+    
+    bench_client, database, counter = open_benchmark_database(database_name)
+    try:
+        click.echo(f"{'format':>8} {'BSON MB':>10} {'python MB':>10} {'stored MB':>10} {'expand ms':>10}")
+        for compact in (False, True):
+            tracemalloc.start()
+            built = build_documents(compact)
+            python_bytes = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            bson_bytes = sum(len(bson_encode(progress)) for progress in built)
+            
+            course_progress = database["course_progress"]
+            course_progress.drop()
+            course_progress.insert_many(built)
+            try:
+                stored_bytes = database.command("collStats", "course_progress")["storageSize"]
+                stored = f"{stored_bytes / 2**20:10.1f}"
+            except OperationFailure:
+                stored = f"{'n/a':>10}"
+            
+            # Reading a compact document costs a join against the cached curriculum
+            started = time.perf_counter()
+            for progress in built:
+                expand_progress(progress)
+            expand_ms = (time.perf_counter() - started) * 1000
+            
+            label = "bitset" if compact else "full"
+            click.echo(f"{label:>8} {bson_bytes / 2**20:10.1f} {python_bytes / 2**20:10.1f} {stored} {expand_ms:10.1f}")
+            del built
+        database["course_progress"].drop()
+    finally:
+        bench_client.close()
+
+@bench_cli.command("transcode")
+@click.option("--images", default=48, show_default=True)
+@click.option("--size", default="1600x1200", show_default=True, help="Source photo size as WIDTHxHEIGHT.")
+@click.option("--processes", default=0, help="Largest pool to try; defaults to the CPU count.")
+def bench_transcode(images, size, processes):
+    """Render photo renditions with growing process pools and report throughput per process."""
+    if Image is None:
+        raise click.ClickException("Pillow is not installed")
+    width, height = (int(value) for value in size.lower().split("x"))
+    processes = processes or os.cpu_count() or 1
+    Image.init()
+    widths = app.config['PHOTO_RENDITION_WIDTHS']
+    format_names = [name for name in app.config['PHOTO_RENDITION_FORMATS']
+                    if name in RENDITION_FORMATS and RENDITION_FORMATS[name][0] in Image.SAVE]
+    
+    work_folder = tempfile.mkdtemp(prefix="edupulse-transcode-")
+    try:
+        # Noise over a gradient compresses about as badly as a camera photo
+        gradient = Image.linear_gradient("L").resize((width, height)).convert("RGB")
+        sources = []
+        for index in range(images):
+            image = Image.blend(Image.effect_noise((width, height), 40 + index % 20).convert("RGB"), gradient, 0.5)
+            source_path = os.path.join(work_folder, f"source-{index}.jpg")
+            image.save(source_path, format="JPEG", quality=90)
+            sources.append(source_path)
+        original_bytes = sum(os.path.getsize(source_path) for source_path in sources)
+        
+        click.echo(f"{images} photos of {width}x{height}, widths {widths}, formats {format_names}")
+        click.echo(f"{'processes':>9} {'seconds':>8} {'photos/s':>10} {'per proc':>10}")
+        pool_sizes = sorted({min(2 ** power, processes) for power in range(processes.bit_length() + 1)})
+        for pool_size in pool_sizes:
+            started = time.perf_counter()
+            with ProcessPoolExecutor(max_workers=pool_size) as executor:
+                results = list(executor.map(render_photo_renditions, sources,
+                                            itertools.repeat(widths), itertools.repeat(format_names)))
+            elapsed = time.perf_counter() - started
+            rate = images / elapsed
+            click.echo(f"{pool_size:>9} {elapsed:8.2f} {rate:10.1f} {rate / pool_size:10.1f}")
+        
+        for format_name in format_names:
+            for rendition_width in widths:
+                sizes = [rendition["size"] for result in results for rendition in result["renditions"]
+                         if rendition["format"] == format_name and rendition["width"] == rendition_width]
+                if sizes:
+                    click.echo(f"{format_name:>5} w{rendition_width:<5} {sum(sizes) / len(sizes) / 1024:8.1f} KB avg "
+                               f"({sum(sizes) / original_bytes * 100:.1f}% of the originals)")
+    finally:
+        shutil.rmtree(work_folder, ignore_errors=True)
+
+@bench_cli.command("photo-reuse")
+@click.option("--photos", default=100000, show_default=True, help="Photo hashes in one school's history.")
+@click.option("--lookups", default=2000, show_default=True)
+def bench_photo_reuse(photos, lookups):
+    """Time near-duplicate lookups in one school's photo hash table."""
+    max_distance = app.config['PHOTO_REUSE_MAX_DISTANCE']
+    rng = random.Random(photos)
+    hashes = [rng.getrandbits(64) for _ in range(photos)]
+    
+    started = time.perf_counter()
+    table = MultiIndexHashTable(max_distance)
+    for index, value in enumerate(hashes):
+        table.add(value, index)
+    build_seconds = time.perf_counter() - started
+    
+    # Half the lookups are re-submissions with a few bits changed, half are new pictures
+    timings = []
+    found = 0
+    for index in range(lookups):
+        value = rng.getrandbits(64)
+        if index % 2 == 0:
+            value = rng.choice(hashes)
+            for bit in rng.sample(range(64), rng.randint(0, max_distance)):
+                value ^= 1 << bit
+        started = time.perf_counter()
+        matches = table.search(value)
+        timings.append(time.perf_counter() - started)
+        found += bool(matches)
+    
+    timings.sort()
+    click.echo(f"{photos} hashes indexed in {build_seconds:.2f}s, distance <= {max_distance}")
+    click.echo(f"lookup mean {sum(timings) / len(timings) * 1e6:.0f} us, p50 {timings[len(timings) // 2] * 1e6:.0f} us, "
+               f"p99 {timings[int(len(timings) * 0.99)] * 1e6:.0f} us")
+    click.echo(f"{found} of {lookups} lookups matched ({lookups // 2 + lookups % 2} were near-duplicates)")
+
+@bench_cli.command("storage")
+@click.option("--objects", default=20, show_default=True)
+@click.option("--size-kb", default=500, show_default=True)
+def bench_storage(objects, size_kb):
+    """Round-trip photos through the configured storage: presigned PUT, size check, fetch and delete.
+    
+    Point PHOTO_STORAGE=s3 and S3_ENDPOINT_URL at a local MinIO to exercise the S3 backend."""
+    client = app.test_client()
+    payload = os.urandom(size_kb * 1024)
+    timings = {"presign": [], "put": [], "size": [], "fetch": [], "delete": []}
+    
+    def timed(step, function, *args):
+        started = time.perf_counter()
+        result = function(*args)
+        timings[step].append(time.perf_counter() - started)
+        return result
+    
+    def upload(url, content_type):
+        if isinstance(photo_storage.backend(), LocalDiskStorage):
+            # The local backend's URLs point at this app
+            response = client.put(url, data=payload, headers={"Content-Type": content_type})
+            return response.status_code
+        upload_request = urllib.request.Request(url, data=payload, method="PUT", headers={"Content-Type": content_type})
+        with urllib.request.urlopen(upload_request) as response:
+            return response.status
+    
+    with app.test_request_context():
+        for index in range(objects):
+            key = f"{direct_upload_prefix('bench.storage@example.com')}{uuid.uuid4().hex}/photo-{index}.jpg"
+            url = timed("presign", photo_storage.presigned_put, key, "image/jpeg", 300)
+            status = timed("put", upload, url, "image/jpeg")
+            if status != 200:
+                raise click.ClickException(f"Upload of {key} failed with HTTP {status}")
+            if timed("size", photo_storage.size, key) != len(payload):
+                raise click.ClickException(f"Stored size of {key} does not match the upload")
+            
+            local_path = os.path.join(upload_staging_folder(), f"bench-{uuid.uuid4().hex}")
+            try:
+                timed("fetch", photo_storage.fetch, key, local_path)
+                if file_sha256(local_path) != hashlib.sha256(payload).hexdigest():
+                    raise click.ClickException(f"Fetched copy of {key} differs from the upload")
+            finally:
+                discard_file(local_path)
+            timed("delete", photo_storage.delete, key)
+    
+    click.echo(f"{objects} photos of {size_kb} KB through {type(photo_storage.backend()).__name__}")
+    for step, values in timings.items():
+        click.echo(f"{step:>8} {sum(values) / len(values) * 1000:8.1f} ms avg {max(values) * 1000:8.1f} ms max")
+
+@bench_cli.command("metrics")
+@click.option("--requests", "request_count", default=2000, show_default=True, help="Requests per timed round.")
+@click.option("--commands", "command_count", default=2000, show_default=True, help="MongoDB commands per timed round.")
+@click.option("--rounds", default=3, show_default=True, help="Alternating rounds with metrics off and on; the best counts.")
+@click.option("--database", "database_name", default="edupulse_bench", show_default=True)
+def bench_metrics(request_count, command_count, rounds, database_name):
+    """Cost of the Prometheus metrics per request, per MongoDB command and per scrape.
+    
+    Run it with PROMETHEUS_MULTIPROC_DIR set to measure the multiprocess mode used under gunicorn."""
+    global metrics
+    if metrics is None:
+        raise click.ClickException("Metrics are disabled; install prometheus_client and leave METRICS_ENABLED=1")
+    mode = "multiprocess" if "PROMETHEUS_MULTIPROC_DIR" in os.environ else "single-process"
+    enabled_metrics = metrics
+    client = app.test_client()
+    
+    def time_requests():
+        started = time.perf_counter()
+        for _ in range(request_count):
+            client.get("/healthz")
+        return (time.perf_counter() - started) / request_count
+    
+    bench_client, database, counter = open_benchmark_database(database_name)
+    # Neither client carries the benchmark's command counter, so only the metrics listener differs
+    plain_client = MongoClient(app.config['MONGO_URI'], serverSelectionTimeoutMS=5000)
+    metered_client = MongoClient(app.config['MONGO_URI'], serverSelectionTimeoutMS=5000, event_listeners=[enabled_metrics])
+    try:
+        database["metrics_bench"].drop()
+        database["metrics_bench"].insert_one({"_id": 1})
+        collections = {"off": plain_client[database_name]["metrics_bench"],
+                       "on": metered_client[database_name]["metrics_bench"]}
+        
+        def time_commands(collection):
+            started = time.perf_counter()
+            for _ in range(command_count):
+                collection.find_one({"_id": 1})
+            return (time.perf_counter() - started) / command_count
+        
+        timings = {"request": {"off": [], "on": []}, "command": {"off": [], "on": []}}
+        time_requests()
+        for _ in range(rounds):
+            for state in ["off", "on"]:
+                metrics = enabled_metrics if state == "on" else None
+                timings["request"][state].append(time_requests())
+                timings["command"][state].append(time_commands(collections[state]))
+    finally:
+        metrics = enabled_metrics
+        plain_client.close()
+        metered_client.close()
+        bench_client.close()
+    
+    scrapes = []
+    for _ in range(20):
+        started = time.perf_counter()
+        prometheus_client.generate_latest(metrics_registry())
+        scrapes.append(time.perf_counter() - started)
+    
+    click.echo(f"Metrics in {mode} mode")
+    click.echo(f"{'step':>8} {'off us':>10} {'on us':>10} {'overhead us':>12}")
+    for step, values in timings.items():
+        off, on = min(values["off"]) * 1e6, min(values["on"]) * 1e6
+        click.echo(f"{step:>8} {off:10.1f} {on:10.1f} {on - off:12.1f}")
+    click.echo(f"  scrape {min(scrapes) * 1000:.2f} ms best, {max(scrapes) * 1000:.2f} ms worst")
+
+# Runs in a fresh interpreter for bench startup; prints its timings as JSON
+STARTUP_BENCHMARK_SCRIPT = """
+import json, sys, time
+started = time.perf_counter()
+import edupulse_app
+imported = time.perf_counter()
+client = edupulse_app.create_app().test_client()
+timings = {"import": imported - started}
+for name in ["first", "second"]:
+    request_started = time.perf_counter()
+    client.post("/login", data={"email": "bench.startup@example.com", "password": "wrong"})
+    timings[name] = time.perf_counter() - request_started
+json.dump(timings, sys.stdout)
+"""
+
+@bench_cli.command("startup")
+@click.option("--repeat", default=5, show_default=True, help="Fresh processes to start.")
+@click.option("--database", "database_name", default="edupulse_bench", show_default=True)
+def bench_startup(repeat, database_name):
+    """Import time of the app and latency of the first and second request in a fresh process.
+    
+    The requests are failed logins, which read the users and principals collections."""
+    bench_client, database, counter = open_benchmark_database(database_name)
+    bench_client.close()
+    env = {**os.environ, "MONGO_DB_NAME": database_name}
+    module_folder = os.path.dirname(os.path.abspath(__file__))
+    runs = []
+    for _ in range(repeat):
+        result = subprocess.run([sys.executable, "-c", STARTUP_BENCHMARK_SCRIPT], cwd=module_folder, env=env,
+                                capture_output=True, text=True)
+        if result.returncode != 0:
+            raise click.ClickException(f"Startup run failed:\n{result.stderr}")
+        runs.append(json.loads(result.stdout.strip().splitlines()[-1]))
+    
+    click.echo(f"{'step':>8} {'mean ms':>10} {'best ms':>10}")
+    for step in ["import", "first", "second"]:
+        values = [run[step] for run in runs]
+        click.echo(f"{step:>8} {sum(values) / len(values) * 1000:10.1f} {min(values) * 1000:10.1f}")
+
 if __name__ == '__main__':
     # Create test user for easy login
     create_test_users()
@@ -2954,4 +6973,4 @@ if __name__ == '__main__':
     
     # Run the application
     logger.info("Starting Flask application...")
-    app.run(debug=True)
+    create_app().run(debug=True)